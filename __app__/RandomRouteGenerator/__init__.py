@@ -8,67 +8,261 @@
 
 import logging
 import os
-import gzip
+import json
+import functools
+import typing
 import azure.functions as func
 from datetime import datetime
-from __app__.SharedCode import blobutils, maputils
+from __app__.SharedCode import (
+    blobutils, maputils, secretutils, fetchutils, metricsutils, routeutils,
+    panelutils, spoolutils, scheduleutils, geometryutils, statsutils)
 
 
-def main(mytimer: func.TimerRequest) -> None:
+def main(mytimer: func.TimerRequest,
+         workitems: func.Out[typing.List[str]] = None) -> None:
     """Main method triggered by CRON time trigger"""
+    run_metrics = metricsutils.RunMetrics("RandomRouteGenerator")
+    # Start uploading blobs spooled but not uploaded by earlier runs
+    spoolutils.resume()
+    try:
+        process_cities(workitems, run_metrics)
+    finally:
+        spoolutils.drain()
+        # One structured record of where the invocation's time went
+        run_metrics.emit()
+
+
+def process_cities(workitems, run_metrics):
+    """Processes every city in the config, or queues them in fan-out mode"""
     logging.info("RandomRouteGenerator function initialised.")
 
     # Call blob storage to get city polygon definitions from stored JSON file
     polygons_json = blobutils.get_polygonsJSON()
-    logging.info(f"Retrieved polygon JSON from blob storage")
+    logging.info("Retrieved polygon JSON from blob storage")
 
-    # existing blob container for saving outputs
-    container_url = os.environ["TRAFFICROUTES_OUTPUT_URL"]
+    # In fan-out mode each city is queued for the RandomRouteWorker function
+    if os.environ.get("FANOUT_MODE", "false").lower() == "true":
+        workitems.set([json.dumps(city_polygon)
+                       for city_polygon in polygons_json])
+        logging.info(f"Queued {len(polygons_json)} cities for route workers")
+        return
+
+    # Share the run's routes out by how much each city's delays vary
+    schedule = None
+    if scheduleutils.adaptive_schedule:
+        schedule = scheduleutils.Schedule("RandomRouteGenerator")
+        schedule.plan_routes(
+            [city_polygon.get('cityId', polygons_count)
+             for polygons_count, city_polygon in enumerate(polygons_json)],
+            int(maputils.num_of_routes_to_calc))
 
     # Iterate through JSON array and get random coordinates for each city
+    failed_cities = []
     for polygons_count, city_polygon in enumerate(polygons_json):
         try:
-            # Get polygon for the city
-            city_id = city_polygon['cityId']
-            assert city_id, ("'cityId' field empty/not found in array"
-                             f"[{polygons_count}] in polygons JSON")
-
-            polygon_string = city_polygon['polygon']
-            assert polygon_string, ("City 'polygon' field empty/not in array"
-                                    f" [{polygons_count}] in polygons JSON")
-
-            # Call method to convert polygon string to Shapely polygon object
-            logging.info(f"Generating random coordinates for CityID {city_id}")
-            polygon = maputils.create_polygon_from_string(polygon_string)
-            assert polygon, "Valid polygon should be in city polygon string"
-
-            # Get random routes within polygon
-            random_coords = maputils.get_random_coords(polygon)
-
-            # Send random routes to Azure Maps to get the calculation data
-            blob_count = 1
-            for origin, dest in zip(
-                    random_coords[0::2], random_coords[1::2]):
-                # Construct an API request with route to query
-                query = maputils.construct_routes_query(origin, dest)
-                # Query Azure Maps API
-                file = maputils.query_maps(query)
-                # Save result to blob with datetime values as folder path
-                dt = datetime.utcnow().timetuple()
-                file_name = (f"cityId={city_id}/year={dt[0]}/month={dt[1]}/"
-                             f"day={dt[2]}/hour={dt[3]}/minute={dt[4]}/"
-                             f"{blob_count}.json.gz")
-                # Output the JSON result to blob
-                if file:
-                    gzipped = gzip.compress(file)
-                    blobutils.upload_results(container_url, file_name, gzipped)
-                    blob_count += 1
-                else:
-                    logging.error("Response from Maps empty. Skipping upload.")
+            city_id = city_polygon.get('cityId', polygons_count)
+            with run_metrics.city(city_id):
+                process_city(city_polygon, polygons_count, schedule)
+        except Exception as ex:
+            # Carry on with the other cities, the run fails at the end
+            logging.exception(ex)
+            failed_cities.append(city_polygon.get('cityId', polygons_count))
+
+    if schedule is not None:
+        schedule.save()
+
+    logging.info("Key Vault secret cache stats: "
+                 f"{secretutils.get_cache_stats()}")
+
+    if failed_cities:
+        raise Exception(f"Random routes failed for CityIDs {failed_cities}")
+
+
+def process_city(city_polygon, polygons_count=0, schedule=None):
+    """Generates, queries & uploads the random routes for a single city"""
+    # existing blob container for saving outputs
+    container_url = os.environ["TRAFFICROUTES_OUTPUT_URL"]
+
+    # Number of routes fetched in parallel, can be overridden per city
+    concurrency = int(os.environ.get("ROUTES_CONCURRENCY", 8))
+
+    # Send routes one request each ('single') or through the batch API
+    request_mode = os.environ.get("ROUTES_REQUEST_MODE", "single")
+    batch_size = int(os.environ.get("ROUTES_BATCH_SIZE", 700))
+
+    # Write a blob per route ('files') or one NDJSON stream ('ndjson')
+    output_mode = os.environ.get("ROUTES_OUTPUT_MODE", "files")
+
+    # Rewrite route point lists compactly ('delta' or 'polyline') or not
+    geometry_encoding = os.environ.get("ROUTES_GEOMETRY_ENCODING", "none")
+
+    # Also write a columnar summary of the run's routes for analytics
+    summary_output = (
+        os.environ.get("ROUTES_SUMMARY_OUTPUT", "false").lower() == "true")
+
+    # Reuse a stored panel of OD pairs instead of sampling every run
+    od_panel = os.environ.get("OD_PANEL", "false").lower() == "true"
+
+    if geometry_encoding not in geometryutils.geometry_encodings:
+        raise ValueError(
+            f"Unknown route geometry encoding '{geometry_encoding}'")
+
+    # Get polygon for the city
+    city_id = city_polygon['cityId']
+    assert city_id, ("'cityId' field empty/not found in array"
+                     f"[{polygons_count}] in polygons JSON")
+
+    polygon_string = city_polygon['polygon']
+    assert polygon_string, ("City 'polygon' field empty/not in array"
+                            f" [{polygons_count}] in polygons JSON")
 
+    # Get the Shapely polygon object for the polygon string, which
+    # is only parsed again when the city's polygon changes
+    logging.info(f"Generating random coordinates for CityID {city_id}")
+    polygon = maputils.get_city_polygon(polygon_string)
+    assert polygon, "Valid polygon should be in city polygon string"
+
+    # Number of routes, unless the adaptive schedule chose one for the city
+    num_routes = int(maputils.num_of_routes_to_calc)
+    if schedule is not None:
+        num_routes = schedule.get_num_routes(city_id)
+
+    # Get random routes within polygon
+    if od_panel:
+        # Scheduled route counts vary by run, so the panel is kept at the
+        # most a city can be given rather than resampled on every change
+        panel_size = schedule.max_routes if schedule is not None else None
+        routes = panelutils.get_od_panel(city_id, polygon, num_routes,
+                                         panel_size=panel_size)
+    else:
+        random_coords = maputils.get_random_coords(polygon, num_routes * 2)
+        routes = maputils.pair_coords(random_coords)
+
+    # Save results to blob with datetime values as folder path
+    dt = datetime.utcnow().timetuple()
+    run_folder = (f"cityId={city_id}/year={dt[0]}/month={dt[1]}/"
+                  f"day={dt[2]}/hour={dt[3]}/minute={dt[4]}/")
+    sinks = routeutils.create_route_sinks(container_url, run_folder,
+                                          output_mode, summary_output)
+    if schedule is not None:
+        # Observes the spread of the city's delays for the next schedule
+        delay_tracker = scheduleutils.RouteDelayTracker()
+        sinks.append(delay_tracker)
+    if statsutils.stats_output:
+        # Keeps the city's running statistics up to date as routes arrive
+        sinks.append(statsutils.RouteStatsSink(city_id))
+
+    # Send random routes to Azure Maps to get the calculation data
+    concurrency = int(city_polygon.get('concurrency', concurrency))
+    if request_mode == "batch":
+        batches = [(routes[i:i + batch_size],)
+                   for i in range(0, len(routes), batch_size)]
+        # Batches return how many of their routes failed
+        batch_failures = []
+
+        def fetch_batch(batch):
+            try:
+                batch_failures.append(fetch_route_batch(
+                    sinks, batch, geometry_encoding=geometry_encoding))
+            except Exception as ex:
+                # Every route of a batch that couldn't be sent has failed
+                logging.exception(
+                    f"Route batch of {len(batch)} items failed", exc_info=ex)
+                batch_failures.append(len(batch))
+
+        failed = fetchutils.run_concurrently(fetch_batch, batches,
+                                             concurrency)
+        failed += sum(batch_failures)
+    else:
+        failed = fetchutils.run_concurrently(
+            functools.partial(fetch_route, sinks,
+                              geometry_encoding=geometry_encoding),
+            routes, concurrency)
+    if failed:
+        logging.error(f"{failed} routes failed for CityID {city_id}")
+
+    # Every sink is closed even if one fails, the city fails afterwards
+    close_errors = []
+    for sink in sinks:
+        try:
+            sink.close()
         except Exception as ex:
             logging.exception(ex)
-            raise
-        else:
-            logging.info(f"Random routes for CityID {city_id} successfully"
-                         " queried & results uploaded to blob storage")
+            close_errors.append(ex)
+    if close_errors:
+        raise close_errors[0]
+
+    if schedule is not None:
+        schedule.record_routes(city_id, delay_tracker.delays)
+
+    logging.info(f"Random routes for CityID {city_id} successfully"
+                 " queried & results uploaded to blob storage")
+
+
+def fetch_route(sinks, origin, dest, geometry_encoding="none"):
+    """Queries Maps for a route and passes the result to the sinks"""
+    # Construct an API request with route to query
+    query = maputils.construct_routes_query(origin, dest)
+
+    # Compacting needs the whole response, so can't be streamed
+    if (len(sinks) == 1 and sinks[0].streaming
+            and geometry_encoding == "none"):
+        # Pass the response through as it is read, without buffering it
+        response = maputils.open_maps_stream(query)
+        if response is None:
+            raise Exception(f"No route from Maps for {origin} to {dest}")
+        with response:
+            sinks[0].add_stream(origin, dest, datetime.utcnow(),
+                                response.iter_content(chunk_size=64 * 1024))
+        return
+
+    # Query Azure Maps API
+    file = maputils.query_maps(query)
+    if not file:
+        # Raised so the route is counted as failed, not silently dropped
+        raise Exception(f"No route from Maps for {origin} to {dest}")
+
+    with metricsutils.timer("geometry_encoding"):
+        file = geometryutils.compact_route_file(file, geometry_encoding)
+    output_route(sinks, origin, dest, datetime.utcnow(), file)
+
+
+def fetch_route_batch(sinks, routes, geometry_encoding="none"):
+    """Queries Maps for a batch of routes and outputs each item's result.
+
+    Results are output on the calling thread, as batches already run
+    concurrently. Returns the number of the batch's routes that failed.
+    """
+    batch_items = [maputils.construct_routes_batch_item(origin, dest)
+                   for origin, dest in routes]
+    results = maputils.query_maps_batch(batch_items)
+    if not results:
+        logging.error(f"Route batch of {len(routes)} items failed")
+        return len(routes)
+
+    request_time = datetime.utcnow()
+    # Routes Maps gave no item for are failed too
+    failed = max(len(routes) - len(results), 0)
+    if failed:
+        logging.error(f"Route batch returned {len(results)} of "
+                      f"{len(routes)} items")
+    for (origin, dest), result in zip(routes, results):
+        if result.get("statusCode") != 200:
+            logging.error(f"Batch route failed: {result.get('response')}")
+            failed += 1
+            continue
+        try:
+            route_json = geometryutils.compact_route(result["response"],
+                                                     geometry_encoding)
+            output_route(sinks, origin, dest, request_time,
+                         json.dumps(route_json).encode("utf-8"))
+        except Exception as ex:
+            logging.exception("Batch route output failed", exc_info=ex)
+            failed += 1
+    return failed
+
+
+def output_route(sinks, origin, dest, request_time, file):
+    """Passes a route response to each of the city run's sinks"""
+    for sink in sinks:
+        sink.add(origin, dest, request_time, file)
@@ -0,0 +1,30 @@
+# --------------------------------------------------------------
+# Generates and queries the random routes for a single city
+#
+# Triggered by work items queued by RandomRouteGenerator in fan-out mode,
+# so cities are processed independently across Function instances
+#
+# Connection strings in Function App Settings, queue config in function.json
+# --------------------------------------------------------------
+
+import logging
+import azure.functions as func
+from __app__ import RandomRouteGenerator
+from __app__.SharedCode import metricsutils, spoolutils
+
+
+def main(msg: func.QueueMessage) -> None:
+    """Main method triggered by a city work item on the routes queue"""
+    city_polygon = msg.get_json()
+    logging.info("RandomRouteWorker function initialised for CityID "
+                 f"{city_polygon.get('cityId')}.")
+
+    run_metrics = metricsutils.RunMetrics("RandomRouteWorker")
+    # Start uploading blobs spooled but not uploaded by earlier runs
+    spoolutils.resume()
+    try:
+        with run_metrics.city(city_polygon.get('cityId')):
+            RandomRouteGenerator.process_city(city_polygon)
+    finally:
+        spoolutils.drain()
+        run_metrics.emit()
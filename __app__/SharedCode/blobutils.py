@@ -3,9 +3,18 @@
 # ----------------------------------------------------------
 
 
-from azure.storage.blob import BlobClient, ContainerClient
-from azure.identity import DefaultAzureCredential
+from azure.storage.blob import BlobClient, ContainerClient, BlobBlock
+from azure.core.pipeline.transport import RequestsTransport
+from azure.core.exceptions import (
+    HttpResponseError, ResourceNotModifiedError, ResourceNotFoundError,
+    ResourceModifiedError, ResourceExistsError)
+from azure.core import MatchConditions
+from __app__.SharedCode import httputils, metricsutils
+from urllib.parse import urlsplit, urlunsplit
+import collections
+import threading
 import logging
+import posixpath
 import json
 import os
 
@@ -13,35 +22,99 @@ import os
 # Get environment variables
 # Local dev: found in local.settings.json, Azure: Function App Settings
 cities_config_url = os.environ["CITIES_CONFIG_URL"]
-blob_credential = DefaultAzureCredential()
+
+# Credential for blob storage, created on first use to keep cold starts short
+blob_credential_lock = threading.Lock()
+blob_credential = None
+
+# Container clients are kept for the life of the worker, one per URL
+container_clients_lock = threading.Lock()
+container_clients = {}
+
+# Last downloaded cities config, revalidated by ETag on each run
+cities_config_lock = threading.Lock()
+cities_config_cache = {"etag": None, "polygons_json": None}
+
+# Names of blobs known to exist, so content-addressed uploads can be skipped
+known_blobs_limit = 100000
+known_blobs_lock = threading.Lock()
+known_blobs = collections.OrderedDict()
+
+
+def get_blob_credential():
+    """Gets the blob storage credential, creating it on first use"""
+    global blob_credential
+    with blob_credential_lock:
+        if blob_credential is None:
+            # azure.identity is slow to import, so only load it when needed
+            from azure.identity import DefaultAzureCredential
+            blob_credential = DefaultAzureCredential()
+        return blob_credential
+
+
+def create_storage_transport():
+    """Create a transport sending requests over the pooled storage session"""
+    return RequestsTransport(session=httputils.get_session("storage"),
+                             session_owner=False)
 
 
 def create_container_client(url):
-    """Create container client from URL to read/write blobs to Azure"""
-    container_client = ContainerClient.from_container_url(
-        url, credential=blob_credential
-    )
-    return container_client
+    """Get (or create once) container client to read/write blobs to Azure"""
+    with container_clients_lock:
+        if url not in container_clients:
+            container_clients[url] = ContainerClient.from_container_url(
+                url, credential=get_blob_credential(),
+                transport=create_storage_transport()
+            )
+        return container_clients[url]
 
 
 def create_blob_client(url):
     """Create blob client from URL to read/write blobs to Azure"""
-    blob_client = BlobClient.from_blob_url(url, credential=blob_credential)
+    blob_client = BlobClient.from_blob_url(
+        url, credential=get_blob_credential(),
+        transport=create_storage_transport())
     return blob_client
 
 
 def get_polygonsJSON():
-    """Gets JSON definition file of city polygons from Azure Blob Storage"""
+    """Gets JSON definition file of city polygons from Azure Blob Storage.
+
+    The parsed file is kept between runs and only downloaded again when its
+    ETag changes, so an unchanged config costs a single 304 response.
+    """
     polygon_blob_client = create_blob_client(cities_config_url)
 
+    with cities_config_lock:
+        etag = cities_config_cache["etag"]
+        cached_json = cities_config_cache["polygons_json"]
+
     try:
-        # Download polygon JSON blob from Azure Storage
-        polygons_filestream = polygon_blob_client.download_blob()
+        # Download polygon JSON blob from Azure Storage if it has changed
+        if etag:
+            try:
+                with metricsutils.timer("blob_download"):
+                    polygons_filestream = polygon_blob_client.download_blob(
+                        etag=etag, match_condition=MatchConditions.IfModified)
+            except HttpResponseError as ex:
+                # Newer SDKs raise a 304 as a generic (or 'modified') error
+                if not (isinstance(ex, ResourceNotModifiedError)
+                        or ex.status_code == 304):
+                    raise
+                logging.info("Polygon JSON unchanged, using cached copy")
+                return cached_json
+        else:
+            with metricsutils.timer("blob_download"):
+                polygons_filestream = polygon_blob_client.download_blob()
         polygons_file = polygons_filestream.readall()
         polygons_json = json.loads(polygons_file)
 
         assert polygons_json, "Polygons JSON should not be empty"
 
+        with cities_config_lock:
+            cities_config_cache["etag"] = polygons_filestream.properties.etag
+            cities_config_cache["polygons_json"] = polygons_json
+
         return polygons_json
 
     except Exception as ex:
@@ -50,8 +123,25 @@ def get_polygonsJSON():
         raise Exception(message, ex)
 
 
-def upload_results(container_url, file_name, results):
-    """Uploads JSON results to the specified city's blob container"""
+def clear_polygonsJSON_cache():
+    """Forgets the cached cities config so the next call downloads it"""
+    with cities_config_lock:
+        cities_config_cache["etag"] = None
+        cities_config_cache["polygons_json"] = None
+
+
+def get_config_blob_url(*parts):
+    """Gets the URL of a blob stored under the cities config's folder"""
+    scheme, netloc, path, query, fragment = urlsplit(cities_config_url)
+    path = posixpath.join(posixpath.dirname(path), *parts)
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+
+def upload_results(container_url, file_name, results, raise_errors=False):
+    """Uploads JSON results to the specified city's blob container.
+
+    Failures are logged, and only raised if `raise_errors` is set.
+    """
     # Create blob client to output map response into
     container_client = create_container_client(container_url)
     # Instantiate a new BlobClient
@@ -59,10 +149,142 @@ def upload_results(container_url, file_name, results):
 
     # Upload the file
     try:
-        upload_props = upload_blob_client.upload_blob(results)
+        with metricsutils.timer("blob_upload"):
+            upload_props = upload_blob_client.upload_blob(results)
+        metricsutils.count("blob_upload_bytes", len(results))
         return upload_props
     except Exception as ex:
         logging.exception(f"Blob upload failed, filename: {file_name}.",
                           exc_info=ex)
+        if raise_errors:
+            raise
     else:
         logging.info(f'Blob successfully uploaded: {file_name}')
+
+
+def download_blob(blob_url):
+    """Downloads a blob's content, or None if the blob doesn't exist"""
+    blob_client = create_blob_client(blob_url)
+    try:
+        with metricsutils.timer("blob_download"):
+            data = blob_client.download_blob().readall()
+    except ResourceNotFoundError:
+        return None
+    metricsutils.count("blob_download_bytes", len(data))
+    return data
+
+
+def upload_blob(blob_url, data):
+    """Uploads data to a blob by URL, replacing any existing content"""
+    blob_client = create_blob_client(blob_url)
+    try:
+        with metricsutils.timer("blob_upload"):
+            upload_props = blob_client.upload_blob(data, overwrite=True)
+        metricsutils.count("blob_upload_bytes", len(data))
+        return upload_props
+    except Exception as ex:
+        logging.exception(f"Blob upload failed, url: {blob_url}.",
+                          exc_info=ex)
+        raise
+
+
+def download_blob_with_etag(blob_url):
+    """Downloads a blob's content & ETag, or (None, None) if it's missing"""
+    blob_client = create_blob_client(blob_url)
+    try:
+        with metricsutils.timer("blob_download"):
+            downloader = blob_client.download_blob()
+            data = downloader.readall()
+    except ResourceNotFoundError:
+        return None, None
+    metricsutils.count("blob_download_bytes", len(data))
+    return data, downloader.properties.etag
+
+
+def upload_blob_if_unchanged(blob_url, data, etag):
+    """Uploads data to a blob only if no one has changed it since it was read.
+
+    `etag` is the ETag the blob was read at, or None if it didn't exist, in
+    which case the blob must still not exist. Returns False if another
+    writer got there first, so the caller can read it again and retry.
+    """
+    blob_client = create_blob_client(blob_url)
+    try:
+        with metricsutils.timer("blob_upload"):
+            if etag:
+                blob_client.upload_blob(
+                    data, overwrite=True, etag=etag,
+                    match_condition=MatchConditions.IfNotModified)
+            else:
+                blob_client.upload_blob(data, overwrite=False)
+    except (ResourceModifiedError, ResourceExistsError):
+        return False
+    except HttpResponseError as ex:
+        # Older SDKs raise failed preconditions as generic errors
+        if ex.status_code not in (409, 412):
+            raise
+        return False
+    metricsutils.count("blob_upload_bytes", len(data))
+    return True
+
+
+def stage_block(container_url, file_name, block_id, data):
+    """Stages one block of a block blob, to be committed later"""
+    container_client = create_container_client(container_url)
+    blob_client = container_client.get_blob_client(file_name)
+    with metricsutils.timer("blob_upload"):
+        blob_client.stage_block(block_id, data)
+    metricsutils.count("blob_upload_bytes", len(data))
+
+
+def commit_blocks(container_url, file_name, block_ids):
+    """Commits staged blocks, in the given order, as the blob's content"""
+    container_client = create_container_client(container_url)
+    blob_client = container_client.get_blob_client(file_name)
+    try:
+        with metricsutils.timer("blob_commit"):
+            return blob_client.commit_block_list(
+                [BlobBlock(block_id=block_id) for block_id in block_ids])
+    except Exception as ex:
+        logging.exception(f"Block commit failed, filename: {file_name}.",
+                          exc_info=ex)
+        raise
+
+
+def upload_if_absent(container_url, file_name, results, raise_errors=False):
+    """Uploads results unless the blob already exists.
+
+    Meant for content-addressed blobs, whose content never changes for a
+    given name. Returns True if the blob was uploaded. A failed upload
+    isn't remembered, so the next call for the blob tries again.
+    """
+    key = (container_url, file_name)
+    with known_blobs_lock:
+        if key in known_blobs:
+            known_blobs.move_to_end(key)
+            metricsutils.count("blob_uploads_skipped")
+            return False
+
+    container_client = create_container_client(container_url)
+    blob_client = container_client.get_blob_client(file_name)
+    try:
+        with metricsutils.timer("blob_exists"):
+            blob_client.get_blob_properties()
+        uploaded = False
+        metricsutils.count("blob_uploads_skipped")
+    except ResourceNotFoundError:
+        # Only a blob that's known to be stored may be skipped later
+        try:
+            upload_results(container_url, file_name, results,
+                           raise_errors=True)
+        except Exception:
+            if raise_errors:
+                raise
+            return False
+        uploaded = True
+
+    with known_blobs_lock:
+        known_blobs[key] = True
+        if len(known_blobs) > known_blobs_limit:
+            known_blobs.popitem(last=False)
+    return uploaded
@@ -0,0 +1,108 @@
+# ----------------------------------------------------------
+# Utils for running Maps fetches & blob uploads concurrently
+# Shares a token bucket rate limiter across all worker threads so
+# requests stay within the Azure Maps queries-per-second quota
+# ----------------------------------------------------------
+
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import threading
+import logging
+import random
+import time
+import os
+
+
+# Get environment variables
+# Local dev: found in local.settings.json, Azure: Function App Settings
+maps_qps = float(os.environ.get("MAPS_QPS", 50))
+max_retries = int(os.environ.get("MAPS_MAX_RETRIES", 5))
+max_retry_after = float(os.environ.get("MAPS_MAX_RETRY_AFTER", 60))
+
+# Bounds for the exponential backoff between retries, in seconds
+backoff_base = 0.5
+backoff_cap = 30
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` acquisitions per second"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens
+                                  + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now,
+                           (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stops handing out tokens for a while, e.g. after a 429"""
+        with self.lock:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+            self.tokens = 0
+
+
+# Shared by every thread in the worker so the quota applies process-wide
+maps_rate_limiter = TokenBucket(maps_qps)
+
+
+def backoff_delay(attempt):
+    """Gets a full-jitter exponential backoff delay for a retry attempt"""
+    return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+
+
+def retry_after_seconds(response):
+    """Reads the Retry-After header of a response as seconds, if present.
+
+    The wait is capped at MAPS_MAX_RETRY_AFTER, so a bad or far off
+    header can't stall the run.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        seconds = float(retry_after)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+            seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(0.0, seconds), max_retry_after)
+
+
+def run_concurrently(function, items, max_workers):
+    """Calls function(*item) for each item on a bounded thread pool.
+
+    Exceptions raised for an item are logged and don't stop the others.
+    Returns the number of items that failed.
+    """
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [executor.submit(function, *item) for item in items]
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as ex:
+                failures += 1
+                logging.exception("Item failed in concurrent run",
+                                  exc_info=ex)
+    return failures
@@ -0,0 +1,152 @@
+# ----------------------------------------------------------
+# Compact, lossless encodings of route geometries
+# Rewrites the legs[].points lists of route directions responses as
+# delta-encoded fixed-point integers or encoded polylines, and expands
+# them back. Only needs NumPy, so readers of the stored routes can use
+# it without the function app's settings.
+# ----------------------------------------------------------
+
+
+import numpy as np
+import json
+
+
+# Point list encodings, 'none' leaves responses as returned by Maps
+geometry_encodings = ("none", "delta", "polyline")
+
+# Most decimal places tried when looking for a lossless precision
+max_precision = 9
+
+# Polyline characters are 5 bit chunks offset into printable ASCII
+polyline_offset = 63
+polyline_continue = 0x20
+
+
+def compact_route(route_json, encoding):
+    """Replaces the point lists of a route response's legs in place.
+
+    Each leg's `points` is swapped for `encodedPoints`, holding the
+    `format`, the decimal `precision` and either the `latitudes` and
+    `longitudes` as fixed-point integers (the first absolute, then
+    deltas) or a `polyline` string. Legs whose points can't be encoded
+    exactly are left as they are.
+    """
+    if encoding == "none":
+        return route_json
+    if encoding not in geometry_encodings:
+        raise ValueError(f"Unknown route geometry encoding '{encoding}'")
+
+    for route in route_json.get("routes", []):
+        for leg in route.get("legs", []):
+            points = leg.get("points")
+            if not points:
+                continue
+            encoded = encode_points(points, encoding)
+            if encoded is not None:
+                del leg["points"]
+                leg["encodedPoints"] = encoded
+    return route_json
+
+
+def expand_route(route_json):
+    """Restores the point lists of a route response compacted in place"""
+    for route in route_json.get("routes", []):
+        for leg in route.get("legs", []):
+            if "encodedPoints" in leg:
+                leg["points"] = decode_points(leg.pop("encodedPoints"))
+    return route_json
+
+
+def compact_route_file(file, encoding):
+    """Compacts a route response's JSON bytes"""
+    if encoding == "none":
+        return file
+    route_json = compact_route(json.loads(file), encoding)
+    return json.dumps(route_json, separators=(",", ":")).encode("utf-8")
+
+
+def encode_points(points, encoding):
+    """Encodes a list of latitude/longitude dicts, or None if not exact"""
+    latitudes = np.array([point["latitude"] for point in points],
+                         dtype=np.float64)
+    longitudes = np.array([point["longitude"] for point in points],
+                          dtype=np.float64)
+    precision = get_precision(np.concatenate([latitudes, longitudes]))
+    if precision is None:
+        return None
+
+    scale = 10 ** precision
+    lat_ints = np.rint(latitudes * scale).astype(np.int64)
+    lon_ints = np.rint(longitudes * scale).astype(np.int64)
+    if encoding == "delta":
+        return {"format": "delta", "precision": precision,
+                "latitudes": np.diff(lat_ints, prepend=0).tolist(),
+                "longitudes": np.diff(lon_ints, prepend=0).tolist()}
+    return {"format": "polyline", "precision": precision,
+            "polyline": encode_polyline(lat_ints, lon_ints)}
+
+
+def decode_points(encoded):
+    """Decodes `encodedPoints` back into latitude/longitude dicts"""
+    if encoded["format"] == "delta":
+        lat_ints = np.cumsum(np.array(encoded["latitudes"], dtype=np.int64))
+        lon_ints = np.cumsum(np.array(encoded["longitudes"], dtype=np.int64))
+    elif encoded["format"] == "polyline":
+        lat_ints, lon_ints = decode_polyline(encoded["polyline"])
+    else:
+        raise ValueError(f"Unknown points format '{encoded['format']}'")
+
+    scale = 10 ** encoded["precision"]
+    return [{"latitude": latitude, "longitude": longitude}
+            for latitude, longitude in zip((lat_ints / scale).tolist(),
+                                           (lon_ints / scale).tolist())]
+
+
+def get_precision(values):
+    """Gets the fewest decimal places that represent every value exactly"""
+    for precision in range(max_precision + 1):
+        scale = 10 ** precision
+        if np.array_equal(np.rint(values * scale) / scale, values):
+            return precision
+    return None
+
+
+def encode_polyline(lat_ints, lon_ints):
+    """Encodes fixed-point coordinates with the encoded polyline algorithm.
+
+    Latitude and longitude deltas alternate, each zigzag encoded so its
+    sign is in the lowest bit and written 5 bits a character, lowest
+    first, with 0x20 set on all but a value's last character.
+    """
+    values = np.empty(2 * len(lat_ints), dtype=np.int64)
+    values[0::2] = np.diff(lat_ints, prepend=0)
+    values[1::2] = np.diff(lon_ints, prepend=0)
+    zigzag = np.where(values < 0, ~(values << 1), values << 1).astype(
+        np.uint64)
+
+    shifts = np.arange(13, dtype=np.uint64) * np.uint64(5)
+    remaining = zigzag[:, None] >> shifts
+    chunks = (remaining & np.uint64(31)).astype(np.uint8)
+    more = np.zeros_like(remaining, dtype=bool)
+    more[:, :-1] = remaining[:, 1:] > 0
+    # Every value has at least one character, even when it's 0
+    used = (remaining > 0) | (shifts == 0)
+    characters = chunks + more * np.uint8(polyline_continue) + np.uint8(
+        polyline_offset)
+    return characters[used].tobytes().decode("ascii")
+
+
+def decode_polyline(polyline):
+    """Decodes an encoded polyline into fixed-point latitudes & longitudes"""
+    data = np.frombuffer(polyline.encode("ascii"), dtype=np.uint8).astype(
+        np.int64) - polyline_offset
+    if not len(data):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    last = (data & polyline_continue) == 0
+    starts = np.flatnonzero(np.concatenate([[True], last[:-1]]))
+    value_index = np.cumsum(np.concatenate([[0], last[:-1]]))
+    shifts = 5 * (np.arange(len(data)) - starts[value_index])
+    zigzag = np.add.reduceat((data & 31) << shifts, starts)
+    values = (zigzag >> 1) ^ -(zigzag & 1)
+    return np.cumsum(values[0::2]), np.cumsum(values[1::2])
@@ -0,0 +1,72 @@
+# ----------------------------------------------------------
+# Utils for pooled HTTP sessions shared across a worker process
+# Sessions are created once and kept alive between invocations so
+# Maps and Storage calls reuse their TLS connections
+# ----------------------------------------------------------
+
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+import threading
+import requests
+import socket
+import os
+
+
+# Get environment variables
+# Local dev: found in local.settings.json, Azure: Function App Settings
+http_pool_size = int(os.environ.get("HTTP_POOL_SIZE", 16))
+http_timeout = float(os.environ.get("HTTP_TIMEOUT", 30))
+http_keepalive_idle = int(os.environ.get("HTTP_KEEPALIVE_IDLE", 60))
+http_tcp_keepalive = (
+    os.environ.get("HTTP_TCP_KEEPALIVE", "true").lower() == "true")
+
+sessions_lock = threading.Lock()
+sessions = {}
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTP adapter enabling TCP keep-alive probes on pooled sockets"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        if http_tcp_keepalive:
+            kwargs["socket_options"] = get_keepalive_socket_options()
+        super().init_poolmanager(*args, **kwargs)
+
+
+def get_keepalive_socket_options():
+    """Socket options keeping idle pooled connections open"""
+    options = list(HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    # Idle time before probing is only tunable on some platforms
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                        http_keepalive_idle))
+    return options
+
+
+def create_session(pool_size=None):
+    """Creates a requests session with a connection pool of pool_size"""
+    pool_size = pool_size or http_pool_size
+    session = requests.Session()
+    adapter = KeepAliveAdapter(pool_connections=pool_size,
+                               pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(name):
+    """Gets the named shared session, creating it on first use"""
+    with sessions_lock:
+        if name not in sessions:
+            sessions[name] = create_session()
+        return sessions[name]
+
+
+def close_sessions():
+    """Closes and forgets all shared sessions"""
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
@@ -5,22 +5,44 @@
 # ----------------------------------------------------------
 
 
-from shapely.geometry import Point
-from shapely import wkt
-from azure.identity import ManagedIdentityCredential
-from azure.keyvault.secrets import SecretClient
+from shapely.geometry import box
+from shapely import wkt, wkb
+from __app__.SharedCode import (
+    secretutils, fetchutils, httputils, metricsutils)
 import numpy as np
 import logging
 import requests
+import time
 import os
+import re
 import math
+import functools
+import collections
+import threading
+
+try:
+    # Shapely >= 2.0 exposes vectorized predicates at the top level
+    from shapely import contains_xy, prepare
+
+    def prepare_geometry(geometry):
+        """Prepares geometry in place for repeated predicate tests"""
+        prepare(geometry)
+        return geometry
+except ImportError:
+    from shapely.prepared import prep as prepare_geometry
+    from shapely.vectorized import contains as contains_xy
 
 
 # Get environment variables
 # Local dev: found in local.settings.json, Azure: Function App Settings
-key_vault_uri = os.environ["KEY_VAULT"]
 maps_endpoint = os.environ["AZURE_MAPS_ENDPOINT"]
 num_of_routes_to_calc = os.environ["NUM_OF_ROUTES_PER_CITY"]
+sampling_method = os.environ.get("SAMPLING_METHOD", "rejection")
+random_seed = os.environ.get("RANDOM_SEED")
+pairing_method = os.environ.get("OD_PAIRING", "sequential")
+distance_bands = int(os.environ.get("OD_DISTANCE_BANDS", 4))
+batch_poll_interval = float(os.environ.get("MAPS_BATCH_POLL_INTERVAL", 2))
+batch_timeout = float(os.environ.get("MAPS_BATCH_TIMEOUT", 600))
 
 # Constants for map tile download methods
 earth_radius = 6378137
@@ -30,46 +52,449 @@ min_longitude = -180
 max_longitude = 180
 tile_size = 256
 
+# Name of the Key Vault secret holding the Azure Maps key
+maps_key_secret_name = "mapskey"
+
+# Bounds on the number of candidates drawn per rejection sampling block
+min_sample_block = 64
+max_sample_block = 65536
+
+# Origin to destination distances sampled to find the distance band edges
+band_edge_samples = 100000
+
+# Free destinations drawn for each origin by banded pairing
+band_candidates = 64
+
+# Zoom level of the tile cells that stratified sampling spreads points over
+strata_zoom = 13
+
+# Most candidates drawn per point in a round of stratified sampling
+max_stratum_tries = 64
+
+# Prime bases of the 2D Halton sequence
+halton_bases = (2, 3)
+
+# Kilometres per degree of latitude
+km_per_degree = 111.32
+
+# Tile masks are kept for the whole tile cover of this many city polygons
+max_mask_polygons = 64
+tile_masks_lock = threading.Lock()
+tile_masks = collections.OrderedDict()
+
 
 def get_maps_subscription_key():
-    """Retrieves Azure Maps key secret from Key Vault"""
-    credential = ManagedIdentityCredential()
-    client = SecretClient(vault_url=key_vault_uri, credential=credential)
-    try:
-        maps_key = client.get_secret("mapskey").value
-        return maps_key
-    except Exception as ex:
-        message = "Could not get Key Vault secret"
-        logging.error(message, exc_info=ex)
-        raise Exception(message, ex)
+    """Retrieves Azure Maps key secret from the Key Vault secret cache"""
+    return secretutils.get_secret(maps_key_secret_name)
 
 
 def create_polygon_from_string(string_to_convert):
     return wkt.loads(f"POLYGON(({string_to_convert}))")
 
 
-def get_random_coords(city_polygon):
-    """Generates configured no of random coordinates within city polygon"""
-    # Get number to calculate from environment config
-    num_points_to_calc = int(num_of_routes_to_calc) * 2
+@functools.lru_cache(maxsize=256)
+def get_city_polygon(string_to_convert):
+    """Gets the polygon for a city's polygon string, parsed once per worker"""
+    return create_polygon_from_string(string_to_convert)
+
 
-    min_lat, min_long, max_lat, max_long = city_polygon.bounds
+PolygonMetrics = collections.namedtuple(
+    "PolygonMetrics", ["prepared", "bounds", "area_ratio"])
 
-    random_coordinates_list = []
 
-    while len(random_coordinates_list) < num_points_to_calc:
-        # Generate a random coordinate within polygon
-        random_coordinate = Point([
-            np.random.uniform(min_lat, max_lat),
-            np.random.uniform(min_long, max_long)
-        ])
-        # If the generated coordinate is within the polygon, add it to the list
-        if (random_coordinate.within(city_polygon)):
-            random_coordinates_list.append(
-                [random_coordinate.x, random_coordinate.y]
-            )
+@functools.lru_cache(maxsize=256)
+def get_polygon_metrics(polygon_wkb):
+    """Gets the prepared geometry, bounds & polygon to bbox area ratio"""
+    polygon = wkb.loads(polygon_wkb)
+    min_x, min_y, max_x, max_y = polygon.bounds
+    bbox_area = (max_x - min_x) * (max_y - min_y)
+    area_ratio = polygon.area / bbox_area if bbox_area else 0
 
-    return random_coordinates_list
+    return PolygonMetrics(prepare_geometry(polygon), polygon.bounds,
+                          area_ratio)
+
+
+def get_random_coords(city_polygon, num_points=None, method=None, seed=None):
+    """Generates configured no of random coordinates within city polygon"""
+    # Get number to calculate from environment config
+    if num_points is None:
+        num_points = int(num_of_routes_to_calc) * 2
+    method = method or sampling_method
+    rng = get_rng(random_seed if seed is None else seed)
+
+    metricsutils.count("sampled_points", num_points)
+    with metricsutils.timer("sampling"):
+        return sample_points(city_polygon, num_points, method, rng)
+
+
+def sample_points(city_polygon, num_points, method, rng):
+    """Samples points in the polygon with the named method, as a list"""
+    samplers = {
+        "triangulation": sample_points_triangulated,
+        "stratified": sample_points_stratified,
+        "halton": sample_points_halton,
+    }
+    if method in samplers:
+        try:
+            return samplers[method](city_polygon, num_points, rng).tolist()
+        except ValueError as ex:
+            logging.warning(f"{method.capitalize()} sampling unavailable "
+                            f"({ex}), falling back to rejection sampling")
+    elif method != "rejection":
+        raise ValueError(f"Unknown sampling method '{method}'")
+
+    return sample_points_rejection(city_polygon, num_points, rng).tolist()
+
+
+def get_rng(seed=None):
+    """Creates a NumPy random generator, seeded for reproducible runs"""
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(None if seed is None else int(seed))
+
+
+def sample_points_rejection(polygon, num_points, rng):
+    """Rejection samples points in polygon, testing candidates in blocks"""
+    prepared, bounds, area_ratio = get_polygon_metrics(polygon.wkb)
+    min_x, min_y, max_x, max_y = bounds
+    # Area ratio is the expected fraction of candidates accepted, and is
+    # used to size each block
+    if area_ratio <= 0:
+        raise ValueError("Cannot sample points in a polygon with no area")
+
+    points = np.empty((num_points, 2))
+    found = 0
+
+    while found < num_points:
+        remaining = num_points - found
+        block = int(math.ceil(remaining / area_ratio * 1.1))
+        block = int(clip(block, min_sample_block, max_sample_block))
+
+        xs = rng.uniform(min_x, max_x, block)
+        ys = rng.uniform(min_y, max_y, block)
+        inside = contains_xy(prepared, xs, ys)
+        metricsutils.count("rejected_samples", block - inside.sum())
+
+        accepted = np.column_stack((xs[inside], ys[inside]))[:remaining]
+        points[found:found + len(accepted)] = accepted
+        found += len(accepted)
+
+    return points
+
+
+def sample_points_triangulated(polygon, num_points, rng):
+    """Samples points in polygon exactly from an area weighted triangulation"""
+    triangles, areas = triangulate_polygon(polygon.wkb)
+
+    chosen = rng.choice(len(triangles), size=num_points, p=areas / areas.sum())
+    a, b, c = (triangles[chosen, i] for i in range(3))
+
+    # Uniform barycentric draws, reflecting points from the far half
+    u = rng.random((num_points, 1))
+    v = rng.random((num_points, 1))
+    flip = (u + v) > 1
+    u = np.where(flip, 1 - u, u)
+    v = np.where(flip, 1 - v, v)
+
+    return a + u * (b - a) + v * (c - a)
+
+
+def sample_points_stratified(polygon, num_points, rng):
+    """Samples points in polygon stratified over the zoom 13 tile cells.
+
+    Points are allocated to the cells systematically in proportion to the
+    area of the polygon in each, so every part of the city is covered in
+    its share rather than by chance, then drawn uniformly in their cell.
+    """
+    bounds, areas = get_tile_strata(polygon.wkb, strata_zoom)
+    if not len(areas):
+        raise ValueError("Polygon has no area in any tile cell")
+    prepared = get_polygon_metrics(polygon.wkb).prepared
+
+    # Systematic allocation: one random offset, then evenly spaced picks
+    # along the cells' cumulative area
+    cumulative = np.cumsum(areas) / areas.sum() * num_points
+    strata = np.searchsorted(cumulative, rng.random() + np.arange(num_points),
+                             side="right")
+    strata = np.minimum(strata, len(areas) - 1)
+    fill = areas / ((bounds[:, 2] - bounds[:, 0])
+                    * (bounds[:, 3] - bounds[:, 1]))
+
+    points = np.empty((num_points, 2))
+    remaining = np.arange(num_points)
+    while remaining.size:
+        # Enough candidates per point that most find a hit this round,
+        # even in cells the polygon only clips the corner of
+        tries = int(clip(math.ceil(1.5 / fill[strata[remaining]].min()),
+                         1, max_stratum_tries))
+        cell = bounds[np.repeat(strata[remaining], tries)]
+        xs = rng.uniform(cell[:, 0], cell[:, 2])
+        ys = rng.uniform(cell[:, 1], cell[:, 3])
+        inside = contains_xy(prepared, xs, ys).reshape(-1, tries)
+        metricsutils.count("rejected_samples", inside.size - inside.sum())
+
+        hit = inside.any(axis=1)
+        chosen = np.flatnonzero(hit) * tries + inside.argmax(axis=1)[hit]
+        points[remaining[hit]] = np.column_stack((xs[chosen], ys[chosen]))
+        remaining = remaining[~hit]
+
+    # Points come out grouped by cell, so shuffle before they're paired
+    return rng.permutation(points)
+
+
+@functools.lru_cache(maxsize=64)
+def get_tile_strata(polygon_wkb, zoom):
+    """Gets the covering tile cells' bounds and the polygon's area in each"""
+    polygon = wkb.loads(polygon_wkb)
+    if not polygon.is_valid:
+        polygon = polygon.buffer(0)
+
+    bounds = np.array([tile_XY_to_bounds(tileX, tileY, zoom, tile_size)
+                       for tileX, tileY in
+                       compute_tilecover(polygon_wkb, zoom, 0)]).reshape(-1, 4)
+    areas = np.array([polygon.intersection(box(*cell)).area
+                      for cell in bounds])
+    keep = areas > 0
+
+    return bounds[keep], areas[keep]
+
+
+def sample_points_halton(polygon, num_points, rng):
+    """Samples points in polygon from a randomly shifted Halton sequence.
+
+    The low-discrepancy sequence fills the bounding box more evenly than
+    independent draws; points outside the polygon are skipped.
+    """
+    prepared, bounds, area_ratio = get_polygon_metrics(polygon.wkb)
+    min_x, min_y, max_x, max_y = bounds
+    if area_ratio <= 0:
+        raise ValueError("Cannot sample points in a polygon with no area")
+
+    # A random shift (Cranley-Patterson rotation) keeps each run's
+    # estimate unbiased while preserving the sequence's even spread
+    shift = rng.random(2)
+    points = np.empty((num_points, 2))
+    found = 0
+    index = 1
+
+    while found < num_points:
+        remaining = num_points - found
+        block = int(math.ceil(remaining / area_ratio * 1.1))
+        block = int(clip(block, min_sample_block, max_sample_block))
+
+        indices = np.arange(index, index + block)
+        index += block
+        u = (radical_inverse(indices, halton_bases[0]) + shift[0]) % 1
+        v = (radical_inverse(indices, halton_bases[1]) + shift[1]) % 1
+        xs = min_x + u * (max_x - min_x)
+        ys = min_y + v * (max_y - min_y)
+        inside = contains_xy(prepared, xs, ys)
+        metricsutils.count("rejected_samples", block - inside.sum())
+
+        accepted = np.column_stack((xs[inside], ys[inside]))[:remaining]
+        points[found:found + len(accepted)] = accepted
+        found += len(accepted)
+
+    # Consecutive Halton points are deliberately far apart, so shuffle
+    # before pairing to avoid biasing route lengths
+    return rng.permutation(points)
+
+
+def radical_inverse(indices, base):
+    """Gets the van der Corput radical inverses of integer indices"""
+    indices = np.array(indices, dtype=np.int64)
+    result = np.zeros(indices.shape)
+    factor = 1 / base
+    while indices.any():
+        result += factor * (indices % base)
+        indices //= base
+        factor /= base
+    return result
+
+
+def pair_coords(coords, method=None, num_bands=None, seed=None):
+    """Pairs a list of coordinates into (origin, destination) routes.
+
+    'sequential' pairs alternate coordinates. 'banded' pairs each origin
+    with a destination so that the routes are spread evenly over
+    `num_bands` distance bands (quantiles of all candidate distances),
+    which stratifies the routes by length.
+    """
+    method = method or pairing_method
+    if method == "sequential":
+        return list(zip(coords[0::2], coords[1::2]))
+    if method != "banded":
+        raise ValueError(f"Unknown OD pairing method '{method}'")
+
+    rng = get_rng(random_seed if seed is None else seed)
+    points = np.asarray(coords, dtype=np.float64)
+    num_routes = len(points) // 2
+    origins, destinations = points[:num_routes], points[num_routes:]
+    destinations = destinations[:num_routes]
+    order = pair_by_distance_band(
+        origins, destinations, num_bands or distance_bands, rng)
+
+    return [(list(origin), list(destination)) for origin, destination in
+            zip(origins.tolist(), destinations[order].tolist())]
+
+
+def pair_by_distance_band(origins, destinations, num_bands, rng):
+    """Assigns each origin a destination index, balancing distance bands.
+
+    Band edges are quantiles of a sample of origin to destination
+    distances. Each origin in turn draws `band_candidates` of the
+    destinations still free and takes one in its target band. Only if
+    none of them are in it are all free destinations searched (taking
+    the closest length if the band is used up), so the full distance
+    matrix is never built.
+    """
+    num_routes = len(origins)
+    if num_routes == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if num_routes ** 2 <= band_edge_samples:
+        distances = get_distances_km(origins[:, None], destinations[None, :])
+    else:
+        distances = get_distances_km(
+            origins[rng.integers(0, num_routes, band_edge_samples)],
+            destinations[rng.integers(0, num_routes, band_edge_samples)])
+    edges = np.quantile(distances, np.linspace(0, 1, num_bands + 1))
+    edges[0], edges[-1] = -np.inf, np.inf
+    centres = np.quantile(distances,
+                          (np.arange(num_bands) + 0.5) / num_bands)
+
+    # Even spread of target bands, in random order over the origins
+    targets = rng.permutation(np.arange(num_routes) * num_bands // num_routes)
+    # Free destinations are kept at the front, removed by swapping
+    free = np.arange(num_routes)
+    order = np.empty(num_routes, dtype=np.int64)
+    for remaining, i in zip(range(num_routes, 0, -1),
+                            rng.permutation(num_routes)):
+        band = targets[i]
+        position = find_in_band(
+            origins[i], destinations, free, rng.integers(
+                0, remaining, min(remaining, band_candidates)),
+            edges[band], edges[band + 1])
+        if position is None:
+            # None of the draw is in the band, so look through all of them
+            position = find_in_band(
+                origins[i], destinations, free, rng.permutation(remaining),
+                edges[band], edges[band + 1], centres[band])
+        order[i] = free[position]
+        free[position] = free[remaining - 1]
+
+    return order
+
+
+def find_in_band(origin, destinations, free, positions, low, high,
+                 centre=None):
+    """Finds a free destination whose route is in a distance band.
+
+    `positions` index into `free`. With a `centre` the route closest to
+    it is taken if none are in the band, otherwise None is returned.
+    """
+    distances = get_distances_km(origin, destinations[free[positions]])
+    in_band = np.flatnonzero((distances >= low) & (distances < high))
+    if in_band.size:
+        # Positions are in random order, so the first is as good as any
+        return positions[in_band[0]]
+    if centre is None:
+        return None
+    return positions[np.argmin(np.abs(distances - centre))]
+
+
+def get_distances_km(a, b):
+    """Gets approximate (equirectangular) distances between lat/long arrays"""
+    a, b = np.asarray(a), np.asarray(b)
+    mean_latitude = np.radians((a[..., 0] + b[..., 0]) / 2)
+    return km_per_degree * np.hypot(
+        b[..., 0] - a[..., 0],
+        (b[..., 1] - a[..., 1]) * np.cos(mean_latitude))
+
+
+@functools.lru_cache(maxsize=64)
+def triangulate_polygon(polygon_wkb):
+    """Ear clips a polygon (by WKB) into triangles and their areas"""
+    geometry = wkb.loads(polygon_wkb)
+    if not geometry.is_valid:
+        # Self-intersecting rings are split into valid simple parts
+        geometry = geometry.buffer(0)
+
+    parts = getattr(geometry, "geoms", [geometry])
+    triangles = []
+    for part in parts:
+        if list(part.interiors):
+            raise ValueError("polygons with holes cannot be ear clipped")
+        triangles.extend(ear_clip(np.asarray(part.exterior.coords)[:-1]))
+
+    if not triangles:
+        raise ValueError("polygon could not be triangulated")
+
+    triangles = np.asarray(triangles)
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    areas = np.abs(cross_2d(b - a, c - a)) / 2
+
+    return triangles, areas
+
+
+def ear_clip(ring):
+    """Triangulates a simple polygon ring (without closing vertex)"""
+    # Work counter-clockwise so convex vertices have positive cross products
+    signed_area = np.sum(cross_2d(ring, np.roll(ring, -1, axis=0)))
+    if signed_area < 0:
+        ring = ring[::-1]
+
+    remaining = list(range(len(ring)))
+    triangles = []
+
+    while len(remaining) > 3:
+        count = len(remaining)
+        for i in range(count):
+            prev_idx = remaining[i - 1]
+            idx = remaining[i]
+            next_idx = remaining[(i + 1) % count]
+            a, b, c = ring[prev_idx], ring[idx], ring[next_idx]
+
+            turn = cross_2d(b - a, c - b)
+            if turn == 0:
+                # Collinear vertex adds no area, drop it from the ring
+                del remaining[i]
+                break
+            if turn < 0:
+                # Reflex vertex can't be an ear
+                continue
+
+            others = ring[[j for j in remaining
+                           if j not in (prev_idx, idx, next_idx)]]
+            # Ignore repeated vertices sitting on the candidate's corners
+            others = others[~((others == a).all(axis=1)
+                              | (others == b).all(axis=1)
+                              | (others == c).all(axis=1))]
+            if points_in_triangle(others, a, b, c).any():
+                continue
+
+            triangles.append((a, b, c))
+            del remaining[i]
+            break
+        else:
+            raise ValueError("no ear found, ring is not simple")
+
+    triangles.append(tuple(ring[remaining]))
+    return triangles
+
+
+def points_in_triangle(points, a, b, c):
+    """Tests which points lie inside or on counter-clockwise triangle abc"""
+    return ((cross_2d(b - a, points - a) >= 0)
+            & (cross_2d(c - b, points - b) >= 0)
+            & (cross_2d(a - c, points - c) >= 0))
+
+
+def cross_2d(u, v):
+    """Z component of the cross product of 2D vectors (or arrays of them)"""
+    u = np.asarray(u)
+    v = np.asarray(v)
+    return u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
 
 
 def construct_routes_query(origin, destination):
@@ -97,14 +522,148 @@ def construct_tiles_query(zoom, tileX, tileY):
     return query
 
 
+def construct_routes_batch_item(origin, destination):
+    """Create a batch item query for a route between the coordinates"""
+    return (f"?query={str(origin[0])},{str(origin[1])}:"
+            f"{str(destination[0])},{str(destination[1])}"
+            "&traffic=true&computeTravelTimeFor=all")
+
+
+def construct_routes_batch_query():
+    """Create a maps query to submit a Route Directions batch"""
+    return (maps_endpoint
+            + "route/directions/batch/json?api-version=1.0&subscription-key="
+            + get_maps_subscription_key())
+
+
 def query_maps(query):
     """Calls Azure Maps with defined query and returns payload"""
-    try:
-        response = requests.get(query)
-        response.raise_for_status()
+    response = request_maps(query)
+    if response is not None:
         return response.content
-    except requests.exceptions.HTTPError as e:
-        logging.error(f"HTTP error calling Maps: {e}")
+
+
+def open_maps_stream(query):
+    """Calls Azure Maps with defined query, leaving the payload unread.
+
+    The caller reads the body with `iter_content` and closes the response.
+    Returns None if the request failed.
+    """
+    return request_maps(query, stream=True)
+
+
+def query_maps_batch(batch_items):
+    """Submits a Route Directions batch and polls until its results are in.
+
+    Returns the list of batch item results, each holding a `statusCode` and
+    the `response` Maps gave for that item, in the order submitted.
+    """
+    response = request_maps(construct_routes_batch_query(),
+                            body={"batchItems": [{"query": item}
+                                                 for item in batch_items]})
+    deadline = time.monotonic() + batch_timeout
+
+    # Async batches are accepted with a Location to poll for the results
+    while response is not None and response.status_code == 202:
+        if time.monotonic() > deadline:
+            logging.error("Timed out waiting for Maps batch results")
+            return None
+        time.sleep(fetchutils.retry_after_seconds(response)
+                   or batch_poll_interval)
+        location = response.headers["Location"]
+        separator = "&" if "?" in location else "?"
+        response = request_maps(f"{location}{separator}subscription-key="
+                                + get_maps_subscription_key())
+
+    if response is None:
+        return None
+    return response.json()["batchItems"]
+
+
+def request_maps(query, body=None, stream=False):
+    """Sends a GET (or POST if body is given) to Azure Maps.
+
+    Throttled (429), server error and connection failures are retried with
+    jittered backoff, honouring any Retry-After header sent by Maps.
+    Returns the response, or None if the request failed.
+    """
+    session = httputils.get_session("maps")
+    key_refreshed = False
+    attempt = 0
+    while True:
+        with metricsutils.timer("maps_rate_limit"):
+            fetchutils.maps_rate_limiter.acquire()
+        metricsutils.count("maps_calls")
+        try:
+            with metricsutils.timer("maps_http"):
+                if body is None:
+                    response = session.get(
+                        query, timeout=httputils.http_timeout, stream=stream)
+                else:
+                    response = session.post(
+                        query, json=body, timeout=httputils.http_timeout)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            if attempt >= fetchutils.max_retries:
+                logging.error(f"Could not connect to Maps: {e}")
+                return None
+            metricsutils.count("maps_retries")
+            time.sleep(fetchutils.backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        status = response.status_code
+        if status in (401, 403) and not key_refreshed:
+            # Unread streamed responses hold their pooled connection
+            response.close()
+            # The Maps key may have been rotated, refresh it and retry once
+            logging.warning(f"Maps returned {status}, "
+                            "refreshing subscription key")
+            secretutils.invalidate_secret(
+                maps_key_secret_name, get_subscription_key(query))
+            query = replace_subscription_key(
+                query, get_maps_subscription_key())
+            key_refreshed = True
+            continue
+
+        if (status == 429 or status >= 500) and \
+                attempt < fetchutils.max_retries:
+            delay = fetchutils.retry_after_seconds(response)
+            if delay is None:
+                delay = fetchutils.backoff_delay(attempt)
+            if status == 429:
+                # Slow down every thread sharing the quota, not just this one
+                fetchutils.maps_rate_limiter.pause(delay)
+                metricsutils.count("maps_throttled")
+            metricsutils.count("maps_retries")
+            logging.warning(f"Maps returned {status}, retrying in "
+                            f"{delay:.2f}s (attempt {attempt + 1})")
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+            continue
+
+        try:
+            response.raise_for_status()
+            if not stream:
+                metricsutils.count("maps_bytes", len(response.content))
+            return response
+        except requests.exceptions.HTTPError as e:
+            logging.error(f"HTTP error calling Maps: {e}")
+            response.close()
+            return None
+
+
+def get_subscription_key(query):
+    """Gets the subscription key a constructed Maps query was sent with"""
+    match = re.search(r"subscription-key=([^&]*)", query)
+    return match.group(1) if match else None
+
+
+def replace_subscription_key(query, subscription_key):
+    """Swaps the subscription key in a constructed Maps query"""
+    return re.sub(r"subscription-key=[^&]*",
+                  lambda _: f"subscription-key={subscription_key}", query)
 
 
 def get_tilegrid(polygon, zoom):
@@ -120,23 +679,158 @@ def get_tilegrid(polygon, zoom):
     return top_tile, bottom_tile, left_tile, right_tile
 
 
-def position_to_tile_XY(position, zoom, tile_size):
-    """Calculates XY tile coords that a coordinate falls in for zoom level."""
-    latitude = clip(position[1], min_latitude, max_latitude)
-    longitude = clip(position[0], min_longitude, max_longitude)
+def get_tilecover(polygon, zoom, buffer=0):
+    """Gets XY of the tiles at zoom level that intersect the polygon.
+
+    The polygon can be grown by `buffer` (in degrees) before the tiles are
+    tested. Results are memoized per polygon, zoom and buffer, so repeated
+    runs in the same worker only pay for this once.
+    """
+    return list(compute_tilecover(polygon.wkb, zoom, buffer))
+
+
+@functools.lru_cache(maxsize=256)
+def compute_tilecover(polygon_wkb, zoom, buffer):
+    """Tests each tile in the polygon's bounding grid against the polygon"""
+    polygon = wkb.loads(polygon_wkb)
+    if buffer or not polygon.is_valid:
+        polygon = polygon.buffer(buffer)
+    prepared = prepare_geometry(polygon)
+
+    top, bottom, left, right = get_tilegrid(polygon, zoom)
+    tiles = []
+    for tileX in range(left, right + 1):
+        for tileY in range(top, bottom + 1):
+            tile_box = box(*tile_XY_to_bounds(tileX, tileY, zoom, tile_size))
+            if prepared.intersects(tile_box):
+                tiles.append((tileX, tileY))
+
+    return tuple(tiles)
+
+
+def tile_XY_to_bounds(tileX, tileY, zoom, tile_size):
+    """Gets (min lat, min long, max lat, max long) bounds of a tile"""
+    left, top = global_pixel_to_position(
+        (tileX * tile_size, tileY * tile_size), zoom, tile_size)
+    right, bottom = global_pixel_to_position(
+        ((tileX + 1) * tile_size, (tileY + 1) * tile_size), zoom, tile_size)
+
+    return bottom, left, top, right
+
+
+def tile_XY_to_parent(tileX, tileY):
+    """Gets the tile one zoom level out that contains a tile.
+
+    Returns the parent's XY and the (column, row) of the quadrant the
+    tile covers in it, as each tile splits into 2 x 2 at the next level.
+    """
+    return (tileX // 2, tileY // 2), (tileX % 2, tileY % 2)
+
+
+def global_pixel_to_position(pixel, zoom, tile_size):
+    """Converts pixel XY coordinates into long/lat coordinates (in degrees)"""
+    map_size = get_map_size(zoom, tile_size)
 
     # Adapted to Python from
     # https://docs.microsoft.com/en-gb/azure/azure-maps/zoom-levels-and-tile-grid
-    x = (longitude + 180) / 360
-    sin_latitude = math.sin(latitude * math.pi / 180)
-    y = 0.5 - math.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * math.pi)
+    x = (clip(pixel[0], 0, map_size) / map_size) - 0.5
+    y = 0.5 - (clip(pixel[1], 0, map_size) / map_size)
 
-    map_size = get_map_size(zoom, tile_size)
+    longitude = 360 * x
+    latitude = 90 - 360 * math.atan(math.exp(-y * 2 * math.pi)) / math.pi
 
-    return (
-        math.floor(clip(x * map_size + 0.5, 0, map_size - 1) / tile_size),
-        math.floor(clip(y * map_size + 0.5, 0, map_size - 1) / tile_size)
-    )
+    return longitude, latitude
+
+
+def global_pixels_to_positions(pixel_x, pixel_y, zoom, tile_size):
+    """Converts arrays of pixel XY coordinates into long/lat (in degrees)"""
+    map_size = get_map_sizes(zoom, tile_size)
+
+    x = (np.clip(np.asarray(pixel_x, dtype=np.float64), 0, map_size)
+         / map_size) - 0.5
+    y = 0.5 - (np.clip(np.asarray(pixel_y, dtype=np.float64), 0, map_size)
+               / map_size)
+
+    longitude = 360 * x
+    latitude = 90 - 360 * np.arctan(np.exp(-y * 2 * math.pi)) / math.pi
+
+    return longitude, latitude
+
+
+def get_tile_mask(polygon, tileX, tileY, zoom):
+    """Gets a tile_size x tile_size bool mask of pixels inside the polygon.
+
+    Pixels are tested at their centres. Masks are cached per polygon, for
+    every tile it covers, so only the first run in a worker pays for
+    rasterizing them however many cities the worker handles.
+    """
+    packed = get_packed_tile_mask(polygon.wkb, tileX, tileY, zoom)
+    if packed is None:
+        return np.ones((tile_size, tile_size), dtype=bool)
+    mask = np.unpackbits(packed, count=tile_size * tile_size)
+    return mask.astype(bool).reshape(tile_size, tile_size)
+
+
+def get_packed_tile_mask(polygon_wkb, tileX, tileY, zoom):
+    """Gets a tile's packed mask from the polygon's cache, or computes it"""
+    key = (tileX, tileY, zoom)
+    with tile_masks_lock:
+        masks = tile_masks.get(polygon_wkb)
+        if masks is None:
+            masks = tile_masks[polygon_wkb] = {}
+            if len(tile_masks) > max_mask_polygons:
+                tile_masks.popitem(last=False)
+        else:
+            tile_masks.move_to_end(polygon_wkb)
+        if key in masks:
+            return masks[key]
+
+    packed = compute_tile_mask(polygon_wkb, tileX, tileY, zoom)
+    with tile_masks_lock:
+        masks[key] = packed
+    return packed
+
+
+def compute_tile_mask(polygon_wkb, tileX, tileY, zoom):
+    """Rasterizes the polygon over a tile, as bits to keep the cache small.
+
+    Tiles wholly inside the polygon give None rather than a mask, so the
+    cache only holds masks for the tiles on the city's edge.
+    """
+    polygon = wkb.loads(polygon_wkb)
+    if not polygon.is_valid:
+        polygon = polygon.buffer(0)
+
+    tile_box = box(*tile_XY_to_bounds(tileX, tileY, zoom, tile_size))
+    if polygon.contains(tile_box):
+        return None
+
+    offsets = np.arange(tile_size) + 0.5
+    pixel_x, pixel_y = np.meshgrid(tileX * tile_size + offsets,
+                                   tileY * tile_size + offsets)
+    longitudes, latitudes = global_pixels_to_positions(
+        pixel_x, pixel_y, zoom, tile_size)
+    # Polygons are stored as lat/long, so x is latitude
+    mask = contains_xy(polygon, latitudes, longitudes)
+
+    packed = np.packbits(mask)
+    packed.flags.writeable = False
+    return packed
+
+
+def position_to_tile_XY(position, zoom, tile_size):
+    """Calculates XY tile coords that a coordinate falls in for zoom level."""
+    tileX, tileY = positions_to_tile_XY(position[0], position[1], zoom,
+                                        tile_size)
+    return int(tileX), int(tileY)
+
+
+def positions_to_tile_XY(longitudes, latitudes, zoom, tile_size):
+    """Calculates XY tile coords for arrays of long/lat at zoom level(s)"""
+    pixel_x, pixel_y = positions_to_global_pixels(longitudes, latitudes,
+                                                  zoom, tile_size)
+    return (np.floor(pixel_x / tile_size).astype(np.int64),
+            np.floor(pixel_y / tile_size).astype(np.int64))
 
 
 def clip(n, min_value, max_value):
@@ -149,19 +843,82 @@ def get_map_size(zoom, tile_size):
     return math.ceil(tile_size * math.pow(2, zoom))
 
 
+def get_map_sizes(zoom, tile_size):
+    """Get map sizes in pixels for a zoom level or array of zoom levels"""
+    return np.ceil(tile_size * np.power(2.0, zoom))
+
+
 def position_to_global_pixel(position, zoom, tile_size):
     """Converts lat/long coordinates (in degrees) into pixel XY coordinates"""
-    latitude = clip(position[1], min_latitude, max_latitude)
-    longitude = clip(position[0], min_longitude, max_longitude)
+    pixel_x, pixel_y = positions_to_global_pixels(position[0], position[1],
+                                                  zoom, tile_size)
+    return float(pixel_x), float(pixel_y)
+
+
+def positions_to_global_pixels(longitudes, latitudes, zoom, tile_size):
+    """Converts arrays of long/lat (in degrees) into pixel XY coordinates.
 
-    # Calculate the pixel XY coordinates of the tiles from geo coordinates
+    Zoom can be a single level or an array with a level for each position.
+    NumPy's sin & log can differ from the math module's by an ULP, so
+    pixels can differ from a scalar math projection by ~1e-9 at zoom 13.
+    """
+    latitude = np.clip(np.asarray(latitudes, dtype=np.float64),
+                       min_latitude, max_latitude)
+    longitude = np.clip(np.asarray(longitudes, dtype=np.float64),
+                        min_longitude, max_longitude)
+
+    # Adapted to Python from
+    # https://docs.microsoft.com/en-gb/azure/azure-maps/zoom-levels-and-tile-grid
     x = (longitude + 180) / 360
-    sin_latitude = math.sin(latitude * math.pi / 180)
-    y = 0.5 - math.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * math.pi)
+    sin_latitude = np.sin(latitude * math.pi / 180)
+    y = 0.5 - np.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * math.pi)
 
-    map_size = get_map_size(zoom, tile_size)
+    map_size = get_map_sizes(zoom, tile_size)
 
     return (
-        clip(x * map_size + 0.5, 0, map_size - 1),
-        clip(y * map_size + 0.5, 0, map_size - 1)
+        np.clip(x * map_size + 0.5, 0, map_size - 1),
+        np.clip(y * map_size + 0.5, 0, map_size - 1)
     )
+
+
+def tile_XY_to_quadkey(tileX, tileY, zoom):
+    """Gets the quadkey of a tile at zoom level"""
+    return str(tiles_XY_to_quadkeys(tileX, tileY, zoom)[0])
+
+
+def tiles_XY_to_quadkeys(tilesX, tilesY, zoom):
+    """Gets the quadkeys of arrays of tiles at zoom level(s)"""
+    tilesX, tilesY, zoom = np.broadcast_arrays(
+        np.atleast_1d(tilesX).astype(np.int64),
+        np.atleast_1d(tilesY).astype(np.int64),
+        np.atleast_1d(zoom).astype(np.int64))
+    max_zoom = int(zoom.max()) if zoom.size else 0
+    if max_zoom == 0:
+        return np.full(tilesX.shape, "", dtype="<U1")
+
+    # One column per quadkey digit, most significant level first. Levels
+    # past a tile's own zoom are null bytes, trimmed by the bytes dtype.
+    level = zoom[:, None] - 1 - np.arange(max_zoom)
+    bit = np.left_shift(1, np.maximum(level, 0))
+    digits = (((tilesX[:, None] & bit) != 0).astype(np.uint8)
+              + 2 * ((tilesY[:, None] & bit) != 0).astype(np.uint8)
+              + ord("0"))
+    digits[level < 0] = 0
+
+    quadkeys = np.ascontiguousarray(digits).view(f"S{max_zoom}")[:, 0]
+    return quadkeys.astype(str)
+
+
+Projection = collections.namedtuple(
+    "Projection", ["pixel_x", "pixel_y", "tile_x", "tile_y", "quadkeys"])
+
+
+def project_positions(longitudes, latitudes, zoom, tile_size):
+    """Projects arrays of long/lat to pixel XY, tile XY and tile quadkeys"""
+    pixel_x, pixel_y = positions_to_global_pixels(longitudes, latitudes,
+                                                  zoom, tile_size)
+    tile_x = np.floor(pixel_x / tile_size).astype(np.int64)
+    tile_y = np.floor(pixel_y / tile_size).astype(np.int64)
+    quadkeys = tiles_XY_to_quadkeys(tile_x, tile_y, zoom)
+
+    return Projection(pixel_x, pixel_y, tile_x, tile_y, quadkeys)
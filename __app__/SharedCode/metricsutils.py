@@ -0,0 +1,174 @@
+# ----------------------------------------------------------
+# Lightweight per-stage timers & counters for the functions
+# Hot paths record into process-wide totals; each invocation takes
+# deltas of them per city and logs one structured metrics record
+# ----------------------------------------------------------
+
+
+import collections
+import contextlib
+import threading
+import logging
+import json
+import time
+import sys
+import os
+
+
+# Get environment variables
+# Local dev: found in local.settings.json, Azure: Function App Settings
+profile_interval = float(os.environ.get("METRICS_PROFILE_INTERVAL", 0))
+
+# Number of the most sampled functions included in the metrics record
+profile_top = 20
+
+metrics_lock = threading.Lock()
+timers = collections.defaultdict(lambda: [0, 0.0])
+counters = collections.Counter()
+
+
+@contextlib.contextmanager
+def timer(stage):
+    """Times a block as a call of `stage`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def record(stage, seconds, calls=1):
+    """Adds time spent in `stage`, for work that isn't one block"""
+    with metrics_lock:
+        totals = timers[stage]
+        totals[0] += calls
+        totals[1] += seconds
+
+
+def count(name, value=1):
+    """Adds to a counter, e.g. of bytes, calls or retries"""
+    with metrics_lock:
+        counters[name] += value
+
+
+def snapshot():
+    """Gets a copy of the process-wide timers & counters"""
+    with metrics_lock:
+        return {"timers": {stage: tuple(totals)
+                           for stage, totals in timers.items()},
+                "counters": dict(counters)}
+
+
+def difference(after, before):
+    """Gets the timers & counters recorded between two snapshots"""
+    stages = {}
+    for stage, (calls, seconds) in after["timers"].items():
+        calls_before, seconds_before = before["timers"].get(stage, (0, 0.0))
+        if calls > calls_before:
+            stages[stage] = {"calls": calls - calls_before,
+                             "seconds": round(seconds - seconds_before, 6)}
+    counts = {name: value - before["counters"].get(name, 0)
+              for name, value in after["counters"].items()
+              if value != before["counters"].get(name, 0)}
+    return {"stages": stages, "counters": counts}
+
+
+def reset():
+    """Clears the process-wide timers & counters"""
+    with metrics_lock:
+        timers.clear()
+        counters.clear()
+
+
+class RunMetrics:
+    """Collects the metrics of one function invocation, per city.
+
+    Cities are measured by the change in the process-wide totals while
+    they run, so work from other invocations overlapping in the same
+    worker is included in their figures.
+    """
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.started = time.perf_counter()
+        self.start = snapshot()
+        self.cities = {}
+        self.profiler = None
+        if profile_interval > 0:
+            self.profiler = SamplingProfiler(profile_interval)
+            self.profiler.start()
+
+    @contextlib.contextmanager
+    def city(self, city_id):
+        """Measures the work done for a city in the block"""
+        before = snapshot()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            metrics = difference(snapshot(), before)
+            metrics["seconds"] = round(time.perf_counter() - started, 6)
+            self.cities[str(city_id)] = metrics
+
+    def create_record(self):
+        """Gets the invocation's metrics as a JSON serializable record"""
+        record = {"function": self.function_name,
+                  "seconds": round(time.perf_counter() - self.started, 6),
+                  "cities": self.cities}
+        record.update(difference(snapshot(), self.start))
+        if self.profiler:
+            self.profiler.stop()
+            record["profile"] = self.profiler.top(profile_top)
+        return record
+
+    def emit(self):
+        """Logs the invocation's metrics as a single structured record"""
+        record = self.create_record()
+        logging.info(f"Run metrics: {json.dumps(record)}",
+                     extra={"custom_dimensions": record})
+        return record
+
+
+class SamplingProfiler:
+    """Samples the stacks of all other threads every `interval` seconds.
+
+    Counts how often each function is on a stack, which is cheap enough
+    to leave on for a whole run when looking for where the time goes.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = 0
+        self.functions = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            self.samples += 1
+            # Each function counts once per sample, however many threads
+            # or levels of the stack it's on
+            functions = set()
+            for thread_id, frame in sys._current_frames().items():
+                while frame is not None and thread_id != own_id:
+                    code = frame.f_code
+                    functions.add(f"{code.co_name} ("
+                                  f"{os.path.basename(code.co_filename)}:"
+                                  f"{code.co_firstlineno})")
+                    frame = frame.f_back
+            self.functions.update(functions)
+
+    def top(self, limit):
+        """Gets the most sampled functions & the share of samples with them"""
+        return {"samples": self.samples,
+                "functions": [[name, round(hits / max(1, self.samples), 4)]
+                              for name, hits in
+                              self.functions.most_common(limit)]}
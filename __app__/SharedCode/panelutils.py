@@ -0,0 +1,119 @@
+# ----------------------------------------------------------
+# Persistent panel of origin/destination pairs per city
+# A panel is sampled once, stored next to the cities config and reused
+# each run, with a fraction of its pairs replaced every run
+# ----------------------------------------------------------
+
+
+from __app__.SharedCode import blobutils, maputils
+import numpy as np
+import hashlib
+import logging
+import io
+import os
+
+
+# Get environment variables
+# Local dev: found in local.settings.json, Azure: Function App Settings
+panel_rotation = float(os.environ.get("OD_PANEL_ROTATION", 0.1))
+
+# Hex digits of the polygon hash used to version panels
+polygon_hash_length = 16
+
+
+def get_od_panel(city_id, polygon, num_routes, rotation=None, seed=None,
+                 panel_size=None):
+    """Gets the city's panel of (origin, destination) routes for this run.
+
+    The panel is loaded from blob storage and `rotation` (a fraction) of
+    its pairs, the longest standing first, are replaced with fresh samples
+    before it's saved back. A new panel is sampled if none exists for the
+    city's current polygon or its size no longer matches `panel_size`
+    (by default `num_routes`). The run's routes are the panel's first
+    `num_routes` pairs, so a panel sized for the most routes a city can
+    be given is kept however many it gets each run.
+    """
+    rotation = panel_rotation if rotation is None else rotation
+    panel_size = max(panel_size or num_routes, num_routes)
+    seed = maputils.random_seed if seed is None else seed
+    panel_url = get_panel_url(city_id, get_polygon_hash(polygon))
+
+    data = blobutils.download_blob(panel_url)
+    panel = decode_panel(data) if data else None
+    if panel is None or len(panel["routes"]) != panel_size:
+        logging.info(f"Sampling a new OD panel for CityID {city_id}")
+        panel = {"routes": sample_routes(polygon, panel_size,
+                                         maputils.get_rng(seed)),
+                 "cursor": 0, "rotations": 0}
+        changed = True
+    else:
+        rng = get_rotation_rng(seed, panel["rotations"])
+        changed = rotate_panel(panel, polygon, rotation, rng) > 0
+
+    if changed:
+        blobutils.upload_blob(panel_url, encode_panel(panel))
+
+    return [(origin, destination)
+            for origin, destination in panel["routes"][:num_routes].tolist()]
+
+
+def rotate_panel(panel, polygon, rotation, rng):
+    """Replaces a fraction of the panel's pairs in place, oldest first"""
+    routes = panel["routes"]
+    count = min(int(round(rotation * len(routes))), len(routes))
+    if count <= 0:
+        return 0
+
+    replaced = (panel["cursor"] + np.arange(count)) % len(routes)
+    routes[replaced] = sample_routes(polygon, count, rng)
+    panel["cursor"] = int((panel["cursor"] + count) % len(routes))
+    panel["rotations"] = panel.get("rotations", 0) + 1
+    return count
+
+
+def get_rotation_rng(seed, rotations):
+    """Creates the random generator for a panel's next rotation.
+
+    A seeded generator is also keyed by the number of rotations so far,
+    otherwise every rotation would draw the same replacement pairs.
+    """
+    if seed is None:
+        return maputils.get_rng()
+    return np.random.default_rng([int(seed), rotations])
+
+
+def sample_routes(polygon, num_routes, rng):
+    """Samples routes with the configured sampler as an (N, 2, 2) array"""
+    coords = maputils.get_random_coords(polygon, num_routes * 2, seed=rng)
+    routes = maputils.pair_coords(coords, seed=rng)
+    return np.array(routes, dtype=np.float64).reshape(-1, 2, 2)
+
+
+def get_polygon_hash(polygon):
+    """Gets a short hash of a polygon's geometry, to version its panel"""
+    digest = hashlib.sha256(polygon.wkb).hexdigest()
+    return digest[:polygon_hash_length]
+
+
+def get_panel_url(city_id, polygon_hash):
+    """Gets the URL of a city's panel blob, next to the cities config"""
+    return blobutils.get_config_blob_url(
+        "panels", f"cityId={city_id}", f"od.{polygon_hash}.npz")
+
+
+def encode_panel(panel):
+    """Serializes a panel into .npz bytes"""
+    buffer = io.BytesIO()
+    np.savez(buffer, routes=panel["routes"], cursor=panel["cursor"],
+             rotations=panel.get("rotations", 0))
+    return buffer.getvalue()
+
+
+def decode_panel(data):
+    """Loads a panel from .npz bytes"""
+    with np.load(io.BytesIO(data)) as arrays:
+        # Panels saved before rotations were counted have none
+        rotations = (int(arrays["rotations"]) if "rotations" in arrays
+                     else 0)
+        return {"routes": arrays["routes"].copy(),
+                "cursor": int(arrays["cursor"]), "rotations": rotations}
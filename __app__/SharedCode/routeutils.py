@@ -0,0 +1,251 @@
+# ----------------------------------------------------------
+# Output sinks for the route directions returned by Azure Maps
+# Each sink receives every route fetched for a city run and writes it
+# to blob storage in its own layout
+# ----------------------------------------------------------
+
+
+from __app__.SharedCode import (
+    blobutils, fetchutils, metricsutils, spoolutils)
+from datetime import datetime, timezone
+import numpy as np
+import itertools
+import threading
+import logging
+import base64
+import json
+import gzip
+import zlib
+import time
+import io
+import os
+
+
+# Size of the blocks staged for streamed NDJSON route blobs
+ndjson_block_size = int(os.environ.get("ROUTES_NDJSON_BLOCK_SIZE",
+                                       4 * 1024 * 1024))
+
+
+# RouteDirectionSummary fields kept in the columnar route summaries
+summary_fields = [
+    "lengthInMeters",
+    "travelTimeInSeconds",
+    "trafficDelayInSeconds",
+    "noTrafficTravelTimeInSeconds",
+    "historicTrafficTravelTimeInSeconds",
+    "liveTrafficIncidentsTravelTimeInSeconds",
+]
+
+summary_dtype = np.dtype(
+    [("originLatitude", "f8"), ("originLongitude", "f8"),
+     ("destinationLatitude", "f8"), ("destinationLongitude", "f8"),
+     ("requestTime", "M8[s]"), ("departureTime", "M8[s]"),
+     ("arrivalTime", "M8[s]")]
+    + [(field, "i4") for field in summary_fields])
+
+
+class RouteFileSink:
+    """Uploads each route response as its own gzipped {n}.json.gz blob"""
+
+    streaming = False
+
+    def __init__(self, container_url, run_folder):
+        self.container_url = container_url
+        self.run_folder = run_folder
+        self.blob_numbers = itertools.count(1)
+
+    def add(self, origin, dest, request_time, file):
+        file_name = f"{self.run_folder}{next(self.blob_numbers)}.json.gz"
+        with metricsutils.timer("gzip"):
+            data = gzip.compress(file)
+        spoolutils.write_results(self.container_url, file_name, data)
+
+    def close(self):
+        pass
+
+
+class RouteSummarySink:
+    """Collects route summary fields into one columnar blob for the run.
+
+    The blob is a NumPy .npy structured array of `summary_dtype`, with a
+    row per route. Missing summary fields are stored as -1, and missing
+    times as NaT.
+    """
+
+    streaming = False
+
+    def __init__(self, container_url, run_folder):
+        self.container_url = container_url
+        self.run_folder = run_folder
+        self.rows = []
+        self.lock = threading.Lock()
+
+    def add(self, origin, dest, request_time, file):
+        try:
+            row = create_summary_row(origin, dest, request_time,
+                                     json.loads(file))
+        except (ValueError, KeyError, IndexError) as ex:
+            logging.error(f"Route summary could not be read: {ex}")
+            return
+        with self.lock:
+            self.rows.append(row)
+
+    def close(self):
+        if not self.rows:
+            return
+        summaries = np.array(self.rows, dtype=summary_dtype)
+        buffer = io.BytesIO()
+        np.save(buffer, summaries)
+        spoolutils.write_results(self.container_url,
+                                 f"{self.run_folder}summary.npy",
+                                 buffer.getvalue())
+
+
+class RouteNdjsonSink:
+    """Streams a run's routes into one gzipped newline-delimited JSON blob.
+
+    Each route is compressed as it is read into its own gzip member, and
+    members are appended to the run's routes.ndjson.gz block blob. Blocks
+    are staged once `ndjson_block_size` bytes are buffered and committed
+    in order on close, so memory stays bounded by the block size however
+    many routes the run has. A block that can't be staged is kept and
+    tried again on close.
+    """
+
+    streaming = True
+
+    def __init__(self, container_url, run_folder):
+        self.container_url = container_url
+        self.file_name = f"{run_folder}routes.ndjson.gz"
+        self.buffer = []
+        self.buffered = 0
+        self.buffered_routes = 0
+        self.blocks_cut = 0
+        self.staged = {}
+        self.unstaged = {}
+        self.lock = threading.Lock()
+
+    def add(self, origin, dest, request_time, file):
+        self.add_stream(origin, dest, request_time, [file])
+
+    def add_stream(self, origin, dest, request_time, chunks):
+        compressor = zlib.compressobj(wbits=31)
+        member = []
+        # Only compression is timed, not reading the chunks from Maps
+        compressing = 0.0
+        for chunk in chunks:
+            start = time.perf_counter()
+            # Raw newlines in JSON can only be whitespace, so are dropped
+            member.append(compressor.compress(chunk.translate(None, b"\r\n")))
+            compressing += time.perf_counter() - start
+        start = time.perf_counter()
+        member.append(compressor.compress(b"\n"))
+        member.append(compressor.flush())
+        metricsutils.record("gzip", compressing + time.perf_counter() - start)
+
+        with self.lock:
+            self.buffer.extend(member)
+            self.buffered += sum(len(part) for part in member)
+            self.buffered_routes += 1
+            block = self.cut_block(ndjson_block_size)
+        if block:
+            self.stage(*block)
+
+    def cut_block(self, min_size):
+        """Takes the buffered data as the next block (call holding lock)"""
+        if not self.buffered or self.buffered < min_size:
+            return None
+        block_number = self.blocks_cut
+        self.blocks_cut += 1
+        block = (block_number, b"".join(self.buffer), self.buffered_routes)
+        self.buffer = []
+        self.buffered = 0
+        self.buffered_routes = 0
+        return block
+
+    def stage(self, block_number, data, routes):
+        """Stages a block, retrying, and only then adds it to the commit.
+
+        A block that still fails is kept with its route count, to be tried
+        again on close. Returns whether the block was staged.
+        """
+        block_id = base64.b64encode(
+            f"{block_number:08d}".encode("ascii")).decode("ascii")
+        attempt = 0
+        while True:
+            try:
+                blobutils.stage_block(self.container_url, self.file_name,
+                                      block_id, data)
+                break
+            except Exception as ex:
+                if attempt >= fetchutils.max_retries:
+                    logging.error(f"Block {block_number} of {self.file_name}"
+                                  f" ({routes} routes) could not be staged: "
+                                  f"{ex}")
+                    with self.lock:
+                        self.unstaged[block_number] = (data, routes)
+                    return False
+                metricsutils.count("blob_retries")
+                time.sleep(fetchutils.backoff_delay(attempt))
+                attempt += 1
+        with self.lock:
+            self.staged[block_number] = block_id
+            self.unstaged.pop(block_number, None)
+        return True
+
+    def close(self):
+        # Blocks that failed during the run are tried again before the last
+        with self.lock:
+            unstaged = sorted(self.unstaged.items())
+        for block_number, (data, routes) in unstaged:
+            self.stage(block_number, data, routes)
+        with self.lock:
+            block = self.cut_block(1)
+        if block:
+            self.stage(*block)
+        # Blocks may finish staging out of order, but are committed in order
+        block_ids = [self.staged[block_number]
+                     for block_number in sorted(self.staged)]
+        if block_ids:
+            blobutils.commit_blocks(self.container_url, self.file_name,
+                                    block_ids)
+        if self.unstaged:
+            lost = sum(routes for _, routes in self.unstaged.values())
+            raise Exception(f"{lost} routes could not be staged in "
+                            f"{self.file_name}")
+
+
+def create_summary_row(origin, dest, request_time, route_json):
+    """Extracts a summary row tuple from a route directions response"""
+    summary = route_json["routes"][0]["summary"]
+    return ((float(origin[0]), float(origin[1]),
+             float(dest[0]), float(dest[1]),
+             to_datetime64(request_time),
+             to_datetime64(summary.get("departureTime")),
+             to_datetime64(summary.get("arrivalTime")))
+            + tuple(int(summary.get(field, -1)) for field in summary_fields))
+
+
+def to_datetime64(value):
+    """Converts a datetime or ISO 8601 string to a UTC datetime64"""
+    if value is None:
+        return np.datetime64("NaT")
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(value, "s")
+
+
+def create_route_sinks(container_url, run_folder, output_mode="files",
+                       summary_output=False):
+    """Creates the sinks for a city run's routes from the output mode"""
+    if output_mode == "files":
+        sinks = [RouteFileSink(container_url, run_folder)]
+    elif output_mode == "ndjson":
+        sinks = [RouteNdjsonSink(container_url, run_folder)]
+    else:
+        raise ValueError(f"Unknown routes output mode '{output_mode}'")
+    if summary_output:
+        sinks.append(RouteSummarySink(container_url, run_folder))
+    return sinks
@@ -0,0 +1,318 @@
+# ----------------------------------------------------------
+# Adaptive per-city collection scheduling
+# Tracks how much each city's traffic changes between runs and spends
+# the Maps quota where it does: more routes for the cities whose delays
+# vary most, and tiles refreshed more often where their content churns
+# ----------------------------------------------------------
+
+
+from __app__.SharedCode import blobutils
+from datetime import datetime
+import numpy as np
+import threading
+import hashlib
+import logging
+import json
+import os
+
+
+# Get environment variables
+# Local dev: found in local.settings.json, Azure: Function App Settings
+adaptive_schedule = (
+    os.environ.get("ADAPTIVE_SCHEDULE", "false").lower() == "true")
+min_routes = int(os.environ.get("SCHEDULE_MIN_ROUTES", 10))
+max_routes = int(os.environ.get("SCHEDULE_MAX_ROUTES", 0))
+route_budget = int(os.environ.get("SCHEDULE_ROUTE_BUDGET", 0))
+min_tile_interval = float(os.environ.get("SCHEDULE_MIN_TILE_INTERVAL", 15))
+max_tile_interval = float(os.environ.get("SCHEDULE_MAX_TILE_INTERVAL", 120))
+target_churn = float(os.environ.get("SCHEDULE_TARGET_CHURN", 0.2))
+tile_budget = int(os.environ.get("SCHEDULE_TILE_BUDGET", 0))
+
+# Weight of the latest run in each city's smoothed variability
+smoothing = 0.3
+
+# Seconds a city's tiles may be collected early, to allow for timer jitter
+due_tolerance = 60
+
+# Hex digits of the tile content hashes kept to measure churn
+tile_hash_length = 8
+
+
+class Schedule:
+    """A function's per-city schedule for one run.
+
+    Loads the cities' state from blob storage, plans the run from it,
+    records what each city's collection observed and saves the updated
+    state along with an audit record of the run's decisions.
+    """
+
+    def __init__(self, function_name, now=None):
+        self.function_name = function_name
+        self.now = now or datetime.utcnow()
+        self.state = load_state(function_name)
+        self.decisions = {}
+
+    def plan_routes(self, city_ids, num_routes, budget=None, maximum=None):
+        self.max_routes = get_max_routes(num_routes, maximum)
+        self.decisions = plan_routes(self.state, city_ids, num_routes,
+                                     budget, maximum)
+
+    def get_num_routes(self, city_id):
+        return self.decisions[str(city_id)]["num_routes"]
+
+    def record_routes(self, city_id, delays):
+        self.decisions[str(city_id)]["observed"] = record_routes(
+            self.state, city_id, delays, self.now)
+
+    def plan_tiles(self, city_tiles, budget=None):
+        self.decisions = plan_tiles(self.state, city_tiles, self.now, budget)
+
+    def is_due(self, city_id):
+        return self.decisions[str(city_id)]["collect"]
+
+    def record_tiles(self, city_id, hashes):
+        self.decisions[str(city_id)]["observed"] = record_tiles(
+            self.state, city_id, hashes, self.now)
+
+    def save(self):
+        save_state(self.function_name, self.state, self.decisions, self.now)
+
+
+class RouteDelayTracker:
+    """Collects the trafficDelayInSeconds of each of a city's routes"""
+
+    streaming = False
+
+    def __init__(self):
+        self.delays = []
+        self.lock = threading.Lock()
+
+    def add(self, origin, dest, request_time, file):
+        try:
+            summary = json.loads(file)["routes"][0]["summary"]
+            delay = float(summary["trafficDelayInSeconds"])
+        except (ValueError, KeyError, IndexError, TypeError):
+            return
+        with self.lock:
+            self.delays.append(delay)
+
+    def close(self):
+        pass
+
+
+class TileChurnTracker:
+    """Collects a short content hash of each of a city's tiles"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    def add(self, tileX, tileY, zoom, file):
+        digest = hashlib.sha256(file).hexdigest()[:tile_hash_length]
+        with self.lock:
+            self.hashes[f"{tileX},{tileY}"] = digest
+
+    def close(self):
+        pass
+
+
+def plan_routes(state, city_ids, num_routes, budget=None, maximum=None):
+    """Allocates the run's route budget across cities.
+
+    Routes are shared in proportion to each city's smoothed spread of
+    route delays (a Neyman allocation, which minimises the overall error
+    of the cities' mean delays), within [SCHEDULE_MIN_ROUTES, maximum]
+    per city. Cities without history are given the largest known spread.
+    By default the budget is the `num_routes` per city of a fixed
+    schedule, and the maximum twice that.
+    """
+    budget = budget or route_budget or num_routes * len(city_ids)
+    maximum = get_max_routes(num_routes, maximum)
+    minimum = min(min_routes, maximum)
+
+    spreads = {str(city_id): state["cities"].get(str(city_id), {}).get(
+        "delay_std") for city_id in city_ids}
+    known = [spread for spread in spreads.values() if spread is not None]
+    default = max(known) if known else 1.0
+    counts = allocate({city_id: default if spread is None else spread
+                       for city_id, spread in spreads.items()},
+                      budget, minimum, maximum)
+
+    decisions = {}
+    for city_id, spread in spreads.items():
+        reason = ("no history" if spread is None
+                  else f"delay spread {spread:.1f} s")
+        decisions[city_id] = {"num_routes": counts[city_id],
+                              "delay_std": spread, "reason": reason}
+    return decisions
+
+
+def get_max_routes(num_routes, maximum=None):
+    """Gets the most routes a city can be given, twice `num_routes` unset"""
+    return maximum or max_routes or num_routes * 2
+
+
+def allocate(weights, budget, minimum, maximum):
+    """Splits a budget in proportion to weights, within per-key bounds.
+
+    Keys whose share falls outside the bounds are fixed at the bound and
+    the rest of the budget is shared again among the others, starting
+    with those over the maximum. The minimum is kept even if that goes
+    over the budget.
+    """
+    counts = {}
+    remaining = dict(weights)
+    left = budget
+    while remaining:
+        total = sum(remaining.values())
+        shares = {key: left * weight / total if total > 0
+                  else left / len(remaining)
+                  for key, weight in remaining.items()}
+        # Capped keys free up budget for the others, so are fixed first
+        bounded = {key: maximum for key, share in shares.items()
+                   if share > maximum}
+        if not bounded:
+            bounded = {key: minimum for key, share in shares.items()
+                       if share < minimum}
+        if not bounded:
+            counts.update(shares)
+            break
+        for key, count in bounded.items():
+            counts[key] = count
+            left -= count
+            del remaining[key]
+    return {key: int(count) for key, count in counts.items()}
+
+
+def record_routes(state, city_id, delays, now):
+    """Updates a city's smoothed delay spread from its run's routes"""
+    city = state["cities"].setdefault(str(city_id), {})
+    city["last_run"] = now.isoformat()
+    observation = {"routes": len(delays)}
+    if len(delays) >= 2:
+        spread = float(np.std(delays, ddof=1))
+        city["delay_std"] = smooth(city.get("delay_std"), spread)
+        city["delay_mean"] = float(np.mean(delays))
+        observation["delay_std"] = round(spread, 3)
+    return observation
+
+
+def plan_tiles(state, city_tiles, now, budget=None):
+    """Chooses the cities whose tiles are due to be collected this run.
+
+    `city_tiles` maps each city to its number of tiles. Due cities are
+    collected most overdue first until the run's tile budget (0 for no
+    limit) is spent, and the rest are deferred to the next run. The most
+    overdue city is always collected, even if it alone is over budget.
+    """
+    budget = tile_budget if budget is None else budget
+    decisions = {}
+    due = []
+    for city_id, num_tiles in city_tiles.items():
+        city_id = str(city_id)
+        city = state["cities"].get(city_id, {})
+        interval = city.get("interval", min_tile_interval)
+        if "last_run" not in city:
+            due.append((float("inf"), city_id, num_tiles, interval,
+                        "no history"))
+            continue
+        elapsed = (now - datetime.fromisoformat(city["last_run"])
+                   ).total_seconds()
+        if elapsed + due_tolerance < interval * 60:
+            decisions[city_id] = {
+                "collect": False, "interval": interval,
+                "reason": f"due in {(interval * 60 - elapsed) / 60:.0f} min"}
+            continue
+        due.append((elapsed / (interval * 60), city_id, num_tiles, interval,
+                    f"due every {interval:.0f} min, churn "
+                    f"{city.get('churn', 0):.2f}"))
+
+    spent = 0
+    for overdue, city_id, num_tiles, interval, reason in sorted(
+            due, key=lambda city: -city[0]):
+        if budget > 0 and spent + num_tiles > budget:
+            if spent:
+                decisions[city_id] = {
+                    "collect": False, "interval": interval,
+                    "reason": f"deferred, {num_tiles} tiles would exceed "
+                              f"the budget of {budget}"}
+                continue
+            # A city bigger than the whole budget would never be collected,
+            # so it goes over once it's the most overdue
+            logging.warning(f"CityID {city_id} has {num_tiles} tiles, more "
+                            f"than SCHEDULE_TILE_BUDGET of {budget}")
+            reason += ", over budget as the most overdue city"
+        spent += num_tiles
+        decisions[city_id] = {"collect": True, "interval": interval,
+                              "tiles": num_tiles, "reason": reason}
+    return decisions
+
+
+def record_tiles(state, city_id, hashes, now):
+    """Updates a city's tile churn & refresh interval from its run's tiles.
+
+    Churn is the fraction of tiles whose content changed since the city
+    was last collected. The interval is halved while the smoothed churn
+    is above SCHEDULE_TARGET_CHURN and doubled once it's below half of it.
+    """
+    city = state["cities"].setdefault(str(city_id), {})
+    previous = city.get("tiles", {})
+    interval = city.get("interval", min_tile_interval)
+    observation = {"tiles": len(hashes)}
+
+    common = [tile for tile in hashes if tile in previous]
+    if common:
+        churn = sum(hashes[tile] != previous[tile]
+                    for tile in common) / len(common)
+        city["churn"] = smooth(city.get("churn"), churn)
+        if city["churn"] > target_churn:
+            interval /= 2
+        elif city["churn"] < target_churn / 2:
+            interval *= 2
+        interval = min(max(interval, min_tile_interval), max_tile_interval)
+        observation["churn"] = round(churn, 4)
+
+    # Tiles that failed this run keep their last hash
+    city.update(interval=interval, last_run=now.isoformat(),
+                tiles={**previous, **hashes})
+    observation["interval"] = interval
+    return observation
+
+
+def smooth(previous, value):
+    """Exponentially smooths a city's variability across runs"""
+    if previous is None:
+        return value
+    return (1 - smoothing) * previous + smoothing * value
+
+
+def get_state_url(function_name):
+    """Gets the URL of a function's schedule state, next to the cities"""
+    return blobutils.get_config_blob_url("schedule", f"{function_name}.json")
+
+
+def get_audit_url(function_name, now):
+    """Gets the URL of the audit record of a run's schedule decisions"""
+    return blobutils.get_config_blob_url(
+        "schedule", "audit", function_name, f"year={now.year}",
+        f"month={now.month}", f"day={now.day}", f"hour={now.hour}",
+        f"minute={now.minute}", "decisions.json")
+
+
+def load_state(function_name):
+    """Loads a function's per-city schedule state, empty if none is saved"""
+    data = blobutils.download_blob(get_state_url(function_name))
+    if not data:
+        return {"cities": {}}
+    return json.loads(data)
+
+
+def save_state(function_name, state, decisions, now):
+    """Saves a function's schedule state & the audit record of its run"""
+    blobutils.upload_blob(get_state_url(function_name),
+                          json.dumps(state).encode("utf-8"))
+    audit = {"function": function_name, "time": now.isoformat(),
+             "cities": decisions}
+    blobutils.upload_blob(get_audit_url(function_name, now),
+                          json.dumps(audit).encode("utf-8"))
+    logging.info(f"Schedule decisions: {json.dumps(decisions)}")
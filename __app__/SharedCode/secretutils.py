@@ -0,0 +1,152 @@
+# ----------------------------------------------------------
+# Process-wide cache for secrets stored in Azure Key Vault
+# Reuses one credential & client per worker and refreshes secrets
+# in the background before their time-to-live runs out
+# ----------------------------------------------------------
+
+
+from __app__.SharedCode import metricsutils
+import threading
+import logging
+import time
+import os
+
+
+# Get environment variables
+# Local dev: found in local.settings.json, Azure: Function App Settings
+key_vault_uri = os.environ["KEY_VAULT"]
+secret_ttl = float(os.environ.get("SECRET_CACHE_TTL", 3600))
+
+# Fraction of the TTL after which a cached secret is refreshed in background
+refresh_after = 0.8
+
+cache_lock = threading.Lock()
+fetch_lock = threading.Lock()
+secret_client = None
+cached_secrets = {}
+refreshing = set()
+# Values dropped as rejected, and values Key Vault gave back regardless
+invalidated_secrets = {}
+rejected_secrets = {}
+cache_stats = {"hits": 0, "misses": 0, "refreshes": 0, "invalidations": 0}
+
+
+def get_secret_client():
+    """Gets the Key Vault client, creating it on first use"""
+    global secret_client
+    with cache_lock:
+        if secret_client is None:
+            # The Azure SDKs are slow to import, so only load them when needed
+            from azure.identity import ManagedIdentityCredential
+            from azure.keyvault.secrets import SecretClient
+            credential = ManagedIdentityCredential()
+            secret_client = SecretClient(vault_url=key_vault_uri,
+                                         credential=credential)
+        return secret_client
+
+
+def get_secret(name):
+    """Gets a secret from the cache, only calling Key Vault when stale"""
+    with cache_lock:
+        cached = cached_secrets.get(name)
+        if cached:
+            value, age = cached[0], time.monotonic() - cached[1]
+            if age < secret_ttl:
+                cache_stats["hits"] += 1
+                if age >= secret_ttl * refresh_after:
+                    start_background_refresh(name)
+                return value
+        cache_stats["misses"] += 1
+
+    with fetch_lock:
+        # Another thread may have fetched the secret while we waited
+        with cache_lock:
+            cached = cached_secrets.get(name)
+            if cached and time.monotonic() - cached[1] < secret_ttl:
+                return cached[0]
+        return fetch_secret(name)
+
+
+def fetch_secret(name):
+    """Retrieves a secret from Key Vault and stores it in the cache"""
+    try:
+        with metricsutils.timer("keyvault"):
+            value = get_secret_client().get_secret(name).value
+    except Exception as ex:
+        message = "Could not get Key Vault secret"
+        logging.error(message, exc_info=ex)
+        raise Exception(message, ex)
+
+    with cache_lock:
+        now = time.monotonic()
+        cached_secrets[name] = (value, now)
+        if invalidated_secrets.pop(name, None) == value:
+            # Still the rejected value, e.g. a disabled key, so it's not
+            # refetched on every rejection until it expires
+            logging.warning(f"Key Vault returned the rejected value of "
+                            f"secret '{name}' again")
+            rejected_secrets[name] = (value, now)
+    return value
+
+
+def start_background_refresh(name):
+    """Refreshes a secret on a daemon thread (call holding cache_lock)"""
+    if name in refreshing:
+        return
+    refreshing.add(name)
+    threading.Thread(target=refresh_secret, args=(name,), daemon=True).start()
+
+
+def refresh_secret(name):
+    """Refreshes a cached secret, keeping the old value if Key Vault fails"""
+    try:
+        with fetch_lock:
+            fetch_secret(name)
+        with cache_lock:
+            cache_stats["refreshes"] += 1
+    except Exception:
+        logging.warning(f"Background refresh of secret '{name}' failed, "
+                        "cached value kept until it expires")
+    finally:
+        with cache_lock:
+            refreshing.discard(name)
+
+
+def invalidate_secret(name, rejected=None):
+    """Drops a secret from the cache, e.g. after the secret was rotated.
+
+    If the `rejected` value is given, the secret is only dropped while it's
+    still cached as that value, so threads rejected with the same old value
+    fetch the new one from Key Vault once between them. A value Key Vault
+    gave back again after being rejected isn't dropped until its TTL runs
+    out.
+    """
+    with cache_lock:
+        cached = cached_secrets.get(name)
+        if not cached or (rejected is not None and cached[0] != rejected):
+            return
+        if rejected is not None and name in rejected_secrets:
+            value, fetched = rejected_secrets[name]
+            if value == rejected and time.monotonic() - fetched < secret_ttl:
+                return
+        del cached_secrets[name]
+        rejected_secrets.pop(name, None)
+        if rejected is not None:
+            invalidated_secrets[name] = rejected
+        cache_stats["invalidations"] += 1
+
+
+def get_cache_stats():
+    """Gets the hit/miss/refresh counts of the secret cache"""
+    with cache_lock:
+        return dict(cache_stats)
+
+
+def clear_cache():
+    """Empties the cache and resets its counters"""
+    with cache_lock:
+        cached_secrets.clear()
+        invalidated_secrets.clear()
+        rejected_secrets.clear()
+        for stat in cache_stats:
+            cache_stats[stat] = 0
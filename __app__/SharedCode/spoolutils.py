@@ -0,0 +1,368 @@
+# ----------------------------------------------------------
+# Write-behind spool between the output sinks & blob storage
+# Blobs are appended to segment files on local disk and uploaded by a
+# pool of flusher threads, so a slow or briefly unavailable storage
+# account doesn't stall the Maps fetches. Blobs still on disk when an
+# invocation ends are uploaded by the next one.
+# ----------------------------------------------------------
+
+
+from __app__.SharedCode import blobutils, fetchutils, metricsutils
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import ResourceExistsError
+import itertools
+import threading
+import tempfile
+import logging
+import fcntl
+import json
+import glob
+import time
+import uuid
+import os
+
+
+# Get environment variables
+# Local dev: found in local.settings.json, Azure: Function App Settings
+spool_enabled = os.environ.get("OUTPUT_SPOOL", "false").lower() == "true"
+spool_root = os.environ.get(
+    "SPOOL_DIRECTORY",
+    os.path.join(tempfile.gettempdir(), "trafficcollection-spool"))
+segment_size = int(os.environ.get("SPOOL_SEGMENT_SIZE", 64 * 1024 * 1024))
+max_pending_bytes = int(os.environ.get("SPOOL_MAX_BYTES", 512 * 1024 * 1024))
+flush_concurrency = int(os.environ.get("SPOOL_FLUSH_CONCURRENCY", 16))
+flush_retries = int(os.environ.get("SPOOL_FLUSH_RETRIES", 5))
+drain_timeout = float(os.environ.get("SPOOL_DRAIN_TIMEOUT", 240))
+
+# The worker's spool, created on first use
+spool_lock = threading.Lock()
+spool = None
+
+
+class SpoolSegment:
+    """An append-only file of spooled blobs, with an index & acks.
+
+    `{name}.seg` holds the blobs' bytes back to back, `{name}.idx` a JSON
+    line per blob giving its destination and place in the data file, and
+    `{name}.ack` the number of each blob once uploaded. A segment's files
+    are deleted once it's sealed and every blob in it has been uploaded.
+    """
+
+    def __init__(self, path, writable=True):
+        self.path = path
+        self.entries = 0
+        self.flushed = set()
+        self.size = 0
+        self.sealed = not writable
+        self.lock = threading.Lock()
+        self.fd = os.open(f"{path}.seg", os.O_RDWR | os.O_CREAT | os.O_APPEND)
+        self.index = open(f"{path}.idx", "a", encoding="utf-8")
+        self.acks = open(f"{path}.ack", "a", encoding="utf-8")
+
+    def append(self, container_url, file_name, results, if_absent=False):
+        """Writes a blob to the segment, returning its (number, entry)"""
+        with self.lock:
+            view = memoryview(results)
+            while view:
+                view = view[os.write(self.fd, view):]
+            entry = {"container_url": container_url, "file_name": file_name,
+                     "offset": self.size, "length": len(results),
+                     "if_absent": if_absent}
+            # The index line is only written once the data is, so a crash
+            # mid-write leaves at most a blob that was never indexed
+            self.index.write(json.dumps(entry) + "\n")
+            self.index.flush()
+            number = self.entries
+            self.entries += 1
+            self.size += len(results)
+            return number, entry
+
+    def read(self, entry):
+        """Reads a blob's bytes back from the data file"""
+        return os.pread(self.fd, entry["length"], entry["offset"])
+
+    def ack(self, number):
+        """Records a blob as uploaded, returning True if the segment is done"""
+        with self.lock:
+            self.acks.write(f"{number}\n")
+            self.acks.flush()
+            self.flushed.add(number)
+            return self.sealed and len(self.flushed) == self.entries
+
+    def seal(self):
+        """Stops new writes, returning True if every blob was uploaded"""
+        with self.lock:
+            self.sealed = True
+            return len(self.flushed) == self.entries
+
+    def close(self):
+        """Closes the segment's files, leaving them on disk"""
+        with self.lock:
+            os.close(self.fd)
+            self.index.close()
+            self.acks.close()
+
+    def remove(self):
+        """Closes & deletes the segment's files"""
+        self.close()
+        with self.lock:
+            for extension in ("seg", "idx", "ack"):
+                try:
+                    os.remove(f"{self.path}.{extension}")
+                except FileNotFoundError:
+                    pass
+
+
+def load_segment(path):
+    """Opens a segment left on disk, returning it & its unflushed entries"""
+    entries = read_lines(f"{path}.idx", json.loads)
+    flushed = set(read_lines(f"{path}.ack", int))
+    segment = SpoolSegment(path, writable=False)
+    segment.entries = len(entries)
+    segment.flushed = flushed
+    segment.size = sum(entry["length"] for entry in entries)
+    return segment, [(number, entry) for number, entry in enumerate(entries)
+                     if number not in flushed]
+
+
+def read_lines(path, parse):
+    """Parses each complete line of a file, stopping at a torn one"""
+    values = []
+    try:
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if not line.endswith("\n"):
+                    break
+                values.append(parse(line))
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        logging.warning(f"Spool file {path} is corrupt after "
+                        f"{len(values)} lines")
+    return values
+
+
+class Spool:
+    """Write-behind spool of blobs waiting to be uploaded.
+
+    Each process spools into its own directory under `root`, holding an
+    exclusive lock on it while alive. Directories whose lock is free were
+    left by a process that ended with blobs still on disk, and are adopted
+    and flushed by the next spool to start or resume.
+    """
+
+    def __init__(self, root, segment_size=segment_size,
+                 max_pending_bytes=max_pending_bytes,
+                 concurrency=flush_concurrency, retries=flush_retries):
+        self.root = root
+        self.segment_size = segment_size
+        self.max_pending_bytes = max_pending_bytes
+        self.retries = retries
+        self.directory = os.path.join(
+            root, f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(self.directory)
+        self.lock_file = lock_directory(self.directory)
+        self.segment = None
+        self.segment_numbers = itertools.count()
+        self.adopted = {}
+        # Entries being flushed & their bytes, guarded by `condition`
+        self.pending = 0
+        self.pending_bytes = 0
+        self.failed = []
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(concurrency,
+                                           thread_name_prefix="spool")
+        self.adopt()
+
+    def write(self, container_url, file_name, results, if_absent=False):
+        """Spools a blob for upload, waiting if too much is unflushed"""
+        with metricsutils.timer("spool_write"), self.condition:
+            self.condition.wait_for(
+                lambda: self.pending_bytes < self.max_pending_bytes)
+            if self.segment is None or self.segment.size >= self.segment_size:
+                self.roll_segment()
+            segment = self.segment
+            number, entry = segment.append(container_url, file_name,
+                                           results, if_absent)
+            self.pending += 1
+            self.pending_bytes += entry["length"]
+        metricsutils.count("spool_bytes", entry["length"])
+        self.executor.submit(self.flush, segment, number, entry)
+
+    def roll_segment(self):
+        """Seals the current segment & starts the next (holding condition)"""
+        if self.segment is not None and self.segment.seal():
+            self.segment.remove()
+        self.segment = SpoolSegment(os.path.join(
+            self.directory, f"{next(self.segment_numbers):08d}"))
+
+    def flush(self, segment, number, entry):
+        """Uploads a spooled blob, retrying before leaving it on disk"""
+        try:
+            results = segment.read(entry)
+            for attempt in range(self.retries):
+                try:
+                    if entry["if_absent"]:
+                        blobutils.upload_if_absent(
+                            entry["container_url"], entry["file_name"],
+                            results, raise_errors=True)
+                    else:
+                        blobutils.upload_results(
+                            entry["container_url"], entry["file_name"],
+                            results, raise_errors=True)
+                    break
+                except ResourceExistsError:
+                    # Uploaded before, by an attempt whose response was
+                    # lost or a run that ended before acknowledging it
+                    break
+                except Exception:
+                    if attempt + 1 == self.retries:
+                        raise
+                    metricsutils.count("spool_retries")
+                    time.sleep(fetchutils.backoff_delay(attempt))
+            if segment.ack(number):
+                segment.remove()
+            failed = False
+        except Exception as ex:
+            logging.error(f"Spooled blob {entry['file_name']} not uploaded, "
+                          f"it will be retried next run: {ex}")
+            metricsutils.count("spool_failed")
+            failed = True
+
+        with self.condition:
+            if failed:
+                self.failed.append((segment, number, entry))
+            self.pending -= 1
+            self.pending_bytes -= entry["length"]
+            self.condition.notify_all()
+
+    def submit(self, segment, entries):
+        """Queues entries already on disk to be flushed"""
+        with self.condition:
+            self.pending += len(entries)
+            self.pending_bytes += sum(entry["length"]
+                                      for _, entry in entries)
+        for number, entry in entries:
+            self.executor.submit(self.flush, segment, number, entry)
+
+    def resume(self):
+        """Retries blobs that failed to upload & adopts abandoned spools"""
+        with self.condition:
+            failed, self.failed = self.failed, []
+        for segment, number, entry in failed:
+            self.submit(segment, [(number, entry)])
+        self.adopt()
+
+    def adopt(self):
+        """Flushes the segments of spool directories no process holds"""
+        for directory in glob.glob(os.path.join(self.root, "*")):
+            if (directory == self.directory or directory in self.adopted
+                    or not os.path.isdir(directory)):
+                continue
+            lock_file = lock_directory(directory)
+            if lock_file is None:
+                continue
+            self.adopted[directory] = lock_file
+            for index_path in sorted(glob.glob(
+                    os.path.join(directory, "*.idx"))):
+                segment, entries = load_segment(index_path[:-len(".idx")])
+                if entries:
+                    logging.info(f"Resuming {len(entries)} spooled blobs "
+                                 f"from {segment.path}")
+                    self.submit(segment, entries)
+                else:
+                    segment.remove()
+
+    def drain(self, timeout=None):
+        """Waits for the spooled blobs to be uploaded.
+
+        Returns the number of blobs still on disk, either not flushed
+        within `timeout` seconds or failed, which are retried on resume.
+        """
+        with metricsutils.timer("spool_drain"), self.condition:
+            self.condition.wait_for(lambda: self.pending == 0, timeout)
+            if self.pending == 0 and not self.failed and self.segment:
+                # Nothing is left to upload, so the segment can go
+                self.segment.seal()
+                self.segment.remove()
+                self.segment = None
+            remaining = self.pending + len(self.failed)
+        self.remove_adopted()
+        return remaining
+
+    def remove_adopted(self):
+        """Deletes adopted spool directories with no segments left"""
+        for directory, lock_file in list(self.adopted.items()):
+            if glob.glob(os.path.join(directory, "*.idx")):
+                continue
+            os.remove(os.path.join(directory, "lock"))
+            lock_file.close()
+            os.rmdir(directory)
+            del self.adopted[directory]
+
+    def close(self):
+        """Stops flushing & releases the spool, leaving it for adoption"""
+        self.executor.shutdown(wait=True)
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        for lock_file in [self.lock_file] + list(self.adopted.values()):
+            lock_file.close()
+        self.adopted = {}
+
+
+def lock_directory(directory):
+    """Takes the exclusive lock on a spool directory, or None if held"""
+    lock_file = open(os.path.join(directory, "lock"), "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def get_spool():
+    """Gets the worker's spool, creating it on first use"""
+    global spool
+    with spool_lock:
+        if spool is None:
+            spool = Spool(spool_root)
+        return spool
+
+
+def write_results(container_url, file_name, results, if_absent=False):
+    """Writes a blob through the spool, or uploads it if spooling is off.
+
+    Returns what the upload returned, or None once the blob is spooled.
+    A failed direct upload (already retried by the storage SDK) is
+    raised, so the item that wrote it is counted as failed.
+    """
+    if spool_enabled:
+        try:
+            get_spool().write(container_url, file_name, results, if_absent)
+            return None
+        except OSError as ex:
+            # A full or unwritable disk shouldn't lose the blob
+            logging.error(f"Spooling {file_name} failed, uploading it: {ex}")
+    if if_absent:
+        return blobutils.upload_if_absent(container_url, file_name, results,
+                                          raise_errors=True)
+    return blobutils.upload_results(container_url, file_name, results,
+                                    raise_errors=True)
+
+
+def resume():
+    """Starts flushing blobs left over from earlier runs, if spooling"""
+    if spool_enabled:
+        get_spool().resume()
+
+
+def drain():
+    """Waits for the run's spooled blobs to be uploaded, if spooling"""
+    if not spool_enabled:
+        return
+    remaining = get_spool().drain(drain_timeout)
+    if remaining:
+        logging.warning(f"{remaining} spooled blobs not yet uploaded, "
+                        "they will be flushed in the background or next run")
@@ -0,0 +1,287 @@
+# ----------------------------------------------------------
+# Incremental per-city route statistics
+# Keeps running moments and mergeable quantile sketches of each city's
+# travel times and delays per hour of the week, updated as routes are
+# fetched and merged into one small state blob per city & hour
+# ----------------------------------------------------------
+
+
+from __app__.SharedCode import blobutils, fetchutils, metricsutils
+from datetime import datetime
+import threading
+import logging
+import math
+import json
+import time
+import os
+
+
+# Get environment variables
+# Local dev: found in local.settings.json, Azure: Function App Settings
+stats_output = (
+    os.environ.get("ROUTES_STATS_OUTPUT", "false").lower() == "true")
+sketch_accuracy = float(os.environ.get("STATS_SKETCH_ACCURACY", 0.02))
+max_bins = int(os.environ.get("STATS_MAX_BINS", 128))
+merge_retries = int(os.environ.get("STATS_MERGE_RETRIES", 10))
+
+# Measures taken from each route's summary
+stats_measures = ("travel_time", "delay", "delay_per_km")
+
+# Quantiles given when describing a measure
+describe_quantiles = (0.5, 0.9, 0.95)
+
+
+class RouteStatsSink:
+    """Aggregates a city run's routes into statistics per hour of the week.
+
+    On close the run's aggregates are merged into the city's state blob
+    for each hour, so runs of the same city on other workers add to them
+    rather than replace them.
+    """
+
+    streaming = False
+
+    def __init__(self, city_id, accuracy=None):
+        self.city_id = city_id
+        self.stats = create_stats(city_id, accuracy or sketch_accuracy)
+        self.lock = threading.Lock()
+
+    def add(self, origin, dest, request_time, file):
+        try:
+            hour, values = read_route(json.loads(file), request_time)
+        except (ValueError, KeyError, IndexError, TypeError):
+            return
+        with self.lock:
+            add_route(self.stats, hour, values)
+
+    def close(self):
+        if not self.stats["hours"]:
+            return
+        # The raw routes are already stored, so the city run doesn't fail
+        try:
+            with metricsutils.timer("stats_merge"):
+                save_stats(self.city_id, self.stats)
+        except Exception as ex:
+            logging.exception(
+                f"Route stats for CityID {self.city_id} not saved",
+                exc_info=ex)
+
+
+def read_route(route_json, request_time):
+    """Gets a route's hour of the week & its measures from its summary"""
+    summary = route_json["routes"][0]["summary"]
+    hour = get_hour_of_week(summary.get("departureTime"), request_time)
+    delay = float(summary["trafficDelayInSeconds"])
+    values = {"travel_time": float(summary["travelTimeInSeconds"]),
+              "delay": delay}
+    length = float(summary.get("lengthInMeters", 0))
+    if length > 0:
+        values["delay_per_km"] = delay / (length / 1000)
+    return hour, values
+
+
+def get_hour_of_week(departure_time, request_time):
+    """Gets the hour of the week (0 is Monday 00:00) a route departed.
+
+    Maps gives the departure in the city's local time, so buckets line
+    up with local rush hours. The request time (UTC) is used if there
+    is no readable departure time.
+    """
+    try:
+        departed = datetime.fromisoformat(departure_time)
+    except (TypeError, ValueError):
+        departed = request_time
+    return departed.weekday() * 24 + departed.hour
+
+
+def create_stats(city_id, accuracy):
+    """Creates an empty set of a city's statistics"""
+    return {"cityId": str(city_id), "accuracy": accuracy, "hours": {}}
+
+
+def create_measure():
+    """Creates the empty moments & sketch of one measure"""
+    return {"count": 0, "mean": 0.0, "m2": 0.0, "min": None, "max": None,
+            "zeros": 0, "bins": {}}
+
+
+def add_route(stats, hour, values):
+    """Adds a route's measures to the statistics of its hour of the week"""
+    bucket = stats["hours"].setdefault(str(hour), {})
+    for measure, value in values.items():
+        add_value(bucket.setdefault(measure, create_measure()), value,
+                  stats["accuracy"])
+
+
+def add_value(measure, value, accuracy):
+    """Adds a value to a measure's running moments (Welford) & sketch"""
+    measure["count"] += 1
+    delta = value - measure["mean"]
+    measure["mean"] += delta / measure["count"]
+    measure["m2"] += delta * (value - measure["mean"])
+    measure["min"] = value if measure["min"] is None else min(
+        measure["min"], value)
+    measure["max"] = value if measure["max"] is None else max(
+        measure["max"], value)
+    add_to_sketch(measure, value, accuracy)
+
+
+def add_to_sketch(measure, value, accuracy, count=1):
+    """Counts a value in the log-spaced bin holding it, or as a zero.
+
+    Every value in a bin is within `accuracy` (relative) of the bin's
+    representative value, so quantiles are too. Bins are just counts,
+    which makes sketches exactly mergeable.
+    """
+    if value <= 0:
+        measure["zeros"] += count
+        return
+    index = str(get_bin(value, accuracy))
+    measure["bins"][index] = measure["bins"].get(index, 0) + count
+    if len(measure["bins"]) > max_bins:
+        collapse_bins(measure)
+
+
+def collapse_bins(measure):
+    """Folds the lowest bins together, keeping at most `max_bins`.
+
+    Only quantiles in the folded bins lose accuracy (they read high), so
+    the medians & upper quantiles that matter for delays are kept.
+    """
+    indices = sorted(int(index) for index in measure["bins"])
+    lowest = indices[-max_bins]
+    folded = sum(measure["bins"].pop(str(index))
+                 for index in indices[:-max_bins])
+    measure["bins"][str(lowest)] += folded
+
+
+def get_gamma(accuracy):
+    """Gets the ratio between the bounds of a sketch's bins"""
+    return (1 + accuracy) / (1 - accuracy)
+
+
+def get_bin(value, accuracy):
+    """Gets the index of the sketch bin holding a positive value"""
+    return math.ceil(math.log(value) / math.log(get_gamma(accuracy)))
+
+
+def get_bin_value(index, accuracy):
+    """Gets the representative value of a sketch bin"""
+    gamma = get_gamma(accuracy)
+    return 2 * gamma ** index / (gamma + 1)
+
+
+def merge_hour(state, bucket, accuracy):
+    """Merges an hour's measures into the hour's state, in place.
+
+    Sketches are rebinned if the two were kept at different accuracies,
+    keeping the accuracy of `state`.
+    """
+    for name, measure in bucket.items():
+        merge_measure(state["measures"].setdefault(name, create_measure()),
+                      measure, state["accuracy"], accuracy)
+    return state
+
+
+def merge_measure(target, source, accuracy, source_accuracy):
+    """Merges a measure's moments (Chan et al.) & sketch into another's"""
+    if not source["count"]:
+        return
+    count = target["count"] + source["count"]
+    delta = source["mean"] - target["mean"]
+    target["mean"] += delta * source["count"] / count
+    target["m2"] += (source["m2"] + delta ** 2 * target["count"]
+                     * source["count"] / count)
+    target["count"] = count
+    target["min"] = source["min"] if target["min"] is None else min(
+        target["min"], source["min"])
+    target["max"] = source["max"] if target["max"] is None else max(
+        target["max"], source["max"])
+
+    target["zeros"] += source["zeros"]
+    for index, bin_count in source["bins"].items():
+        if accuracy == source_accuracy:
+            target["bins"][index] = target["bins"].get(index, 0) + bin_count
+        else:
+            add_to_sketch(target, get_bin_value(int(index), source_accuracy),
+                          accuracy, bin_count)
+    if len(target["bins"]) > max_bins:
+        collapse_bins(target)
+
+
+def get_quantile(measure, quantile, accuracy):
+    """Estimates a quantile of a measure from its sketch"""
+    if not measure["count"]:
+        return None
+    rank = quantile * (measure["count"] - 1)
+    seen = measure["zeros"]
+    value = 0.0
+    if seen <= rank:
+        for index in sorted(int(index) for index in measure["bins"]):
+            seen += measure["bins"][str(index)]
+            if seen > rank:
+                value = get_bin_value(index, accuracy)
+                break
+    return min(max(value, measure["min"]), measure["max"])
+
+
+def describe(measure, accuracy):
+    """Summarises a measure as its count, mean, spread & quantiles"""
+    count = measure["count"]
+    description = {
+        "count": count, "mean": measure["mean"],
+        "std": math.sqrt(measure["m2"] / (count - 1)) if count > 1 else 0.0,
+        "min": measure["min"], "max": measure["max"]}
+    for quantile in describe_quantiles:
+        description[f"p{quantile * 100:g}"] = get_quantile(
+            measure, quantile, accuracy)
+    return description
+
+
+def create_hour_state(city_id, hour, accuracy, now):
+    """Creates the empty state of a city's hour of the week"""
+    return {"cityId": str(city_id), "hour": int(hour), "accuracy": accuracy,
+            "since": now.isoformat(), "measures": {}}
+
+
+def get_stats_url(city_id, hour):
+    """Gets the URL of a city's statistics for an hour of the week"""
+    return blobutils.get_config_blob_url(
+        "stats", f"cityId={city_id}", f"hour={hour}", "stats.json")
+
+
+def load_stats(city_id, hour):
+    """Loads a city's statistics for an hour, or None if none are saved"""
+    data = blobutils.download_blob(get_stats_url(city_id, hour))
+    return json.loads(data) if data else None
+
+
+def save_stats(city_id, stats):
+    """Merges a run's statistics into the city's state blob for each hour"""
+    return [save_hour(city_id, hour, bucket, stats["accuracy"])
+            for hour, bucket in stats["hours"].items()]
+
+
+def save_hour(city_id, hour, bucket, accuracy):
+    """Merges a run's statistics for an hour into its state blob.
+
+    The blob is only replaced if it's unchanged since it was read (by
+    ETag), so concurrent runs of a city never overwrite each other's
+    routes. On a conflict it's read & merged again, after a backoff.
+    """
+    url = get_stats_url(city_id, hour)
+    for attempt in range(merge_retries + 1):
+        data, etag = blobutils.download_blob_with_etag(url)
+        now = datetime.utcnow()
+        state = (json.loads(data) if data
+                 else create_hour_state(city_id, hour, accuracy, now))
+        merge_hour(state, bucket, accuracy)
+        state["updated"] = now.isoformat()
+        if blobutils.upload_blob_if_unchanged(
+                url, json.dumps(state, separators=(",", ":")).encode("utf-8"),
+                etag):
+            return state
+        metricsutils.count("stats_conflicts")
+        time.sleep(fetchutils.backoff_delay(attempt))
+    raise Exception(f"Route stats for CityID {city_id} hour {hour} kept "
+                    f"changing, gave up after {merge_retries + 1} attempts")
@@ -0,0 +1,406 @@
+# ----------------------------------------------------------
+# Output sinks for the traffic tiles downloaded from Azure Maps
+# Each sink receives every tile fetched for a city run and writes it
+# to blob storage in its own layout when the run is closed
+# ----------------------------------------------------------
+
+
+from __app__.SharedCode import maputils, metricsutils, spoolutils
+import numpy as np
+import collections
+import threading
+import logging
+import hashlib
+import zipfile
+import json
+import io
+
+
+# Congestion classes of the relative flow style, indexed by grid value
+congestion_classes = ("none", "free_flow", "light", "heavy", "stopped")
+
+# Approximate legend colours of the relative flow style, for classes 1-4.
+# Anti-aliased edges are matched to the nearest of these.
+relative_palette = np.array([
+    [0x4c, 0xaf, 0x50],
+    [0xff, 0xc1, 0x07],
+    [0xf4, 0x43, 0x36],
+    [0x8b, 0x00, 0x00],
+])
+
+# Pixels more transparent than this carry no traffic
+min_alpha = 128
+
+# Grid value of pixels outside the city polygon
+outside_class = 255
+
+# An array written to an .npz a chunk (along its first axis) at a time
+StreamedArray = collections.namedtuple("StreamedArray",
+                                       ["shape", "dtype", "chunks"])
+
+
+class TileBlobSink:
+    """Uploads each tile as its own map.{x}.{y}.{zoom}.traffic.png blob"""
+
+    def __init__(self, container_url, run_folder):
+        self.container_url = container_url
+        self.run_folder = run_folder
+
+    def add(self, tileX, tileY, zoom, file):
+        file_name = f"{self.run_folder}map.{tileX}.{tileY}.{zoom}.traffic.png"
+        spoolutils.write_results(self.container_url, file_name, file)
+
+    def close(self):
+        pass
+
+
+class DedupTileSink:
+    """Stores tiles by content hash, with a manifest of tiles for the run.
+
+    A tile's image is only uploaded the first time its content is seen, to
+    cityId={id}/content/{hash[:2]}/{hash}.png. Every tile of the run is
+    recorded in the run folder's manifest, mapping (x, y, zoom, timestamp)
+    to the content hash, so the full time series can be reconstructed.
+    """
+
+    def __init__(self, container_url, city_id, run_folder, timestamp):
+        self.container_url = container_url
+        self.city_id = city_id
+        self.run_folder = run_folder
+        self.timestamp = timestamp
+        self.entries = []
+        self.uploaded = 0
+        # Content written (or being written) by the run, by hash
+        self.contents = {}
+        self.lock = threading.Lock()
+
+    def add(self, tileX, tileY, zoom, file):
+        digest = hashlib.sha256(file).hexdigest()
+        uploaded = self.write_content(digest, file)
+
+        with self.lock:
+            self.uploaded += bool(uploaded)
+            self.entries.append({"x": tileX, "y": tileY, "zoom": zoom,
+                                 "timestamp": self.timestamp,
+                                 "sha256": digest})
+
+    def write_content(self, digest, file):
+        """Writes a tile's content once per run, however many threads see it.
+
+        Threads with the same content wait for the first one's write, and
+        take over if it fails. Returns True if the content was uploaded.
+        """
+        while True:
+            with self.lock:
+                written = self.contents.get(digest)
+                if written is None:
+                    written = self.contents[digest] = threading.Event()
+                    break
+            written.wait()
+            with self.lock:
+                if digest in self.contents:
+                    return False
+        try:
+            # Counts uploads done here, not those left to the spool's flushers
+            return spoolutils.write_results(
+                self.container_url, content_blob_name(self.city_id, digest),
+                file, if_absent=True)
+        except Exception:
+            with self.lock:
+                del self.contents[digest]
+            raise
+        finally:
+            written.set()
+
+    def close(self):
+        if not self.entries:
+            return
+        entries = sorted(self.entries, key=lambda e: (e["x"], e["y"]))
+        first = entries[0]
+        # Named after the first tile so fan-out chunks don't overwrite
+        # each other's manifests in the same run folder
+        file_name = (f"{self.run_folder}manifest.{first['zoom']}."
+                     f"{first['x']}.{first['y']}.json")
+        manifest = {"cityId": self.city_id, "tiles": entries}
+        spoolutils.write_results(self.container_url, file_name,
+                                 json.dumps(manifest).encode("utf-8"))
+
+
+class MosaicTileSink:
+    """Writes all of a run's tiles as one chunked mosaic array blob.
+
+    Tiles are decoded to RGBA and stacked into a compressed .npz holding
+    `tiles` (N x 256 x 256 x 4), `tile_xy` (N x 2) and `pixel_origin`, the
+    (column, row) offset of each tile in a mosaic of `mosaic_shape` whose
+    top left is tile `origin_tile`. Only tiles that were fetched are stored,
+    so cities far from rectangular don't pay for their empty bounding box.
+    The PNGs are kept until close, then decoded one at a time straight
+    into the compressed blob, so peak memory is the PNGs and the blob
+    rather than every decoded tile (~170 MB for London).
+    """
+
+    def __init__(self, container_url, run_folder):
+        self.container_url = container_url
+        self.run_folder = run_folder
+        self.files = {}
+        self.zoom = None
+        self.lock = threading.Lock()
+
+    def add(self, tileX, tileY, zoom, file):
+        with self.lock:
+            self.files[(tileX, tileY)] = file
+            self.zoom = zoom
+
+    def close(self):
+        if not self.files:
+            return
+        mosaic = create_mosaic(self.files, self.zoom)
+        left, top = mosaic["origin_tile"]
+        file_name = (f"{self.run_folder}mosaic.{self.zoom}.{left}.{top}"
+                     ".traffic.npz")
+        spoolutils.write_results(self.container_url, file_name,
+                                 encode_npz(mosaic))
+
+
+class CongestionTileSink:
+    """Classifies a run's relative flow tiles into one congestion grid blob.
+
+    Each tile is decoded as it arrives and its pixels mapped to a
+    `congestion_classes` index, with pixels outside the city polygon set
+    to `outside_class`. On close the grids are written as a compressed
+    congestion.{zoom}.{left}.{top}.npz holding `grid` (N x 256 x 256
+    uint8), `tile_xy` (N x 2) and `tiles_histogram`, the pixel count for
+    each class over the blob's tiles. That's the whole city, or in
+    fan-out mode one work item's chunk of it, written to its own blob.
+    """
+
+    def __init__(self, container_url, run_folder, polygon):
+        self.container_url = container_url
+        self.run_folder = run_folder
+        self.polygon = polygon
+        self.grids = {}
+        self.histogram = np.zeros(len(congestion_classes), dtype=np.int64)
+        self.zoom = None
+        self.lock = threading.Lock()
+
+    def add(self, tileX, tileY, zoom, file):
+        mask = maputils.get_tile_mask(self.polygon, tileX, tileY, zoom)
+        grid = classify_tile(pad_tile(decode_tile(file)), mask)
+        counts = np.bincount(grid[mask], minlength=len(congestion_classes))
+
+        with self.lock:
+            self.grids[(tileX, tileY)] = grid
+            self.histogram += counts
+            self.zoom = zoom
+
+    def close(self):
+        if not self.grids:
+            return
+        tile_xy = np.array(sorted(self.grids), dtype=np.int32)
+        left, top = tile_xy.min(axis=0)
+        file_name = (f"{self.run_folder}congestion.{self.zoom}.{left}.{top}"
+                     ".npz")
+        congestion = {
+            "grid": np.stack([self.grids[xy] for xy in
+                              map(tuple, tile_xy.tolist())]),
+            "tile_xy": tile_xy,
+            "tiles_histogram": self.histogram,
+            "classes": np.array(congestion_classes),
+            "zoom": np.array(self.zoom),
+        }
+        spoolutils.write_results(self.container_url, file_name,
+                                 encode_npz(congestion))
+        logging.info(f"Congestion histogram of {file_name}: " + ", ".join(
+            f"{name}={count}" for name, count in
+            zip(congestion_classes, self.histogram.tolist())))
+
+
+class PyramidTileSink:
+    """Builds the coarser zoom levels of a run's tiles by downsampling them.
+
+    Each tile is decoded as it arrives and halved into its quadrant of
+    the parent tile one zoom level out. On close the levels down to
+    `min_zoom` are built from those in turn, and every pyramid tile is
+    written as map.{x}.{y}.{zoom}.traffic.png next to the base tiles, so
+    overview levels cost no Maps requests.
+    """
+
+    def __init__(self, container_url, run_folder, min_zoom):
+        self.container_url = container_url
+        self.run_folder = run_folder
+        self.min_zoom = min_zoom
+        self.parents = {}
+        self.zoom = None
+        self.lock = threading.Lock()
+
+    def add(self, tileX, tileY, zoom, file):
+        if zoom <= self.min_zoom:
+            return
+        quadrant = downsample_tile(pad_tile(decode_tile(file)))
+        with self.lock:
+            add_to_parent(self.parents, tileX, tileY, quadrant)
+            self.zoom = zoom - 1
+
+    def close(self):
+        tiles, zoom = self.parents, self.zoom
+        while tiles:
+            for (tileX, tileY), tile in sorted(tiles.items()):
+                file_name = (f"{self.run_folder}map.{tileX}.{tileY}.{zoom}"
+                             ".traffic.png")
+                spoolutils.write_results(self.container_url, file_name,
+                                         encode_tile(tile))
+            if zoom <= self.min_zoom:
+                break
+            parents = {}
+            for (tileX, tileY), tile in tiles.items():
+                add_to_parent(parents, tileX, tileY, downsample_tile(tile))
+            tiles, zoom = parents, zoom - 1
+
+
+def add_to_parent(parents, tileX, tileY, quadrant):
+    """Places a downsampled tile in its quadrant of its parent in `parents`"""
+    parent, (column, row) = maputils.tile_XY_to_parent(tileX, tileY)
+    size = maputils.tile_size
+    if parent not in parents:
+        parents[parent] = np.zeros((size, size, 4), dtype=np.uint8)
+    half = size // 2
+    parents[parent][row * half:(row + 1) * half,
+                    column * half:(column + 1) * half] = quadrant
+
+
+def downsample_tile(tile):
+    """Halves an RGBA tile's resolution by averaging 2 x 2 pixel blocks.
+
+    Colours are weighted by alpha, so the transparent pixels either side
+    of a road don't darken it at the coarser level.
+    """
+    rgba = tile.astype(np.float32)
+    height, width = tile.shape[:2]
+
+    def pool(values):
+        return values.reshape(height // 2, 2, width // 2, 2, -1).sum(
+            axis=(1, 3))
+
+    alpha = pool(rgba[..., 3:])
+    colour = pool(rgba[..., :3] * rgba[..., 3:]) / np.maximum(alpha, 1)
+    return np.rint(np.concatenate([colour, alpha / 4], axis=-1)).astype(
+        np.uint8)
+
+
+def classify_tile(tile, mask=None):
+    """Maps an RGBA relative flow tile to a uint8 grid of congestion classes.
+
+    Transparent pixels (no road) are class 0, every other pixel takes the
+    class of the nearest palette colour. Pixels where `mask` is False are
+    set to `outside_class`.
+    """
+    rgb = tile[..., :3].astype(np.int32)
+    distances = ((rgb[..., None, :] - relative_palette) ** 2).sum(axis=-1)
+    grid = (np.argmin(distances, axis=-1) + 1).astype(np.uint8)
+    grid[tile[..., 3] < min_alpha] = 0
+
+    if mask is not None:
+        grid[~mask] = outside_class
+    return grid
+
+
+def decode_tile(file):
+    """Decodes a PNG tile into an RGBA uint8 array"""
+    # Pillow is only loaded by the output modes that decode tiles
+    from PIL import Image
+    with metricsutils.timer("tile_decode"):
+        with Image.open(io.BytesIO(file)) as image:
+            return np.asarray(image.convert("RGBA"))
+
+
+def encode_tile(tile):
+    """Encodes an RGBA uint8 array as a PNG tile"""
+    from PIL import Image
+    with metricsutils.timer("tile_encode"):
+        buffer = io.BytesIO()
+        Image.fromarray(tile, "RGBA").save(buffer, "PNG")
+        return buffer.getvalue()
+
+
+def pad_tile(tile):
+    """Pads (or crops) a decoded tile to tile_size x tile_size"""
+    size = maputils.tile_size
+    if tile.shape[:2] == (size, size):
+        return tile
+    padded = np.zeros((size, size) + tile.shape[2:], dtype=tile.dtype)
+    padded[:tile.shape[0], :tile.shape[1]] = tile[:size, :size]
+    return padded
+
+
+def create_mosaic(files, zoom):
+    """Lays out encoded tiles keyed by (x, y) as mosaic arrays.
+
+    `tiles` is a StreamedArray, decoding each tile as it's written.
+    """
+    tile_xy = np.array(sorted(files), dtype=np.int32).reshape(-1, 2)
+    left, top = tile_xy.min(axis=0)
+    right, bottom = tile_xy.max(axis=0)
+
+    tiles = (pad_tile(decode_tile(files[(tileX, tileY)]))
+             for tileX, tileY in tile_xy.tolist())
+
+    return {
+        "tiles": StreamedArray((len(tile_xy), maputils.tile_size,
+                                maputils.tile_size, 4), np.uint8, tiles),
+        "tile_xy": tile_xy,
+        "pixel_origin": (tile_xy - (left, top)) * maputils.tile_size,
+        "origin_tile": np.array([left, top], dtype=np.int32),
+        "mosaic_shape": np.array([(bottom - top + 1) * maputils.tile_size,
+                                  (right - left + 1) * maputils.tile_size]),
+        "zoom": np.array(zoom),
+    }
+
+
+def encode_npz(arrays):
+    """Serializes named arrays into compressed .npz bytes.
+
+    Written as np.savez_compressed does, except that a StreamedArray's
+    chunks are compressed as they're produced, never all in memory.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, array in arrays.items():
+            with archive.open(f"{name}.npy", "w", force_zip64=True) as member:
+                if not isinstance(array, StreamedArray):
+                    np.lib.format.write_array(member, np.asanyarray(array),
+                                              allow_pickle=False)
+                    continue
+                np.lib.format.write_array_header_1_0(member, {
+                    "descr": np.lib.format.dtype_to_descr(
+                        np.dtype(array.dtype)),
+                    "fortran_order": False, "shape": tuple(array.shape)})
+                for chunk in array.chunks:
+                    member.write(np.ascontiguousarray(
+                        chunk, dtype=array.dtype).tobytes())
+    return buffer.getvalue()
+
+
+def content_blob_name(city_id, digest):
+    """Gets the content-addressed blob name for a tile's content hash"""
+    return f"cityId={city_id}/content/{digest[:2]}/{digest}.png"
+
+
+def create_tile_sinks(output_mode, container_url, city_id, run_folder,
+                      timestamp, polygon=None, congestion_output=False,
+                      pyramid_min_zoom=None):
+    """Creates the sinks for a city run's tiles from the output mode"""
+    if output_mode == "tiles":
+        sinks = [TileBlobSink(container_url, run_folder)]
+    elif output_mode == "dedup":
+        sinks = [DedupTileSink(container_url, city_id, run_folder,
+                               timestamp)]
+    elif output_mode == "mosaic":
+        sinks = [MosaicTileSink(container_url, run_folder)]
+    else:
+        raise ValueError(f"Unknown tiles output mode '{output_mode}'")
+    if congestion_output:
+        sinks.append(CongestionTileSink(container_url, run_folder, polygon))
+    if pyramid_min_zoom is not None:
+        sinks.append(PyramidTileSink(container_url, run_folder,
+                                     pyramid_min_zoom))
+    return sinks
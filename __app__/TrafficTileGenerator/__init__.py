@@ -8,64 +8,213 @@
 
 import logging
 import os
+import functools
+import typing
+import json
 import azure.functions as func
 from datetime import datetime
-from __app__.SharedCode import maputils, blobutils
+from __app__.SharedCode import (
+    maputils, blobutils, secretutils, fetchutils, metricsutils, tileutils,
+    spoolutils, scheduleutils)
 
+# Zoom level for the tile grid
+zoom = 13
 
-def main(mytimer: func.TimerRequest) -> None:
+
+def main(mytimer: func.TimerRequest,
+         workitems: func.Out[typing.List[str]] = None) -> None:
     """Main method triggered by CRON time trigger"""
+    run_metrics = metricsutils.RunMetrics("TrafficTileGenerator")
+    # Start uploading blobs spooled but not uploaded by earlier runs
+    spoolutils.resume()
+    try:
+        process_cities(workitems, run_metrics)
+    finally:
+        spoolutils.drain()
+        # One structured record of where the invocation's time went
+        run_metrics.emit()
+
+
+def process_cities(workitems, run_metrics):
+    """Processes every city in the config, or queues them in fan-out mode"""
     logging.info("TrafficTileGenerator function initialised.")
 
     # Call blob storage to get city polygon definitions from stored JSON file
     polygons_json = blobutils.get_polygonsJSON()
     logging.info("Retrieved polygon JSON from blob storage.")
 
-    # existing blob container for saving outputs
-    container_url = os.environ["TRAFFICTILES_OUTPUT_URL"]
+    # In fan-out mode each city's tiles are queued in chunks for the
+    # TrafficTileWorker function
+    if os.environ.get("FANOUT_MODE", "false").lower() == "true":
+        items, failed_cities = create_work_items(polygons_json)
+        workitems.set([json.dumps(item) for item in items])
+        logging.info(f"Queued {len(items)} tile chunks for tile workers")
+        if failed_cities:
+            raise Exception("Traffic tiles not queued for CityIDs "
+                            f"{failed_cities}")
+        return
 
-    # Specify zoom level for the tile grid
-    zoom = 13
+    # Only collect the cities whose tiles are due, by how much they churn
+    schedule = None
+    if scheduleutils.adaptive_schedule:
+        schedule = scheduleutils.Schedule("TrafficTileGenerator")
+        schedule.plan_tiles(get_tile_counts(polygons_json))
 
     # Iterate through the JSON array for each city
+    failed_cities = []
     for polygons_count, city_polygon in enumerate(polygons_json):
         try:
-            # Get polygon for the city
-            city_id = city_polygon['cityId']
-            assert city_id, ("'cityId' field empty/not found in array"
-                             f"[{polygons_count}] in polygons JSON")
-
-            polygon_string = city_polygon['polygon']
-            assert polygon_string, ("City 'polygon' field empty/not in array"
-                                    f"[{polygons_count}] in polygons JSON")
-
-            logging.info(f"Generating tile grid for CityID {city_id}")
-
-            # Get a Shapely polygon object for the polygon string
-            polygon = maputils.create_polygon_from_string(polygon_string)
-
-            # Get tile grid positions for city bounding box area
-            top, bottom, left, right = maputils.get_tilegrid(polygon, zoom)
-
-            for tileX in range(left, right+1):
-                for tileY in range(top, bottom+1):
-                    # Construct tile query
-                    query = maputils.construct_tiles_query(zoom, tileX, tileY)
-                    logging.info(f"Calling Maps to generate traffic tile, "
-                                 f"X:{tileX} Y:{tileY} Zoom:{zoom}")
-                    # Query Azure Maps API
-                    file = maputils.query_maps(query)
-                    # Save result to blob with datetime values as folder path
-                    dt = datetime.utcnow().timetuple()
-                    file_name = (f"cityId={city_id}/year={dt[0]}/month={dt[1]}"
-                                 f"/day={dt[2]}/hour={dt[3]}/minute={dt[4]}/"
-                                 f"map.{tileX}.{tileY}.{zoom}.traffic.png")
-                    # Upload the tile to blob storage
-                    blobutils.upload_results(container_url, file_name, file)
+            city_id = city_polygon.get('cityId', polygons_count)
+            if schedule is not None and not schedule.is_due(city_id):
+                logging.info(f"Tiles for CityID {city_id} not due this run")
+                continue
+            with run_metrics.city(city_id):
+                process_city(city_polygon, polygons_count, schedule=schedule)
+        except Exception as ex:
+            # Carry on with the other cities, the run fails at the end
+            logging.exception(ex)
+            failed_cities.append(city_polygon.get('cityId', polygons_count))
+
+    if schedule is not None:
+        schedule.save()
+
+    logging.info("Key Vault secret cache stats: "
+                 f"{secretutils.get_cache_stats()}")
+
+    if failed_cities:
+        raise Exception(f"Traffic tiles failed for CityIDs {failed_cities}")
+
 
+def create_work_items(polygons_json):
+    """Splits each city's tile cover into chunks to queue as work items.
+
+    Returns the work items and the IDs of any cities that couldn't be
+    split, so one invalid city doesn't stop the others being queued.
+    """
+    chunk_size = int(os.environ.get("TILES_PER_WORK_ITEM", 50))
+    buffer = float(os.environ.get("TILE_COVER_BUFFER", 0))
+
+    items = []
+    failed_cities = []
+    for polygons_count, city_polygon in enumerate(polygons_json):
+        try:
+            polygon = maputils.get_city_polygon(city_polygon['polygon'])
+            tiles = maputils.get_tilecover(polygon, zoom, buffer)
         except Exception as ex:
             logging.exception(ex)
-            raise
-        else:
-            logging.info(f"Tiles for CityID {city_id} successfully queried"
-                         " & results uploaded to blob storage")
+            failed_cities.append(city_polygon.get('cityId', polygons_count))
+            continue
+        for i in range(0, len(tiles), chunk_size):
+            items.append({"city": city_polygon,
+                          "tiles": tiles[i:i + chunk_size]})
+    return items, failed_cities
+
+
+def get_tile_counts(polygons_json):
+    """Counts the tiles in each city's tile cover, to budget a schedule"""
+    buffer = float(os.environ.get("TILE_COVER_BUFFER", 0))
+
+    counts = {}
+    for polygons_count, city_polygon in enumerate(polygons_json):
+        city_id = city_polygon.get('cityId', polygons_count)
+        try:
+            polygon = maputils.get_city_polygon(city_polygon['polygon'])
+            counts[city_id] = len(maputils.get_tilecover(polygon, zoom,
+                                                         buffer))
+        except Exception:
+            # Invalid cities are still scheduled, to fail when processed
+            counts[city_id] = 0
+    return counts
+
+
+def process_city(city_polygon, polygons_count=0, tiles=None, schedule=None):
+    """Queries & uploads the traffic tiles (default all) for a single city"""
+    # existing blob container for saving outputs
+    container_url = os.environ["TRAFFICTILES_OUTPUT_URL"]
+
+    # Optional margin (in degrees) around each city to also fetch tiles for
+    buffer = float(os.environ.get("TILE_COVER_BUFFER", 0))
+
+    # Number of tiles fetched in parallel, can be overridden per city
+    concurrency = int(os.environ.get("TILES_CONCURRENCY", 8))
+
+    # Write a blob per tile ('tiles') or content-addressed tiles ('dedup')
+    output_mode = os.environ.get("TILES_OUTPUT_MODE", "tiles")
+
+    # Also write the tiles decoded into a grid of congestion classes
+    congestion_output = os.environ.get(
+        "TILES_CONGESTION_OUTPUT", "false").lower() == "true"
+
+    # Also build zoom levels out to this one by downsampling the tiles
+    pyramid_min_zoom = os.environ.get("TILES_PYRAMID_MIN_ZOOM")
+
+    # Get polygon for the city
+    city_id = city_polygon['cityId']
+    assert city_id, ("'cityId' field empty/not found in array"
+                     f"[{polygons_count}] in polygons JSON")
+
+    polygon_string = city_polygon['polygon']
+    assert polygon_string, ("City 'polygon' field empty/not in array"
+                            f"[{polygons_count}] in polygons JSON")
+
+    logging.info(f"Generating tile grid for CityID {city_id}")
+
+    # Get a Shapely polygon object for the polygon string, which is
+    # only parsed again when the city's polygon changes
+    polygon = maputils.get_city_polygon(polygon_string)
+
+    if tiles is None:
+        # Get positions of the tiles that intersect the city polygon
+        tiles = maputils.get_tilecover(polygon, zoom, buffer)
+    elif pyramid_min_zoom:
+        # A chunk's parent tiles would miss the other chunks' tiles
+        logging.info("Tile pyramid skipped for a chunk of CityID "
+                     f"{city_id}, it needs the city's full tile cover")
+        pyramid_min_zoom = None
+
+    # Save results to blob with datetime values as folder path
+    run_time = datetime.utcnow()
+    dt = run_time.timetuple()
+    run_folder = (f"cityId={city_id}/year={dt[0]}/month={dt[1]}"
+                  f"/day={dt[2]}/hour={dt[3]}/minute={dt[4]}/")
+    sinks = tileutils.create_tile_sinks(
+        output_mode, container_url, city_id, run_folder,
+        run_time.isoformat(), polygon, congestion_output,
+        int(pyramid_min_zoom) if pyramid_min_zoom else None)
+    if schedule is not None:
+        # Observes which tiles changed, for the city's next refresh interval
+        churn_tracker = scheduleutils.TileChurnTracker()
+        sinks.append(churn_tracker)
+
+    failed = fetchutils.run_concurrently(
+        functools.partial(fetch_tile, zoom, sinks),
+        tiles, int(city_polygon.get('concurrency', concurrency)))
+    if failed:
+        logging.error(f"{failed} tiles failed for CityID {city_id}")
+
+    for sink in sinks:
+        sink.close()
+
+    if schedule is not None:
+        schedule.record_tiles(city_id, churn_tracker.hashes)
+
+    logging.info(f"Tiles for CityID {city_id} successfully queried"
+                 " & results uploaded to blob storage")
+
+
+def fetch_tile(zoom, sinks, tileX, tileY):
+    """Queries Maps for a traffic tile and passes the image to the sinks"""
+    # Construct tile query
+    query = maputils.construct_tiles_query(zoom, tileX, tileY)
+    logging.info(f"Calling Maps to generate traffic tile, "
+                 f"X:{tileX} Y:{tileY} Zoom:{zoom}")
+    # Query Azure Maps API
+    file = maputils.query_maps(query)
+    if not file:
+        # Raised so the tile is counted as failed, not silently dropped
+        raise Exception(f"No tile from Maps for X:{tileX} Y:{tileY} "
+                        f"Zoom:{zoom}")
+
+    # Output the tile through each of the run's sinks
+    for sink in sinks:
+        sink.add(tileX, tileY, zoom, file)
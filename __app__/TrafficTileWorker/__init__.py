@@ -0,0 +1,32 @@
+# --------------------------------------------------------------
+# Downloads a chunk of traffic tiles for a single city
+#
+# Triggered by work items queued by TrafficTileGenerator in fan-out mode,
+# so cities and tile chunks are processed independently across instances
+#
+# Connection strings in Function App Settings, queue config in function.json
+# --------------------------------------------------------------
+
+import logging
+import azure.functions as func
+from __app__ import TrafficTileGenerator
+from __app__.SharedCode import metricsutils, spoolutils
+
+
+def main(msg: func.QueueMessage) -> None:
+    """Main method triggered by a tile chunk work item on the tiles queue"""
+    work_item = msg.get_json()
+    city_polygon = work_item['city']
+    tiles = [tuple(tile) for tile in work_item['tiles']]
+    logging.info("TrafficTileWorker function initialised for CityID "
+                 f"{city_polygon.get('cityId')}, {len(tiles)} tiles.")
+
+    run_metrics = metricsutils.RunMetrics("TrafficTileWorker")
+    # Start uploading blobs spooled but not uploaded by earlier runs
+    spoolutils.resume()
+    try:
+        with run_metrics.city(city_polygon.get('cityId')):
+            TrafficTileGenerator.process_city(city_polygon, tiles=tiles)
+    finally:
+        spoolutils.drain()
+        run_metrics.emit()
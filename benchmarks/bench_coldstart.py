@@ -0,0 +1,104 @@
+# ----------------------------------------------------------
+# Cold-start benchmark for the timer functions
+# Runs each function in a fresh interpreter against the local service
+# stand-ins, timing its import, its first route or tile & its whole run
+#
+# Run from the repo root: python -m benchmarks.bench_coldstart
+# ----------------------------------------------------------
+
+# Only the standard library is imported up front, as this module is also
+# the fresh interpreter being measured
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import importlib
+import statistics
+import subprocess
+
+
+def measure(module_name, item_function):
+    """Times a function's import, first item & run in this interpreter"""
+    logging.basicConfig(level=logging.CRITICAL)
+    started = time.perf_counter()
+    module = importlib.import_module(f"__app__.{module_name}")
+    imported = time.perf_counter()
+    modules = len(sys.modules)
+
+    first_item = []
+    function = getattr(module, item_function)
+
+    def timed(*args, **kwargs):
+        result = function(*args, **kwargs)
+        first_item.append(time.perf_counter())
+        return result
+    setattr(module, item_function, timed)
+
+    module.main(None)
+    finished = time.perf_counter()
+
+    return {"import": imported - started,
+            "first_item": (min(first_item) if first_item else finished)
+            - imported,
+            "run": finished - imported,
+            "modules": modules}
+
+
+def run(args):
+    from benchmarks import bench_e2e
+
+    services = bench_e2e.local_services(args.routes, qps=1000,
+                                        latency=args.latency,
+                                        settings=args.env)
+    with services as (maps, blob, environment):
+        bench_e2e.store_cities(blob, 1)
+        child_environment = dict(os.environ, **environment)
+
+        print(f"Median of {args.repeat} fresh interpreters, 1 city, "
+              f"Maps latency {args.latency * 1000:.0f} ms")
+        print(f"  {'function':<10} {'process ms':>11} {'import ms':>10} "
+              f"{'first item ms':>14} {'run ms':>8} {'modules':>8}")
+        for function in args.functions:
+            module_name, item_function = bench_e2e.functions[function]
+            samples = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                child = subprocess.run(
+                    [sys.executable, "-m", "benchmarks.bench_coldstart",
+                     "--child", module_name, item_function],
+                    env=child_environment, capture_output=True, check=True,
+                    text=True)
+                result = json.loads(child.stdout.splitlines()[-1])
+                result["process"] = time.perf_counter() - started
+                samples.append(result)
+
+            median = {key: statistics.median(sample[key]
+                                             for sample in samples)
+                      for key in samples[0]}
+            print(f"  {function:<10} {median['process'] * 1000:>11.0f} "
+                  f"{median['import'] * 1000:>10.0f} "
+                  f"{median['first_item'] * 1000:>14.0f} "
+                  f"{median['run'] * 1000:>8.0f} {median['modules']:>8.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the functions' cold starts")
+    parser.add_argument("--functions", nargs="+", default=["routes", "tiles"],
+                        choices=["routes", "tiles"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--routes", type=int, default=5,
+                        help="routes per city")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Maps response latency in seconds")
+    parser.add_argument("--env", nargs="*", default=[],
+                        help="extra NAME=VALUE settings for the functions")
+    parser.add_argument("--child", nargs=2, metavar=("MODULE", "FUNCTION"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(measure(*args.child)))
+    else:
+        run(args)
@@ -0,0 +1,195 @@
+# ----------------------------------------------------------
+# End-to-end throughput benchmark for the timer functions
+# Runs RandomRouteGenerator.main & TrafficTileGenerator.main against
+# local servers emulating Azure Maps, Key Vault & Blob Storage, and
+# reports items/s, p50/p99 latency per item & peak RSS per city count
+#
+# Run from the repo root: python -m benchmarks.bench_e2e
+# ----------------------------------------------------------
+
+import os
+import json
+import time
+import logging
+import argparse
+import tempfile
+import importlib
+import contextlib
+import resource
+import functools
+import multiprocessing
+
+import numpy as np
+from tests.localservers import (
+    LocalMapsServer, LocalKeyVaultServer, LocalBlobServer, create_tls_context)
+
+# Function modules & the per-item function each one fans out to
+functions = {
+    "routes": ("RandomRouteGenerator", "fetch_route"),
+    "tiles": ("TrafficTileGenerator", "fetch_tile"),
+}
+
+
+def create_cities(count, size=0.03, spacing=0.05, per_row=10):
+    """Creates square cities on a grid near London"""
+    cities = []
+    for i in range(count):
+        lat = 51.3 + (i // per_row) * spacing
+        lon = -0.4 + (i % per_row) * spacing
+        corners = [(lat, lon), (lat + size, lon), (lat + size, lon + size),
+                   (lat, lon + size), (lat, lon)]
+        cities.append({"cityId": str(i + 1),
+                       "polygon": ", ".join(f"{x} {y}" for x, y in corners)})
+    return cities
+
+
+def timed(function, latencies):
+    """Wraps a function to record how long each call takes"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def run_scenario(function, environment, verbose, results):
+    """Runs a function's main once in this (fresh) process"""
+    logging.basicConfig(level=logging.INFO if verbose else logging.CRITICAL)
+    # The functions read their configuration at import time
+    os.environ.update(environment)
+    module_name, item_function = functions[function]
+    module = importlib.import_module(f"__app__.{module_name}")
+
+    latencies = []
+    setattr(module, item_function,
+            timed(getattr(module, item_function), latencies))
+
+    error = None
+    start = time.perf_counter()
+    try:
+        module.main(None)
+    except Exception as ex:
+        error = str(ex)
+    elapsed = time.perf_counter() - start
+
+    results.put({
+        "items": len(latencies),
+        "seconds": elapsed,
+        "p50": float(np.percentile(latencies, 50)) if latencies else 0,
+        "p99": float(np.percentile(latencies, 99)) if latencies else 0,
+        # Linux reports the peak resident set size in KiB
+        "peak_rss_mb": resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "error": error,
+    })
+
+
+@contextlib.contextmanager
+def local_services(routes, qps, latency=0, blob_latency=0, error_rate=0,
+                   throttle_rate=0, retry_after=0, settings=()):
+    """Starts the local servers, yielding them & the functions' settings"""
+    tls_context, cert_path = create_tls_context(tempfile.mkdtemp())
+    faults = {"latency": latency, "error_rate": error_rate,
+              "throttle_rate": throttle_rate, "retry_after": retry_after,
+              "seed": 1}
+
+    with LocalMapsServer(**faults) as maps, \
+            LocalKeyVaultServer({"mapskey": "local-key"},
+                                tls_context=tls_context) as vault, \
+            LocalBlobServer(latency=blob_latency,
+                            tls_context=tls_context) as blob:
+        environment = {
+            "AZURE_MAPS_ENDPOINT": maps.endpoint,
+            "KEY_VAULT": vault.endpoint,
+            "IDENTITY_ENDPOINT": vault.identity_endpoint,
+            "IDENTITY_HEADER": "local",
+            "REQUESTS_CA_BUNDLE": cert_path,
+            "CITIES_CONFIG_URL": blob.container_url("config")
+            + "/cities.json",
+            "TRAFFICROUTES_OUTPUT_URL": blob.container_url("routes"),
+            "TRAFFICTILES_OUTPUT_URL": blob.container_url("tiles"),
+            "NUM_OF_ROUTES_PER_CITY": str(routes),
+            "MAPS_QPS": str(qps),
+        }
+        environment.update(setting.split("=", 1) for setting in settings)
+        yield maps, blob, environment
+
+
+def store_cities(blob, count):
+    """Empties the blob server and stores a config of `count` cities"""
+    # Each scenario starts from empty storage, as runs in the same minute
+    # write to the same folders
+    blob.blobs.clear()
+    blob.put(f"/{blob.account}/config/cities.json",
+             json.dumps(create_cities(count)).encode("utf-8"))
+
+
+def run(args):
+    context = multiprocessing.get_context("spawn")
+    services = local_services(
+        args.routes, args.qps, args.latency, args.blob_latency,
+        args.error_rate, args.throttle_rate, args.retry_after, args.env)
+
+    with services as (maps, blob, environment):
+        print(f"Maps latency {args.latency * 1000:.0f} ms, error rate "
+              f"{args.error_rate:.0%}, 429 rate {args.throttle_rate:.0%}, "
+              f"{args.routes} routes per city")
+        for function in args.functions:
+            print(f"\n{function}")
+            print(f"  {'cities':>6} {'items':>7} {'items/s':>9} "
+                  f"{'p50 ms':>8} {'p99 ms':>8} {'429s':>6} {'5xx':>6} "
+                  f"{'RSS MB':>8}")
+            for count in args.cities:
+                store_cities(blob, count)
+                maps.statuses.clear()
+
+                results = context.Queue()
+                process = context.Process(
+                    target=run_scenario,
+                    args=(function, environment, args.verbose, results))
+                process.start()
+                result = results.get()
+                process.join()
+
+                rate = result["items"] / result["seconds"]
+                errors = sum(n for status, n in maps.statuses.items()
+                             if status >= 500)
+                print(f"  {count:>6} {result['items']:>7} {rate:>9.1f} "
+                      f"{result['p50'] * 1000:>8.1f} "
+                      f"{result['p99'] * 1000:>8.1f} "
+                      f"{maps.statuses[429]:>6} {errors:>6} "
+                      f"{result['peak_rss_mb']:>8.1f}"
+                      + (f"  failed: {result['error']}"
+                         if result["error"] else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the functions end to end against local "
+                    "Maps, Key Vault & Blob Storage servers")
+    parser.add_argument("--functions", nargs="+", choices=list(functions),
+                        default=list(functions))
+    parser.add_argument("--cities", type=int, nargs="+",
+                        default=[1, 10, 100])
+    parser.add_argument("--routes", type=int, default=20,
+                        help="routes per city")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Maps response latency in seconds")
+    parser.add_argument("--blob-latency", type=float, default=0.005,
+                        help="Blob Storage response latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="fraction of Maps requests failing with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0,
+                        help="fraction of Maps requests throttled with 429")
+    parser.add_argument("--retry-after", type=float, default=0,
+                        help="Retry-After seconds sent with each 429")
+    parser.add_argument("--qps", type=float, default=1000,
+                        help="MAPS_QPS for the functions")
+    parser.add_argument("--env", nargs="*", default=[],
+                        help="extra NAME=VALUE settings for the functions")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the functions' logs")
+    run(parser.parse_args())
@@ -0,0 +1,77 @@
+# ----------------------------------------------------------
+# Benchmark for Web-Mercator tile & pixel projection in maputils
+# Compares the original per-coordinate math implementation with the
+# vectorized NumPy projection over a large batch of points
+#
+# Run from the repo root: python -m benchmarks.bench_mercator
+# ----------------------------------------------------------
+
+import os
+import math
+import time
+import argparse
+
+# maputils reads its configuration from the environment at import time
+for setting, default in (("KEY_VAULT", "https://bench.vault.invalid/"),
+                         ("AZURE_MAPS_ENDPOINT", "https://bench.invalid/"),
+                         ("NUM_OF_ROUTES_PER_CITY", "100")):
+    os.environ.setdefault(setting, default)
+
+import numpy as np  # noqa: E402
+from __app__.SharedCode import maputils  # noqa: E402
+
+
+def legacy_global_pixel(position, zoom, tile_size):
+    """The original scalar projection using math, kept for comparison"""
+    clip = maputils.clip
+    latitude = clip(position[1], maputils.min_latitude, maputils.max_latitude)
+    longitude = clip(position[0], maputils.min_longitude,
+                     maputils.max_longitude)
+    x = (longitude + 180) / 360
+    sin_latitude = math.sin(latitude * math.pi / 180)
+    y = 0.5 - math.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * math.pi)
+    map_size = maputils.get_map_size(zoom, tile_size)
+    return (clip(x * map_size + 0.5, 0, map_size - 1),
+            clip(y * map_size + 0.5, 0, map_size - 1))
+
+
+def run(num_points, zoom):
+    rng = np.random.default_rng(0)
+    # Points scattered over the London bounding box
+    longitudes = rng.uniform(-0.54, 0.36, num_points)
+    latitudes = rng.uniform(51.14, 51.91, num_points)
+
+    start = time.perf_counter()
+    legacy = [legacy_global_pixel(position, zoom, maputils.tile_size)
+              for position in zip(longitudes.tolist(), latitudes.tolist())]
+    legacy_tiles = [(math.floor(x / maputils.tile_size),
+                     math.floor(y / maputils.tile_size)) for x, y in legacy]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    projection = maputils.project_positions(longitudes, latitudes, zoom,
+                                            maputils.tile_size)
+    vector_time = time.perf_counter() - start
+
+    legacy = np.asarray(legacy)
+    legacy_tiles = np.asarray(legacy_tiles)
+    pixel_error = max(np.abs(legacy[:, 0] - projection.pixel_x).max(),
+                      np.abs(legacy[:, 1] - projection.pixel_y).max())
+    tiles_match = (np.array_equal(legacy_tiles[:, 0], projection.tile_x)
+                   and np.array_equal(legacy_tiles[:, 1], projection.tile_y))
+
+    print(f"{num_points} points at zoom {zoom}")
+    print(f"  scalar math loop (pixel & tile XY)    {legacy_time:8.3f} s")
+    print(f"  vectorized (pixel, tile XY, quadkeys) {vector_time:8.3f} s"
+          f"  {legacy_time / vector_time:6.1f}x")
+    print(f"  max pixel difference {pixel_error:.3g}, "
+          f"tile XY identical: {tiles_match}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark Web-Mercator projection")
+    parser.add_argument("--points", type=int, default=1000000)
+    parser.add_argument("--zoom", type=int, default=13)
+    args = parser.parse_args()
+    run(args.points, args.zoom)
@@ -0,0 +1,75 @@
+# ----------------------------------------------------------
+# Micro-benchmark for random coordinate sampling in city polygons
+# Compares the original per-point rejection loop with the batched
+# rejection and triangulation samplers in maputils
+#
+# Run from the repo root: python -m benchmarks.bench_sampling
+# ----------------------------------------------------------
+
+import os
+import json
+import timeit
+import argparse
+
+# maputils reads its configuration from the environment at import time
+for setting, default in (("KEY_VAULT", "https://bench.vault.invalid/"),
+                         ("AZURE_MAPS_ENDPOINT", "https://bench.invalid/"),
+                         ("NUM_OF_ROUTES_PER_CITY", "100")):
+    os.environ.setdefault(setting, default)
+
+import numpy as np  # noqa: E402
+from shapely.geometry import Point  # noqa: E402
+from __app__.SharedCode import maputils  # noqa: E402
+
+cities_file = os.path.join(os.path.dirname(__file__), "..",
+                           "sample_cities.json")
+
+
+def legacy_random_coords(city_polygon, num_points):
+    """The original point-at-a-time rejection loop, kept for comparison"""
+    min_lat, min_long, max_lat, max_long = city_polygon.bounds
+    random_coordinates_list = []
+    while len(random_coordinates_list) < num_points:
+        random_coordinate = Point([
+            np.random.uniform(min_lat, max_lat),
+            np.random.uniform(min_long, max_long)
+        ])
+        if (random_coordinate.within(city_polygon)):
+            random_coordinates_list.append(
+                [random_coordinate.x, random_coordinate.y]
+            )
+    return random_coordinates_list
+
+
+def run(num_points, repeat):
+    with open(cities_file) as f:
+        cities = json.load(f)
+
+    samplers = (
+        ("legacy loop", lambda p: legacy_random_coords(p, num_points)),
+        ("batched rejection", lambda p: maputils.get_random_coords(
+            p, num_points, "rejection")),
+        ("triangulation", lambda p: maputils.get_random_coords(
+            p, num_points, "triangulation")),
+    )
+
+    print(f"{num_points} points per city, best of {repeat}")
+    for city in cities:
+        polygon = maputils.create_polygon_from_string(city["polygon"])
+        print(f"\n{city['name']} (cityId {city['cityId']})")
+        baseline = None
+        for name, sampler in samplers:
+            best = min(timeit.repeat(lambda: sampler(polygon),
+                                     number=1, repeat=repeat))
+            baseline = baseline or best
+            print(f"  {name:<18} {best * 1000:10.2f} ms"
+                  f"  {baseline / best:8.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark random coordinate sampling")
+    parser.add_argument("--points", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    run(args.points, args.repeat)
@@ -0,0 +1,93 @@
+# ----------------------------------------------------------
+# Offline evaluation of OD sampling strategies
+# Estimates a synthetic per-city mean route delay many times with each
+# sampler & pairing, and reports the spread of the estimate per route
+# count, so strategies can be compared without paid Maps calls
+#
+# Run from the repo root: python -m benchmarks.eval_sampling
+# ----------------------------------------------------------
+
+import os
+import json
+import argparse
+
+# maputils reads its configuration from the environment at import time
+for setting, default in (("KEY_VAULT", "https://bench.vault.invalid/"),
+                         ("AZURE_MAPS_ENDPOINT", "https://bench.invalid/"),
+                         ("NUM_OF_ROUTES_PER_CITY", "100")):
+    os.environ.setdefault(setting, default)
+
+import numpy as np  # noqa: E402
+from __app__.SharedCode import maputils  # noqa: E402
+
+cities_file = os.path.join(os.path.dirname(__file__), "..",
+                           "sample_cities.json")
+
+strategies = (
+    ("rejection", "sequential"),
+    ("triangulation", "sequential"),
+    ("stratified", "sequential"),
+    ("halton", "sequential"),
+    ("rejection", "banded"),
+    ("stratified", "banded"),
+)
+
+
+def synthetic_delay(polygon, routes):
+    """Delay (s) of routes through a congestion hotspot at the centroid.
+
+    Stands in for the Maps response: delay grows with route length and
+    with how close the route's midpoint passes to the city centre.
+    """
+    origins, destinations = (np.array(side) for side in zip(*routes))
+    centre = np.array(polygon.centroid.coords[0])
+    radius = np.sqrt(polygon.area)
+
+    length = maputils.get_distances_km(origins, destinations)
+    midpoints = (origins + destinations) / 2
+    closeness = np.exp(-(np.linalg.norm(midpoints - centre, axis=1)
+                         / (0.3 * radius)) ** 2)
+
+    return length * 60 * (0.1 + closeness)
+
+
+def estimate(polygon, num_routes, method, pairing, seed):
+    """Estimates the city's mean route delay from one sampled run"""
+    coords = maputils.get_random_coords(polygon, num_routes * 2, method,
+                                        seed=seed)
+    routes = maputils.pair_coords(coords, pairing, seed=seed)
+    return synthetic_delay(polygon, routes).mean()
+
+
+def run(route_counts, trials):
+    with open(cities_file) as f:
+        cities = json.load(f)
+
+    print(f"Std dev of the mean delay estimate over {trials} runs, "
+          "and the variance ratio to rejection/sequential")
+    for city in cities:
+        polygon = maputils.create_polygon_from_string(city["polygon"])
+        print(f"\n{city['name']} (cityId {city['cityId']})")
+        print(f"  {'strategy':<26}" + "".join(
+            f"{count:>18}" for count in route_counts))
+        baseline = {}
+        for method, pairing in strategies:
+            cells = []
+            for count in route_counts:
+                spread = np.std([estimate(polygon, count, method, pairing,
+                                          seed) for seed in range(trials)])
+                baseline.setdefault(count, spread)
+                ratio = (baseline[count] / spread) ** 2 if spread else 0
+                cells.append(f"{spread:10.2f} {ratio:5.2f}x")
+            print(f"  {method + '/' + pairing:<26}" + "".join(
+                f"{cell:>18}" for cell in cells))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Evaluate OD sampling strategies offline")
+    parser.add_argument("--routes", type=int, nargs="+",
+                        default=[25, 50, 100, 200])
+    parser.add_argument("--trials", type=int, default=100)
+    args = parser.parse_args()
+    run(args.routes, args.trials)
@@ -1,6 +1,12 @@
 from __app__.SharedCode.blobutils import (
-    create_blob_client, get_polygonsJSON,
-    upload_results)
+    create_blob_client, create_container_client, get_polygonsJSON,
+    upload_results, upload_if_absent, download_blob, upload_blob,
+    download_blob_with_etag, upload_blob_if_unchanged)
+from azure.core.exceptions import (
+    ResourceNotFoundError, ResourceModifiedError, ResourceExistsError)
+from unittest.mock import Mock
+import pytest
+from tests.conftest import MockStorageStreamDownloader, MockBlobClient
 
 
 def test_create_blob_client():
@@ -15,6 +21,99 @@ def test_get_polygonsJSON(mock_blob):
     assert polygonsJSON["mock_key"] == "mock_value"
 
 
+def test_get_polygonsJSON_cached(mock_blob, mocker):
+    downloads = mocker.spy(MockStorageStreamDownloader, "readall")
+    first = get_polygonsJSON()
+    second = get_polygonsJSON()
+    assert first is second
+    # The second call is answered by a 304 and served from the cache
+    assert downloads.call_count == 1
+
+
+def test_get_polygonsJSON_not_modified_error(mock_blob, mocker):
+    first = get_polygonsJSON()
+    # Newer storage SDKs raise a 304 as a ConditionNotMet error
+    mocker.patch.object(MockBlobClient, "download_blob",
+                        side_effect=ResourceModifiedError(
+                            "Not Modified", response=Mock(status_code=304)))
+    assert get_polygonsJSON() is first
+
+
 def test_upload_results(mock_blob):
     upload_props = upload_results("test", "test", "test")
     assert upload_props["mock_prop_key"] == "mock_prop_value"
+
+
+def test_create_container_client_reused(mock_blob):
+    first = create_container_client("https://teststorage.invalid/a")
+    second = create_container_client("https://teststorage.invalid/a")
+    other = create_container_client("https://teststorage.invalid/b")
+    assert first is second
+    assert first is not other
+
+
+def test_upload_if_absent(mock_blob, mocker):
+    uploads = mocker.spy(MockBlobClient, "upload_blob")
+    assert upload_if_absent("test", "content/ab/abc.png", b"tile")
+    # Known to exist now, so neither checked nor uploaded again
+    assert not upload_if_absent("test", "content/ab/abc.png", b"tile")
+    assert uploads.call_count == 1
+
+
+def test_upload_if_absent_existing(mock_blob, mocker):
+    mocker.patch.object(MockBlobClient, "get_blob_properties",
+                        return_value={"etag": "0x1"})
+    uploads = mocker.spy(MockBlobClient, "upload_blob")
+    assert not upload_if_absent("test", "content/ab/abc.png", b"tile")
+    assert uploads.call_count == 0
+
+
+def test_upload_if_absent_failed(mock_blob, mocker):
+    upload = mocker.patch.object(MockBlobClient, "upload_blob",
+                                 side_effect=Exception("Storage down"))
+    assert not upload_if_absent("test", "content/ab/abc.png", b"tile")
+    # The failed blob isn't taken as stored, so is uploaded next time
+    upload.side_effect = None
+    assert upload_if_absent("test", "content/ab/abc.png", b"tile")
+    assert upload.call_count == 2
+    with pytest.raises(Exception, match="Storage down"):
+        upload.side_effect = Exception("Storage down")
+        upload_if_absent("test", "content/ab/abd.png", b"tile",
+                         raise_errors=True)
+
+
+def test_download_blob(mock_blob, mocker):
+    assert download_blob("https://test/blob") == '{"mock_key": "mock_value"}'
+    mocker.patch.object(MockBlobClient, "download_blob",
+                        side_effect=ResourceNotFoundError("Not found"))
+    assert download_blob("https://test/blob") is None
+
+
+def test_upload_blob(mock_blob):
+    upload_props = upload_blob("https://test/blob", b"data")
+    assert upload_props["mock_prop_key"] == "mock_prop_value"
+
+
+def test_download_blob_with_etag(mock_blob, mocker):
+    assert download_blob_with_etag("https://test/blob") == (
+        '{"mock_key": "mock_value"}', MockBlobClient.etag)
+    mocker.patch.object(MockBlobClient, "download_blob",
+                        side_effect=ResourceNotFoundError("Not found"))
+    assert download_blob_with_etag("https://test/blob") == (None, None)
+
+
+def test_upload_blob_if_unchanged(mock_blob, mocker):
+    uploads = mocker.spy(MockBlobClient, "upload_blob")
+    assert upload_blob_if_unchanged("https://test/blob", b"data", "0x1")
+    assert uploads.call_args[1]["etag"] == "0x1"
+    assert upload_blob_if_unchanged("https://test/blob", b"data", None)
+    assert uploads.call_args[1] == {"overwrite": False}
+
+
+def test_upload_blob_if_unchanged_conflict(mock_blob, mocker):
+    mocker.patch.object(MockBlobClient, "upload_blob",
+                        side_effect=ResourceModifiedError("Changed"))
+    assert not upload_blob_if_unchanged("https://test/blob", b"data", "0x1")
+    mocker.patch.object(MockBlobClient, "upload_blob",
+                        side_effect=ResourceExistsError("Exists"))
+    assert not upload_blob_if_unchanged("https://test/blob", b"data", None)
@@ -0,0 +1,51 @@
+from __app__.SharedCode.fetchutils import (
+    TokenBucket, backoff_delay, retry_after_seconds, run_concurrently)
+from unittest.mock import Mock
+import threading
+import time
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=100, capacity=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # One token up front, then 5 more at 100 per second
+    assert time.monotonic() - start >= 0.04
+
+
+def test_token_bucket_pause():
+    bucket = TokenBucket(rate=1000)
+    bucket.pause(0.05)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.04
+
+
+def test_backoff_delay():
+    for attempt in range(10):
+        assert 0 <= backoff_delay(attempt) <= 30
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds(Mock(headers={"Retry-After": "3"})) == 3
+    assert retry_after_seconds(Mock(headers={})) is None
+    past_date = {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    assert retry_after_seconds(Mock(headers=past_date)) == 0
+    # Waits are capped, however far off the header asks for
+    assert retry_after_seconds(Mock(headers={"Retry-After": "86400"})) == 60
+
+
+def test_run_concurrently():
+    seen = []
+    lock = threading.Lock()
+
+    def work(a, b):
+        if a == 3:
+            raise ValueError("failed item")
+        with lock:
+            seen.append(a + b)
+
+    failures = run_concurrently(work, [(i, i) for i in range(10)], 4)
+    assert failures == 1
+    assert sorted(seen) == [0, 2, 4, 8, 10, 12, 14, 16, 18]
@@ -0,0 +1,84 @@
+from __app__.SharedCode.geometryutils import (
+    compact_route, expand_route, compact_route_file, encode_points,
+    decode_points, get_precision, encode_polyline, decode_polyline)
+import numpy as np
+import pytest
+import copy
+import json
+
+
+def make_route(num_points=200, seed=0):
+    """A route response with a random walk of 5 decimal place points"""
+    random = np.random.default_rng(seed)
+    lat_ints = 5150000 + np.cumsum(random.integers(-40, 40, num_points))
+    lon_ints = -12000 + np.cumsum(random.integers(-40, 40, num_points))
+    points = [{"latitude": latitude, "longitude": longitude}
+              for latitude, longitude in zip((lat_ints / 1e5).tolist(),
+                                             (lon_ints / 1e5).tolist())]
+    return {"routes": [{"summary": {"lengthInMeters": 1000},
+                        "legs": [{"summary": {}, "points": points}]}]}
+
+
+def test_polyline_reference():
+    # The worked example from the encoded polyline algorithm's docs
+    lat_ints = np.array([3850000, 4070000, 4325200])
+    lon_ints = np.array([-12020000, -12095000, -12645300])
+    polyline = encode_polyline(lat_ints, lon_ints)
+    assert polyline == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    latitudes, longitudes = decode_polyline(polyline)
+    assert latitudes.tolist() == lat_ints.tolist()
+    assert longitudes.tolist() == lon_ints.tolist()
+
+
+def test_decode_polyline_empty():
+    latitudes, longitudes = decode_polyline("")
+    assert len(latitudes) == 0 and len(longitudes) == 0
+
+
+@pytest.mark.parametrize("encoding", ["delta", "polyline"])
+def test_compact_route_roundtrip(encoding):
+    route = make_route()
+    compacted = compact_route(copy.deepcopy(route), encoding)
+    leg = compacted["routes"][0]["legs"][0]
+    assert "points" not in leg
+    assert leg["encodedPoints"]["format"] == encoding
+    assert leg["encodedPoints"]["precision"] == 5
+    assert expand_route(compacted) == route
+
+
+def test_compact_route_file():
+    route = make_route()
+    file = json.dumps(route).encode("utf-8")
+    assert compact_route_file(file, "none") is file
+    compacted = compact_route_file(file, "polyline")
+    assert len(compacted) < len(file) / 4
+    assert expand_route(json.loads(compacted)) == route
+
+
+def test_compact_route_inexact():
+    # Points that no precision represents exactly are left as they are
+    route = {"routes": [{"legs": [{"points": [
+        {"latitude": 0.1 + 0.2, "longitude": 1.0}]}]}]}
+    assert compact_route(copy.deepcopy(route), "delta") == route
+
+
+def test_compact_route_unknown_encoding():
+    with pytest.raises(ValueError):
+        compact_route(make_route(), "gzip")
+    with pytest.raises(ValueError):
+        decode_points({"format": "gzip", "precision": 5})
+
+
+def test_encode_points():
+    points = [{"latitude": 51.5, "longitude": -0.12},
+              {"latitude": 51.25, "longitude": -0.1}]
+    encoded = encode_points(points, "delta")
+    assert encoded == {"format": "delta", "precision": 2,
+                       "latitudes": [5150, -25], "longitudes": [-12, 2]}
+    assert decode_points(encoded) == points
+
+
+def test_get_precision():
+    assert get_precision(np.array([1.0, 2.0])) == 0
+    assert get_precision(np.array([51.50735, -0.1])) == 5
+    assert get_precision(np.array([0.1 + 0.2])) is None
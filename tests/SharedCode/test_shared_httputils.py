@@ -0,0 +1,23 @@
+from __app__.SharedCode import httputils
+from __app__.SharedCode.httputils import (
+    create_session, get_session, get_keepalive_socket_options)
+import socket
+
+
+def test_create_session():
+    session = create_session(pool_size=4)
+    adapter = session.get_adapter("https://atlas.microsoft.com/")
+    assert adapter._pool_maxsize == 4
+
+
+def test_get_session():
+    try:
+        assert get_session("maps") is get_session("maps")
+        assert get_session("maps") is not get_session("storage")
+    finally:
+        httputils.close_sessions()
+
+
+def test_get_keepalive_socket_options():
+    options = get_keepalive_socket_options()
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in options
@@ -1,8 +1,25 @@
 from __app__.SharedCode.maputils import (
     create_polygon_from_string, get_random_coords, construct_routes_query,
+    triangulate_polygon, construct_routes_batch_item, query_maps_batch,
+    get_city_polygon, get_polygon_metrics, positions_to_tile_XY,
+    positions_to_global_pixels, tile_XY_to_quadkey, tiles_XY_to_quadkeys,
+    project_positions, global_pixels_to_positions, get_tile_mask,
+    get_tile_strata, radical_inverse, pair_coords, get_distances_km,
     construct_tiles_query, query_maps, get_tilegrid, position_to_tile_XY,
-    clip, get_map_size, position_to_global_pixel)
+    get_tilecover, tile_XY_to_bounds, global_pixel_to_position,
+    tile_XY_to_parent, clip, get_map_size, position_to_global_pixel)
 from shapely.geometry import Polygon, Point
+from tests.conftest import MockResponse
+from tests.localservers import LocalMapsServer
+from __app__.SharedCode import maputils, secretutils
+from azure.keyvault.secrets import SecretClient
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import math
+import pytest
+import threading
+import requests
+import time
 import os
 
 
@@ -12,6 +29,21 @@ def test_create_polygon_from_string():
     assert polygon.length == 3.4142135623730949
 
 
+def test_get_city_polygon():
+    polygon_string = "0.0 0.0,1.0 1.0,1.0 0.0,0.0 0.0"
+    polygon = get_city_polygon(polygon_string)
+    assert polygon is get_city_polygon(polygon_string)
+    assert polygon.equals(create_polygon_from_string(polygon_string))
+
+
+def test_get_polygon_metrics():
+    polygon = Polygon([(0, 0), (1, 1), (1, 0)])
+    metrics = get_polygon_metrics(polygon.wkb)
+    assert metrics.bounds == (0, 0, 1, 1)
+    assert metrics.area_ratio == 0.5
+    assert metrics is get_polygon_metrics(polygon.wkb)
+
+
 def test_get_random_coords():
     polygon = Polygon([(0, 0), (1, 1), (1, 0)])
     random_coords = get_random_coords(polygon)
@@ -20,6 +52,112 @@ def test_get_random_coords():
         assert coord.within(polygon)
 
 
+def test_get_random_coords_triangulation():
+    # Concave "L" shape where a third of the bounding box is outside
+    polygon = Polygon([(0, 0), (2, 0), (2, 1), (1, 1), (1, 3), (0, 3)])
+    random_coords = get_random_coords(polygon, 500, "triangulation", seed=1)
+    assert len(random_coords) == 500
+    for coord_points in random_coords:
+        assert polygon.intersects(Point(coord_points))
+
+
+def test_get_random_coords_seeded():
+    polygon = Polygon([(0, 0), (1, 1), (1, 0)])
+    first = get_random_coords(polygon, 10, seed=42)
+    second = get_random_coords(polygon, 10, seed=42)
+    assert first == second
+    assert len(first) == 10
+
+
+def test_get_random_coords_stratified():
+    polygon = Polygon([(0, 0), (0.2, 0.2), (0.2, 0)])
+    random_coords = get_random_coords(polygon, 400, "stratified", seed=1)
+    assert len(random_coords) == 400
+    for coord_points in random_coords:
+        assert polygon.intersects(Point(coord_points))
+
+    # Each tile cell gets its share of the points, to within one
+    bounds, areas = get_tile_strata(polygon.wkb, 13)
+    points = np.array(random_coords)
+    counts = [((points[:, 0] >= b[0]) & (points[:, 0] < b[2]) &
+               (points[:, 1] >= b[1]) & (points[:, 1] < b[3])).sum()
+              for b in bounds]
+    expected = areas / areas.sum() * 400
+    assert np.all(np.abs(counts - expected) <= 1)
+
+
+def test_get_random_coords_halton():
+    polygon = Polygon([(0, 0), (2, 0), (2, 1), (1, 1), (1, 3), (0, 3)])
+    random_coords = get_random_coords(polygon, 300, "halton", seed=1)
+    assert len(random_coords) == 300
+    for coord_points in random_coords:
+        assert polygon.intersects(Point(coord_points))
+    assert random_coords == get_random_coords(polygon, 300, "halton", seed=1)
+
+
+def test_get_tile_strata():
+    polygon = Polygon([(0, 0), (0.1, 0.1), (0.1, 0)])
+    bounds, areas = get_tile_strata(polygon.wkb, 13)
+    assert bounds.shape == (len(areas), 4)
+    assert abs(areas.sum() - polygon.area) < 1e-12
+
+
+def test_radical_inverse():
+    assert radical_inverse([1, 2, 3, 4], 2).tolist() == [.5, .25, .75, .125]
+    assert radical_inverse([1, 3], 3).tolist() == [1 / 3, 1 / 9]
+
+
+def test_pair_coords():
+    coords = [[0, 0], [0, 1], [1, 0], [1, 1]]
+    assert pair_coords(coords, "sequential") == [([0, 0], [0, 1]),
+                                                 ([1, 0], [1, 1])]
+    with pytest.raises(ValueError):
+        pair_coords(coords, "unknown")
+
+
+def test_pair_coords_banded():
+    polygon = Polygon([(0, 0), (1, 1), (1, 0)])
+    coords = get_random_coords(polygon, 400, seed=3)
+    routes = pair_coords(coords, "banded", num_bands=4, seed=3)
+    assert len(routes) == 200
+
+    # Every destination used once, and routes spread evenly over the
+    # quartiles of origin to destination distance
+    assert sorted(map(tuple, (d for _, d in routes))) == sorted(
+        map(tuple, coords[200:]))
+    origins, destinations = np.array(coords[:200]), np.array(coords[200:])
+    all_distances = get_distances_km(origins[:, None], destinations[None])
+    edges = np.quantile(all_distances, [0.25, 0.5, 0.75])
+    distances = get_distances_km(*(np.array(side) for side in zip(*routes)))
+    counts = np.bincount(np.searchsorted(edges, distances), minlength=4)
+    assert counts.min() >= 45
+
+
+def test_pair_coords_banded_large(mocker):
+    polygon = Polygon([(0, 0), (1, 1), (1, 0)])
+    coords = get_random_coords(polygon, 10000, seed=4)
+    distances = mocker.spy(maputils, "get_distances_km")
+    routes = pair_coords(coords, "banded", num_bands=4, seed=4)
+
+    # Every destination used once, without a full 5000 x 5000 matrix
+    assert sorted(map(tuple, (d for _, d in routes))) == sorted(
+        map(tuple, coords[5000:]))
+    assert max(result.size for result in distances.spy_return_list) < (
+        5000 ** 2 / 100)
+
+
+def test_get_distances_km():
+    assert get_distances_km([0, 0], [1, 0]) == pytest.approx(111.32)
+    assert get_distances_km([60, 0], [60, 1]) == pytest.approx(55.66)
+
+
+def test_triangulate_polygon():
+    polygon = Polygon([(0, 0), (2, 0), (2, 1), (1, 1), (1, 3), (0, 3)])
+    triangles, areas = triangulate_polygon(polygon.wkb)
+    assert len(triangles) == 4
+    assert abs(areas.sum() - polygon.area) < 1e-9
+
+
 def test_contruct_routes_query(mock_keyvault):
     origin = ["0.2", "0.2"]
     destination = ["0.6", "0.6"]
@@ -31,6 +169,25 @@ def test_contruct_routes_query(mock_keyvault):
         "&traffic=true&computeTravelTimeFor=all")
 
 
+def test_construct_routes_batch_item():
+    item = construct_routes_batch_item(["0.2", "0.2"], ["0.6", "0.6"])
+    assert item == ("?query=0.2,0.2:0.6,0.6"
+                    "&traffic=true&computeTravelTimeFor=all")
+
+
+def test_query_maps_batch(mock_keyvault, monkeypatch):
+    monkeypatch.setattr(maputils, "batch_poll_interval", 0.01)
+    items = [construct_routes_batch_item([0.1, 0.1], [0.2, 0.2]),
+             construct_routes_batch_item([0.3, 0.3], [0.4, 0.4])]
+    with LocalMapsServer(pending_polls=3) as server:
+        monkeypatch.setattr(maputils, "maps_endpoint", server.endpoint)
+        results = query_maps_batch(items)
+    assert [result["statusCode"] for result in results] == [200, 200]
+    # One submit followed by polls until the batch completed
+    assert server.requests[0][0] == "POST"
+    assert len(server.requests) == 5
+
+
 def test_contruct_tiles_query(mock_keyvault):
     query = construct_tiles_query(13, 0, 1)
     assert query == (
@@ -45,12 +202,172 @@ def test_query_maps(mock_response):
     assert result == b'mock data from Maps API'
 
 
+class MockResponse401(MockResponse):
+    status_code = 401
+
+    @staticmethod
+    def raise_for_status():
+        raise requests.exceptions.HTTPError("401 Unauthorized")
+
+
+def test_query_maps_rotated_key(mock_keyvault, monkeypatch):
+    queries = []
+
+    def mock_get(session, query, *args, **kwargs):
+        queries.append(query)
+        if "subscription-key=oldkey" in query:
+            return MockResponse401()
+        return MockResponse()
+
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+    result = query_maps("https://fakeatlas.microsoft.com/query"
+                        "?subscription-key=oldkey&x=1")
+    assert result == b'mock data from Maps API'
+    assert queries[1] == ("https://fakeatlas.microsoft.com/query"
+                          "?subscription-key=kvsecret&x=1")
+
+
+def test_query_maps_rotated_key_concurrent(mock_keyvault, monkeypatch):
+    # Every thread rejected with the old key, but Key Vault is asked once
+    fetches = []
+    get_secret = SecretClient.get_secret
+    monkeypatch.setattr(SecretClient, "get_secret", lambda *args: (
+        fetches.append(args[1]) or get_secret(*args)))
+    secretutils.cached_secrets["mapskey"] = ("oldkey", time.monotonic())
+    # All sent with the old key, each rejected after the last one retried
+    sent = threading.Barrier(8)
+    turn = threading.Lock()
+
+    def mock_get(session, query, *args, **kwargs):
+        if "subscription-key=oldkey" in query:
+            sent.wait()
+            turn.acquire()
+            return MockResponse401()
+        turn.release()
+        return MockResponse()
+
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(query_maps, [
+            "https://fakeatlas.microsoft.com/query?subscription-key=oldkey"
+        ] * 8))
+    assert results == [b'mock data from Maps API'] * 8
+    assert fetches == ["mapskey"]
+
+
+def test_query_maps_forbidden_key(mock_keyvault, monkeypatch):
+    # A key Maps always rejects is only fetched again from Key Vault once
+    fetches = []
+    get_secret = SecretClient.get_secret
+    monkeypatch.setattr(SecretClient, "get_secret", lambda *args: (
+        fetches.append(args[1]) or get_secret(*args)))
+
+    class ForbiddenResponse(MockResponse401):
+        status_code = 403
+
+    monkeypatch.setattr(requests.Session, "get",
+                        lambda *args, **kwargs: ForbiddenResponse())
+    for _ in range(20):
+        assert query_maps(construct_tiles_query(13, 0, 1)) is None
+    assert fetches == ["mapskey"] * 2
+
+
+def test_query_maps_throttled(monkeypatch):
+    class ThrottledResponse(MockResponse):
+        status_code = 429
+        headers = {"Retry-After": "0"}
+
+    throttled = [ThrottledResponse(), ThrottledResponse()]
+    responses = throttled + [MockResponse()]
+    monkeypatch.setattr(requests.Session, "get",
+                        lambda *args, **kwargs: responses.pop(0))
+    result = query_maps("https://fakeatlas.microsoft.com/query")
+    assert result == b'mock data from Maps API'
+    assert not responses
+    # Retried responses give their connections back to the pool
+    assert all(response.closed for response in throttled)
+
+
 def test_get_tilegrid():
     polygon = Polygon([(0, 0), (1, 1), (1, 0)])
     top, bottom, left, right = get_tilegrid(polygon, 13)
     assert (top, bottom, left, right) == (4073, 4096, 4096, 4118)
 
 
+def test_get_tilecover():
+    polygon = Polygon([(0, 0), (1, 1), (1, 0)])
+    tiles = get_tilecover(polygon, 13)
+    # Only tiles touching the triangle, not its whole bounding box
+    assert len(tiles) == 277
+    assert (4096, 4096) in tiles
+    assert (4118, 4096) not in tiles
+    assert len(get_tilecover(polygon, 13, buffer=0.05)) > len(tiles)
+
+
+def test_tile_XY_to_bounds():
+    bottom, left, top, right = tile_XY_to_bounds(4096, 4095, 13, 256)
+    assert (left, bottom) == (0, 0)
+    assert round(right, 6) == 0.043945
+    assert round(top, 6) == 0.043945
+
+
+def test_tile_XY_to_parent():
+    parent, quadrant = tile_XY_to_parent(4097, 4094)
+    assert parent == (2048, 2047) and quadrant == (1, 0)
+    # The child covers the parent's top right quarter
+    bottom, left, top, right = tile_XY_to_bounds(4097, 4094, 13, 256)
+    parent_bounds = tile_XY_to_bounds(*parent, 12, 256)
+    assert (round(left, 9), round(top, 9)) == (
+        round((parent_bounds[1] + parent_bounds[3]) / 2, 9),
+        round(parent_bounds[2], 9))
+    assert round(right, 9) == round(parent_bounds[3], 9)
+    # Quadkeys of a child extend their parent's by one digit
+    assert tile_XY_to_quadkey(4097, 4094, 13)[:-1] == tile_XY_to_quadkey(
+        *parent, 12)
+
+
+def test_global_pixel_to_position():
+    position = global_pixel_to_position((1048576, 1048576), 13, 256)
+    assert position == (0, 0)
+
+
+def test_global_pixels_to_positions():
+    longitudes, latitudes = global_pixels_to_positions(
+        np.array([1048576, 1048576]), np.array([1048576, 1042751]), 13, 256)
+    assert (longitudes[0], latitudes[0]) == (0, 0)
+    assert (longitudes[1], latitudes[1]) == pytest.approx(
+        global_pixel_to_position((1048576, 1042751), 13, 256))
+
+
+def test_get_tile_mask():
+    polygon = Polygon([(0, 0), (1, 1), (1, 0)])
+    # Tile (4096, 4095) is split by the triangle's diagonal
+    mask = get_tile_mask(polygon, 4096, 4095, 13)
+    assert mask.shape == (256, 256)
+    assert mask[0, 0] and not mask[255, 255]
+    assert get_tile_mask(polygon, 4096, 4074, 13).all()
+
+
+def test_get_tile_mask_cached(mocker, monkeypatch):
+    monkeypatch.setattr(maputils, "tile_masks", type(maputils.tile_masks)())
+    monkeypatch.setattr(maputils, "max_mask_polygons", 2)
+    compute = mocker.spy(maputils, "compute_tile_mask")
+    polygons = [Polygon([(0, 0), (1, 1), (1, offset)])
+                for offset in (0, 0.1, 0.2)]
+
+    get_tile_mask(polygons[0], 4096, 4095, 13)
+    get_tile_mask(polygons[0], 4096, 4074, 13)
+    get_tile_mask(polygons[0], 4096, 4095, 13)
+    assert compute.call_count == 2
+    # Tiles inside the polygon don't hold a mask in the cache
+    assert list(maputils.tile_masks[polygons[0].wkb].values())[1] is None
+
+    # Each polygon has its own cache, the least recently used is dropped
+    get_tile_mask(polygons[1], 4096, 4095, 13)
+    get_tile_mask(polygons[2], 4096, 4095, 13)
+    assert list(maputils.tile_masks) == [polygons[1].wkb, polygons[2].wkb]
+
+
 def test_position_to_tile_XY():
     position = position_to_tile_XY((0, 1), 13, 256)
     assert position == (4096, 4073)
@@ -69,3 +386,66 @@ def test_get_map_size():
 def test_position_to_global_pixel():
     position = position_to_global_pixel((0, 1), 13, 256)
     assert position == (1048576.5, 1042750.7820010717)
+
+
+def test_positions_to_tile_XY():
+    tiles_x, tiles_y = positions_to_tile_XY(
+        np.array([0, 0.5]), np.array([1, 0.5]), 13, 256)
+    assert tiles_x.tolist() == [4096, position_to_tile_XY((0.5, 0.5),
+                                                          13, 256)[0]]
+    assert tiles_y.tolist() == [4073, position_to_tile_XY((0.5, 0.5),
+                                                          13, 256)[1]]
+
+
+def test_positions_to_global_pixels():
+    pixels_x, pixels_y = positions_to_global_pixels(
+        np.array([0, 0]), np.array([1, 1]), np.array([13, 12]), 256)
+    assert (pixels_x[0], pixels_y[0]) == (1048576.5, 1042750.7820010717)
+    assert (pixels_x[1], pixels_y[1]) == position_to_global_pixel(
+        (0, 1), 12, 256)
+
+
+def test_positions_to_global_pixels_matches_math():
+    """The NumPy projection against the original scalar math version"""
+    def math_global_pixel(longitude, latitude, zoom, tile_size):
+        latitude = min(max(latitude, maputils.min_latitude),
+                       maputils.max_latitude)
+        sin_latitude = math.sin(latitude * math.pi / 180)
+        x = (longitude + 180) / 360
+        y = 0.5 - math.log((1 + sin_latitude)
+                           / (1 - sin_latitude)) / (4 * math.pi)
+        map_size = math.ceil(tile_size * math.pow(2, zoom))
+        return (min(max(x * map_size + 0.5, 0), map_size - 1),
+                min(max(y * map_size + 0.5, 0), map_size - 1))
+
+    rng = np.random.default_rng(0)
+    longitudes = rng.uniform(-180, 180, 20000)
+    latitudes = rng.uniform(-85, 85, 20000)
+    pixels_x, pixels_y = positions_to_global_pixels(longitudes, latitudes,
+                                                    13, 256)
+    expected = np.array([math_global_pixel(longitude, latitude, 13, 256)
+                         for longitude, latitude in zip(longitudes,
+                                                        latitudes)])
+    # sin & log may differ by an ULP, far below a pixel...
+    assert np.abs(pixels_x - expected[:, 0]).max() < 1e-6
+    assert np.abs(pixels_y - expected[:, 1]).max() < 1e-6
+    # ...so the points fall in the same tiles
+    assert (np.floor(pixels_x / 256) == np.floor(expected[:, 0] / 256)).all()
+    assert (np.floor(pixels_y / 256) == np.floor(expected[:, 1] / 256)).all()
+
+
+def test_tile_XY_to_quadkey():
+    assert tile_XY_to_quadkey(3, 5, 3) == "213"
+
+
+def test_tiles_XY_to_quadkeys():
+    quadkeys = tiles_XY_to_quadkeys([3, 1, 0], [5, 1, 0], [3, 1, 1])
+    assert quadkeys.tolist() == ["213", "3", "0"]
+
+
+def test_project_positions():
+    projection = project_positions([0], [1], 13, 256)
+    assert projection.tile_x.tolist() == [4096]
+    assert projection.tile_y.tolist() == [4073]
+    assert projection.quadkeys.tolist() == [
+        tile_XY_to_quadkey(4096, 4073, 13)]
@@ -0,0 +1,82 @@
+from __app__.SharedCode.metricsutils import (
+    timer, record, count, snapshot, difference, RunMetrics, SamplingProfiler)
+from __app__.SharedCode import metricsutils
+import json
+import time
+
+
+def test_timer():
+    before = snapshot()
+    with timer("test_stage"):
+        time.sleep(0.01)
+    with timer("test_stage"):
+        pass
+    stage = difference(snapshot(), before)["stages"]["test_stage"]
+    assert stage["calls"] == 2
+    assert stage["seconds"] >= 0.01
+
+
+def test_record():
+    before = snapshot()
+    record("test_record", 1.5, calls=3)
+    assert difference(snapshot(), before)["stages"]["test_record"] == {
+        "calls": 3, "seconds": 1.5}
+
+
+def test_count():
+    before = snapshot()
+    count("test_bytes", 10)
+    count("test_bytes", 5)
+    assert difference(snapshot(), before)["counters"] == {"test_bytes": 15}
+
+
+def test_difference():
+    before = {"timers": {"a": (1, 1.0)}, "counters": {"x": 1, "y": 2}}
+    after = {"timers": {"a": (1, 1.0), "b": (2, 0.5)},
+             "counters": {"x": 4, "y": 2}}
+    assert difference(after, before) == {
+        "stages": {"b": {"calls": 2, "seconds": 0.5}},
+        "counters": {"x": 3}}
+
+
+def test_run_metrics(caplog):
+    run_metrics = RunMetrics("TestFunction")
+    with run_metrics.city("1"):
+        count("test_calls", 2)
+    with run_metrics.city("2"):
+        count("test_calls", 3)
+
+    with caplog.at_level("INFO"):
+        metrics = run_metrics.emit()
+
+    assert metrics["function"] == "TestFunction"
+    assert metrics["cities"]["1"]["counters"] == {"test_calls": 2}
+    assert metrics["cities"]["2"]["counters"] == {"test_calls": 3}
+    assert metrics["counters"]["test_calls"] == 5
+    # Logged as a single JSON record
+    logged = [r.getMessage() for r in caplog.records
+              if r.getMessage().startswith("Run metrics: ")]
+    assert len(logged) == 1
+    assert json.loads(logged[0][len("Run metrics: "):]) == metrics
+
+
+def test_run_metrics_profile(monkeypatch):
+    monkeypatch.setattr(metricsutils, "profile_interval", 0.001)
+    run_metrics = RunMetrics("TestFunction")
+    time.sleep(0.05)
+    profile = run_metrics.create_record()["profile"]
+    assert profile["samples"] > 0
+    assert len(profile["functions"]) == metricsutils.profile_top
+    # The sleeping test is on the stack of every sample
+    assert any(name.startswith("test_run_metrics_profile ")
+               for name in run_metrics.profiler.functions)
+
+
+def test_sampling_profiler():
+    profiler = SamplingProfiler(0.001)
+    profiler.start()
+    time.sleep(0.02)
+    profiler.stop()
+    top = profiler.top(5)
+    assert len(top["functions"]) <= 5
+    assert all(0 < share <= 1 for name, share in top["functions"])
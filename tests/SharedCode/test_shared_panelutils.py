@@ -0,0 +1,111 @@
+from __app__.SharedCode.panelutils import (
+    get_od_panel, rotate_panel, sample_routes, get_polygon_hash,
+    get_panel_url, encode_panel, decode_panel)
+from __app__.SharedCode import blobutils, maputils
+from shapely.geometry import Polygon, Point
+import numpy as np
+
+polygon = Polygon([(0, 0), (1, 1), (1, 0)])
+
+
+def mock_panel_store(mocker):
+    """Keeps panel blobs in a dict instead of blob storage"""
+    store = {}
+    mocker.patch('__app__.SharedCode.blobutils.download_blob',
+                 side_effect=store.get)
+    mocker.patch('__app__.SharedCode.blobutils.upload_blob',
+                 side_effect=store.__setitem__)
+    return store
+
+
+def test_get_od_panel(mocker):
+    store = mock_panel_store(mocker)
+
+    first = get_od_panel("1", polygon, 20, rotation=0.25, seed=1)
+    assert len(first) == 20
+    assert list(store) == [get_panel_url("1", get_polygon_hash(polygon))]
+    for origin, destination in first:
+        assert polygon.intersects(Point(origin))
+        assert polygon.intersects(Point(destination))
+
+    # The next run keeps all but the rotated quarter of the pairs
+    second = get_od_panel("1", polygon, 20, rotation=0.25, seed=2)
+    assert second[5:] == first[5:]
+    assert second[:5] != first[:5]
+    third = get_od_panel("1", polygon, 20, rotation=0.25, seed=3)
+    assert third[:5] == second[:5] and third[10:] == first[10:]
+
+
+def test_get_od_panel_seeded_rotations(mocker):
+    mock_panel_store(mocker)
+    get_od_panel("1", polygon, 100, rotation=0.1, seed=7)
+    # Each seeded rotation draws different pairs, so the panel stays diverse
+    for _ in range(10):
+        routes = get_od_panel("1", polygon, 100, rotation=0.1, seed=7)
+    assert len({str(route) for route in routes}) == 100
+
+
+def test_get_od_panel_resampled(mocker):
+    store = mock_panel_store(mocker)
+    get_od_panel("1", polygon, 20, rotation=0, seed=1)
+    # No rotation, so the stored panel is used without writing it back
+    upload = mocker.patch('__app__.SharedCode.blobutils.upload_blob')
+    assert len(get_od_panel("1", polygon, 20, rotation=0)) == 20
+    assert upload.call_count == 0
+
+    # A changed route count or polygon gets a new panel
+    assert len(get_od_panel("1", polygon, 30, rotation=0)) == 30
+    moved = Polygon([(0, 0), (2, 2), (2, 0)])
+    get_od_panel("1", moved, 20, rotation=0)
+    assert upload.call_count == 2
+    assert len(store) == 1
+
+
+def test_get_od_panel_size(mocker):
+    store = mock_panel_store(mocker)
+    first = get_od_panel("1", polygon, 20, rotation=0, seed=1, panel_size=40)
+    # Fewer routes are taken from the start of the same stored panel
+    upload = mocker.patch('__app__.SharedCode.blobutils.upload_blob')
+    second = get_od_panel("1", polygon, 10, rotation=0, panel_size=40)
+    assert len(first) == 20 and second == first[:10]
+    assert upload.call_count == 0
+    assert len(decode_panel(next(iter(store.values())))["routes"]) == 40
+
+
+def test_rotate_panel():
+    panel = {"routes": np.zeros((10, 2, 2)), "cursor": 8}
+    rng = maputils.get_rng(0)
+    assert rotate_panel(panel, polygon, 0.3, rng) == 3
+    assert panel["cursor"] == 1
+    assert panel["rotations"] == 1
+    replaced = panel["routes"].any(axis=(1, 2))
+    assert np.flatnonzero(replaced).tolist() == [0, 8, 9]
+
+
+def test_sample_routes():
+    routes = sample_routes(polygon, 5, maputils.get_rng(0))
+    assert routes.shape == (5, 2, 2)
+
+
+def test_get_polygon_hash():
+    assert get_polygon_hash(polygon) == get_polygon_hash(
+        Polygon([(0, 0), (1, 1), (1, 0)]))
+    assert len(get_polygon_hash(polygon)) == 16
+
+
+def test_get_panel_url(monkeypatch):
+    monkeypatch.setattr(
+        blobutils, "cities_config_url",
+        "https://account.blob.core.windows.net/config/cities.json")
+    assert get_panel_url("25", "abc") == (
+        "https://account.blob.core.windows.net/config/panels/cityId=25/"
+        "od.abc.npz")
+
+
+def test_encode_panel():
+    panel = {"routes": np.arange(8, dtype=np.float64).reshape(2, 2, 2),
+             "cursor": 1, "rotations": 3}
+    decoded = decode_panel(encode_panel(panel))
+    assert decoded["routes"].tolist() == panel["routes"].tolist()
+    assert decoded["cursor"] == 1
+    assert decoded["rotations"] == 3
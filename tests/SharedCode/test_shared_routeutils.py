@@ -0,0 +1,147 @@
+from __app__.SharedCode.routeutils import (
+    RouteFileSink, RouteSummarySink, RouteNdjsonSink, create_summary_row,
+    to_datetime64,
+    create_route_sinks)
+from __app__.SharedCode import routeutils
+from tests.localservers import fake_route
+from datetime import datetime
+import numpy as np
+import base64
+import json
+import pytest
+import gzip
+import io
+
+
+def test_route_file_sink(mocker):
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+    sink = RouteFileSink("https://teststorage.invalid/routes", "cityId=1/")
+    sink.add([0, 0], [1, 1], datetime(2020, 2, 11), b'{"routes": []}')
+    sink.add([0, 0], [1, 1], datetime(2020, 2, 11), b'{"routes": []}')
+    names = [call[0][1] for call in m.call_args_list]
+    assert names == ["cityId=1/1.json.gz", "cityId=1/2.json.gz"]
+    assert gzip.decompress(m.call_args[0][2]) == b'{"routes": []}'
+
+
+def test_route_summary_sink(mocker):
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+    sink = RouteSummarySink("https://teststorage.invalid/routes", "cityId=1/")
+    for origin, dest in (([0.1, 0.1], [0.2, 0.2]), ([0.3, 0.3], [0.5, 0.5])):
+        route = fake_route(f"{origin[0]},{origin[1]}:{dest[0]},{dest[1]}")
+        sink.add(origin, dest, datetime(2020, 2, 11, 11, 37),
+                 json.dumps(route).encode("utf-8"))
+    sink.add([0, 0], [1, 1], datetime(2020, 2, 11), b'not json')
+    sink.close()
+
+    (container_url, file_name, data), _ = m.call_args
+    assert file_name == "cityId=1/summary.npy"
+    summaries = np.load(io.BytesIO(data))
+    assert len(summaries) == 2
+    assert summaries["destinationLatitude"].tolist() == [0.2, 0.5]
+    assert (summaries["travelTimeInSeconds"] >=
+            summaries["noTrafficTravelTimeInSeconds"]).all()
+
+
+def test_route_ndjson_sink(mocker, monkeypatch):
+    blocks = {}
+    staged = mocker.patch('__app__.SharedCode.blobutils.stage_block',
+                          side_effect=lambda url, name, block_id, data:
+                          blocks.__setitem__(block_id, data))
+    commit = mocker.patch('__app__.SharedCode.blobutils.commit_blocks')
+    monkeypatch.setattr(routeutils, "ndjson_block_size", 100)
+
+    sink = RouteNdjsonSink("https://teststorage.invalid/routes", "cityId=1/")
+    for number in range(20):
+        route = json.dumps({"number": number, "routes": []}, indent=2)
+        chunks = [route.encode("utf-8")[i:i + 7]
+                  for i in range(0, len(route), 7)]
+        sink.add_stream([0, 0], [1, 1], datetime(2020, 2, 11), chunks)
+    sink.close()
+
+    # Small blocks are staged as routes arrive, then committed in order
+    assert staged.call_count > 1
+    (container_url, file_name, block_ids), _ = commit.call_args
+    assert file_name == "cityId=1/routes.ndjson.gz"
+    lines = gzip.decompress(
+        b"".join(blocks[block_id] for block_id in block_ids)).splitlines()
+    assert [json.loads(line)["number"] for line in lines] == list(range(20))
+
+
+def mock_stage_block(mocker, failing):
+    """Stages blocks in memory, failing while `failing` holds their number"""
+    blocks = {}
+
+    def stage_block(url, name, block_id, data):
+        if int(base64.b64decode(block_id)) in failing:
+            raise Exception("Storage unavailable")
+        blocks[block_id] = data
+
+    mocker.patch('time.sleep')
+    mocker.patch('__app__.SharedCode.blobutils.stage_block',
+                 side_effect=stage_block)
+    return blocks
+
+
+def add_numbered_routes(sink, count):
+    for number in range(count):
+        sink.add([0, 0], [1, 1], datetime(2020, 2, 11),
+                 json.dumps({"number": number}).encode("utf-8"))
+
+
+def read_committed(commit, blocks):
+    (container_url, file_name, block_ids), _ = commit.call_args
+    lines = gzip.decompress(
+        b"".join(blocks[block_id] for block_id in block_ids)).splitlines()
+    return [json.loads(line)["number"] for line in lines]
+
+
+def test_route_ndjson_sink_stage_failure(mocker, monkeypatch):
+    failing = {1, 2}
+    blocks = mock_stage_block(mocker, failing)
+    commit = mocker.patch('__app__.SharedCode.blobutils.commit_blocks')
+    monkeypatch.setattr(routeutils, "ndjson_block_size", 1)
+
+    sink = RouteNdjsonSink("https://teststorage.invalid/routes", "cityId=1/")
+    add_numbered_routes(sink, 4)
+    # Storage recovers before the run closes, the failed blocks are kept
+    failing.clear()
+    sink.close()
+    assert read_committed(commit, blocks) == [0, 1, 2, 3]
+
+
+def test_route_ndjson_sink_stage_lost(mocker, monkeypatch):
+    blocks = mock_stage_block(mocker, {1})
+    commit = mocker.patch('__app__.SharedCode.blobutils.commit_blocks')
+    # Blocks of two routes each
+    monkeypatch.setattr(routeutils, "ndjson_block_size", 50)
+
+    sink = RouteNdjsonSink("https://teststorage.invalid/routes", "cityId=1/")
+    add_numbered_routes(sink, 6)
+    # Every route of the block that never stages is reported lost
+    with pytest.raises(Exception, match="2 routes could not be staged"):
+        sink.close()
+    assert read_committed(commit, blocks) == [0, 1, 4, 5]
+
+
+def test_create_summary_row():
+    route = {"routes": [{"summary": {"lengthInMeters": 1000,
+                                     "departureTime":
+                                     "2020-02-11T12:37:00+01:00"}}]}
+    row = create_summary_row([1, 2], [3, 4], datetime(2020, 2, 11), route)
+    assert row[:4] == (1.0, 2.0, 3.0, 4.0)
+    assert row[5] == np.datetime64("2020-02-11T11:37:00")
+    assert np.isnat(row[6])
+    assert row[7:9] == (1000, -1)
+
+
+def test_to_datetime64():
+    assert (to_datetime64("2020-02-11T11:37:00+00:00") ==
+            np.datetime64("2020-02-11T11:37:00"))
+    assert np.isnat(to_datetime64(None))
+
+
+def test_create_route_sinks():
+    assert len(create_route_sinks("url", "f/")) == 1
+    sinks = create_route_sinks("url", "f/", "ndjson", summary_output=True)
+    assert isinstance(sinks[0], RouteNdjsonSink)
+    assert isinstance(sinks[1], RouteSummarySink)
@@ -0,0 +1,144 @@
+from __app__.SharedCode.scheduleutils import (
+    Schedule, RouteDelayTracker, TileChurnTracker, plan_routes, allocate,
+    record_routes, plan_tiles, record_tiles, smooth, get_state_url,
+    get_audit_url)
+from datetime import datetime, timedelta
+import json
+
+now = datetime(2020, 2, 11, 3, 0)
+
+
+def test_plan_routes():
+    state = {"cities": {"1": {"delay_std": 300.0}, "2": {"delay_std": 100.0},
+                        "3": {"delay_std": 0.0}}}
+    decisions = plan_routes(state, ["1", "2", "3", "4"], 100)
+    # Shared by delay spread, new cities as the most variable one, and
+    # quiet cities kept at the minimum
+    assert {city: decision["num_routes"] for city, decision
+            in decisions.items()} == {"1": 167, "2": 55, "3": 10, "4": 167}
+    assert decisions["4"]["reason"] == "no history"
+    assert decisions["2"]["reason"] == "delay spread 100.0 s"
+
+
+def test_plan_routes_bounded():
+    state = {"cities": {"1": {"delay_std": 300.0}, "2": {"delay_std": 100.0},
+                        "3": {"delay_std": 0.0}}}
+    decisions = plan_routes(state, [1, 2, 3, 4], 100, budget=400,
+                            maximum=150)
+    assert [decision["num_routes"] for decision
+            in decisions.values()] == [150, 90, 10, 150]
+
+
+def test_allocate():
+    assert allocate({"a": 1, "b": 1}, 100, 10, 100) == {"a": 50, "b": 50}
+    assert allocate({"a": 9, "b": 1}, 100, 20, 100) == {"a": 80, "b": 20}
+    assert allocate({"a": 0, "b": 0}, 10, 0, 100) == {"a": 5, "b": 5}
+    # The minimum is kept over the budget
+    assert allocate({"a": 1, "b": 1}, 10, 10, 100) == {"a": 10, "b": 10}
+
+
+def test_record_routes():
+    state = {"cities": {}}
+    observation = record_routes(state, 1, [10, 20, 30], now)
+    assert observation == {"routes": 3, "delay_std": 10.0}
+    assert state["cities"]["1"]["delay_std"] == 10.0
+    record_routes(state, 1, [0, 40, 80], now)
+    assert state["cities"]["1"]["delay_std"] == smooth(10.0, 40.0)
+    # Too few routes to measure a spread leave it as it was
+    record_routes(state, 1, [5], now)
+    assert state["cities"]["1"]["delay_std"] == smooth(10.0, 40.0)
+
+
+def test_plan_tiles():
+    state = {"cities": {
+        "1": {"last_run": (now - timedelta(minutes=15)).isoformat(),
+              "interval": 60},
+        "2": {"last_run": (now - timedelta(minutes=60)).isoformat(),
+              "interval": 60},
+        "3": {"last_run": (now - timedelta(minutes=30)).isoformat(),
+              "interval": 15}}}
+    decisions = plan_tiles(state, {1: 10, 2: 50, 3: 40, 4: 30}, now,
+                           budget=100)
+    assert decisions["1"]["collect"] is False
+    assert decisions["1"]["reason"] == "due in 45 min"
+    # City 4 has no history and 3 is the most overdue, leaving no room for
+    # the 50 tiles of city 2
+    assert decisions["4"]["collect"] and decisions["3"]["collect"]
+    assert decisions["2"]["collect"] is False
+    assert decisions["2"]["reason"].startswith("deferred")
+
+
+def test_plan_tiles_over_budget():
+    state = {"cities": {
+        "1": {"last_run": (now - timedelta(minutes=60)).isoformat(),
+              "interval": 15},
+        "2": {"last_run": (now - timedelta(minutes=30)).isoformat(),
+              "interval": 15}}}
+    # City 1 alone is over the budget, but is collected as the most overdue
+    decisions = plan_tiles(state, {1: 500, 2: 50}, now, budget=100)
+    assert decisions["1"]["collect"]
+    assert decisions["1"]["reason"].endswith("over budget as the most "
+                                             "overdue city")
+    assert decisions["2"]["collect"] is False
+
+
+def test_record_tiles():
+    state = {"cities": {}}
+    record_tiles(state, 1, {"0,0": "a", "0,1": "b"}, now)
+    assert state["cities"]["1"]["interval"] == 15
+
+    # Unchanged tiles stretch the interval, up to the maximum
+    for _ in range(4):
+        observation = record_tiles(state, 1, {"0,0": "a", "0,1": "b"}, now)
+    assert observation == {"tiles": 2, "churn": 0.0, "interval": 120}
+
+    # Churning tiles shorten it again
+    record_tiles(state, 1, {"0,0": "c", "0,1": "d"}, now)
+    assert state["cities"]["1"]["churn"] == smooth(0.0, 1.0)
+    assert state["cities"]["1"]["interval"] == 60
+
+    # Tiles missing from a run keep their last hash
+    record_tiles(state, 1, {"0,0": "e"}, now)
+    assert state["cities"]["1"]["tiles"] == {"0,0": "e", "0,1": "d"}
+
+
+def test_route_delay_tracker():
+    tracker = RouteDelayTracker()
+    route = {"routes": [{"summary": {"trafficDelayInSeconds": 42}}]}
+    tracker.add((0, 0), (1, 1), now, json.dumps(route).encode("utf-8"))
+    tracker.add((0, 0), (1, 1), now, b'{"error": "no route"}')
+    assert tracker.delays == [42.0]
+
+
+def test_tile_churn_tracker():
+    tracker = TileChurnTracker()
+    tracker.add(1, 2, 13, b"tile")
+    tracker.add(1, 3, 13, b"tile")
+    assert list(tracker.hashes) == ["1,2", "1,3"]
+    assert len(tracker.hashes["1,2"]) == 8
+
+
+def test_schedule(mocker):
+    store = {}
+    mocker.patch('__app__.SharedCode.blobutils.download_blob',
+                 side_effect=store.get)
+    mocker.patch('__app__.SharedCode.blobutils.upload_blob',
+                 side_effect=store.__setitem__)
+
+    schedule = Schedule("RandomRouteGenerator", now)
+    schedule.plan_routes(["1"], 100)
+    assert schedule.get_num_routes("1") == 100
+    schedule.record_routes("1", [10, 20, 30])
+    schedule.save()
+
+    state_url = get_state_url("RandomRouteGenerator")
+    audit_url = get_audit_url("RandomRouteGenerator", now)
+    assert set(store) == {state_url, audit_url}
+    assert audit_url.endswith("schedule/audit/RandomRouteGenerator/year=2020/"
+                              "month=2/day=11/hour=3/minute=0/decisions.json")
+    audit = json.loads(store[audit_url])
+    assert audit["cities"]["1"]["observed"]["delay_std"] == 10.0
+
+    # The next run starts from the saved state
+    assert Schedule("RandomRouteGenerator", now).state == json.loads(
+        store[state_url])
@@ -0,0 +1,64 @@
+from __app__.SharedCode import secretutils
+from __app__.SharedCode.secretutils import (
+    get_secret, invalidate_secret, get_cache_stats)
+import time
+
+
+def test_get_secret_cached(mock_keyvault):
+    assert get_secret("mapskey") == "kvsecret"
+    assert get_secret("mapskey") == "kvsecret"
+    stats = get_cache_stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 1
+
+
+def test_get_secret_expired(mock_keyvault, monkeypatch):
+    get_secret("mapskey")
+    monkeypatch.setattr(secretutils, "secret_ttl", 0)
+    get_secret("mapskey")
+    assert get_cache_stats()["misses"] == 2
+
+
+def test_get_secret_background_refresh(mock_keyvault, monkeypatch):
+    get_secret("mapskey")
+    monkeypatch.setattr(secretutils, "refresh_after", 0)
+    assert get_secret("mapskey") == "kvsecret"
+    for _ in range(100):
+        if get_cache_stats()["refreshes"]:
+            break
+        time.sleep(0.01)
+    assert get_cache_stats()["refreshes"] == 1
+
+
+def test_invalidate_secret(mock_keyvault):
+    get_secret("mapskey")
+    invalidate_secret("mapskey")
+    get_secret("mapskey")
+    stats = get_cache_stats()
+    assert stats["invalidations"] == 1
+    assert stats["misses"] == 2
+
+
+def test_invalidate_secret_rejected(mock_keyvault):
+    get_secret("mapskey")
+    # A value rejected before the secret was refetched doesn't drop it
+    invalidate_secret("mapskey", "oldkey")
+    get_secret("mapskey")
+    invalidate_secret("mapskey", "kvsecret")
+    get_secret("mapskey")
+    stats = get_cache_stats()
+    assert stats["invalidations"] == 1
+    assert stats["misses"] == 2
+
+
+def test_invalidate_secret_rejected_again(mock_keyvault, monkeypatch):
+    get_secret("mapskey")
+    invalidate_secret("mapskey", "kvsecret")
+    # Key Vault gives back the rejected value, so it's kept until expiry
+    get_secret("mapskey")
+    invalidate_secret("mapskey", "kvsecret")
+    get_secret("mapskey")
+    assert get_cache_stats()["misses"] == 2
+    monkeypatch.setattr(secretutils, "secret_ttl", 0)
+    invalidate_secret("mapskey", "kvsecret")
+    assert get_cache_stats()["invalidations"] == 2
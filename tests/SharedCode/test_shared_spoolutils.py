@@ -0,0 +1,184 @@
+from __app__.SharedCode import spoolutils
+from __app__.SharedCode.spoolutils import (
+    Spool, SpoolSegment, load_segment, read_lines, write_results)
+from azure.core.exceptions import ResourceExistsError
+import threading
+import pytest
+import glob
+import os
+
+
+def mock_store(mocker):
+    """Keeps uploaded blobs in a dict instead of blob storage"""
+    store = {}
+
+    def upload_results(container_url, file_name, results,
+                       raise_errors=False):
+        store[(container_url, file_name)] = results
+
+    mocker.patch('__app__.SharedCode.blobutils.upload_results',
+                 side_effect=upload_results)
+    mocker.patch('__app__.SharedCode.fetchutils.backoff_delay',
+                 return_value=0)
+    return store
+
+
+def test_spool_flushes(mocker, tmp_path):
+    store = mock_store(mocker)
+    spool = Spool(str(tmp_path), segment_size=10)
+    for i in range(5):
+        spool.write("https://test/routes", f"{i}.json.gz", b"route %d" % i)
+    assert spool.drain(timeout=10) == 0
+    spool.close()
+
+    assert store == {("https://test/routes", f"{i}.json.gz"): b"route %d" % i
+                     for i in range(5)}
+    # Every segment was deleted once its blobs were uploaded
+    assert not glob.glob(os.path.join(spool.directory, "*.seg"))
+
+
+def test_spool_retries(mocker, tmp_path):
+    mock_store(mocker)
+    upload = mocker.patch('__app__.SharedCode.blobutils.upload_results',
+                          side_effect=[Exception("unavailable"), None])
+    spool = Spool(str(tmp_path), retries=3)
+    spool.write("https://test/tiles", "map.png", b"tile")
+    assert spool.drain(timeout=10) == 0
+    spool.close()
+    assert upload.call_count == 2
+
+
+def test_spool_already_uploaded(mocker, tmp_path):
+    mock_store(mocker)
+    mocker.patch('__app__.SharedCode.blobutils.upload_results',
+                 side_effect=ResourceExistsError("The blob already exists"))
+    spool = Spool(str(tmp_path), retries=3)
+    spool.write("https://test/tiles", "map.png", b"tile")
+    assert spool.drain(timeout=10) == 0
+    spool.close()
+
+
+def test_spool_resumed(mocker, tmp_path):
+    store = mock_store(mocker)
+    mocker.patch('__app__.SharedCode.blobutils.upload_results',
+                 side_effect=Exception("unavailable"))
+    first = Spool(str(tmp_path), retries=1)
+    first.write("https://test/routes", "1.json.gz", b"first")
+    first.write("https://test/routes", "2.json.gz", b"second")
+    assert first.drain(timeout=10) == 2
+    # Failed blobs stay on disk for the process that ends without them
+    first.close()
+
+    store = mock_store(mocker)
+    second = Spool(str(tmp_path))
+    assert second.drain(timeout=10) == 0
+    second.close()
+    assert store == {("https://test/routes", "1.json.gz"): b"first",
+                     ("https://test/routes", "2.json.gz"): b"second"}
+    # The adopted spool's directory is gone, leaving only the new spool's
+    assert os.listdir(str(tmp_path)) == [os.path.basename(second.directory)]
+
+
+def test_spool_resume_failed(mocker, tmp_path):
+    mock_store(mocker)
+    upload = mocker.patch('__app__.SharedCode.blobutils.upload_results',
+                          side_effect=[Exception("unavailable"), None])
+    spool = Spool(str(tmp_path), retries=1)
+    spool.write("https://test/routes", "1.json.gz", b"route")
+    assert spool.drain(timeout=10) == 1
+    spool.resume()
+    assert spool.drain(timeout=10) == 0
+    spool.close()
+    assert upload.call_count == 2
+
+
+def test_spool_if_absent(mocker, tmp_path):
+    mock_store(mocker)
+    upload = mocker.patch('__app__.SharedCode.blobutils.upload_if_absent')
+    spool = Spool(str(tmp_path))
+    spool.write("https://test/tiles", "content/ab/abc.png", b"tile",
+                if_absent=True)
+    assert spool.drain(timeout=10) == 0
+    spool.close()
+    upload.assert_called_once_with("https://test/tiles", "content/ab/abc.png",
+                                   b"tile", raise_errors=True)
+
+
+def test_spool_backpressure(mocker, tmp_path):
+    mock_store(mocker)
+    release = threading.Event()
+    mocker.patch('__app__.SharedCode.blobutils.upload_results',
+                 side_effect=lambda *args, **kwargs: release.wait())
+    spool = Spool(str(tmp_path), max_pending_bytes=4)
+    spool.write("https://test/routes", "1.json.gz", b"first")
+
+    # The second write waits until the first blob has been flushed
+    writer = threading.Thread(target=spool.write,
+                              args=("https://test/routes", "2.json.gz",
+                                    b"second"))
+    writer.start()
+    writer.join(timeout=0.2)
+    assert writer.is_alive()
+    release.set()
+    writer.join(timeout=10)
+    assert not writer.is_alive()
+    assert spool.drain(timeout=10) == 0
+    spool.close()
+
+
+def test_load_segment(tmp_path):
+    path = str(tmp_path / "00000000")
+    segment = SpoolSegment(path)
+    for i in range(3):
+        segment.append("https://test/routes", f"{i}.json.gz", b"%d" % i)
+    segment.ack(1)
+    segment.close()
+    # A torn index line, as from a crash mid-write, is ignored
+    with open(f"{path}.idx", "a") as index:
+        index.write('{"container_url": ')
+
+    loaded, entries = load_segment(path)
+    assert [number for number, _ in entries] == [0, 2]
+    assert loaded.read(entries[1][1]) == b"2"
+    loaded.remove()
+    assert not os.listdir(str(tmp_path))
+
+
+def test_read_lines(tmp_path):
+    path = str(tmp_path / "acks")
+    assert read_lines(path, int) == []
+    with open(path, "w") as file:
+        file.write("1\n2\n3")
+    assert read_lines(path, int) == [1, 2]
+
+
+def test_write_results(mocker):
+    upload = mocker.patch('__app__.SharedCode.blobutils.upload_results',
+                          return_value={"etag": "0x1"})
+    assert write_results("https://test/tiles", "map.png", b"tile") == {
+        "etag": "0x1"}
+    upload.assert_called_once_with("https://test/tiles", "map.png", b"tile",
+                                   raise_errors=True)
+    # Without the spool a failed upload fails the item that wrote it
+    upload.side_effect = Exception("Storage unavailable")
+    with pytest.raises(Exception, match="Storage unavailable"):
+        write_results("https://test/tiles", "map.png", b"tile")
+
+
+def test_write_results_spooled(mocker, tmp_path):
+    spool = Spool(str(tmp_path))
+    write = mocker.patch.object(spool, "write")
+    mocker.patch.object(spoolutils, "spool_enabled", True)
+    mocker.patch.object(spoolutils, "spool", spool)
+    upload = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    assert write_results("https://test/tiles", "map.png", b"tile") is None
+    write.assert_called_once_with("https://test/tiles", "map.png", b"tile",
+                                  False)
+    assert not upload.called
+
+    # A full disk falls back to uploading directly
+    write.side_effect = OSError("No space left on device")
+    write_results("https://test/tiles", "map.png", b"tile")
+    assert upload.called
+    spool.close()
@@ -0,0 +1,197 @@
+from __app__.SharedCode import blobutils, statsutils
+from __app__.SharedCode.statsutils import (
+    RouteStatsSink, read_route, get_hour_of_week, create_stats,
+    create_measure, add_route, add_value, merge_hour, create_hour_state,
+    get_quantile, describe, get_stats_url, load_stats, save_stats)
+from datetime import datetime
+import numpy as np
+import pytest
+import json
+
+request_time = datetime(2020, 2, 11, 3, 0)
+
+
+def make_measure(values, accuracy=0.02):
+    measure = create_measure()
+    for value in values:
+        add_value(measure, float(value), accuracy)
+    return measure
+
+
+def make_route_file(delay, travel_time=600, length=5000,
+                    departure="2020-02-11T08:37:00+00:00"):
+    summary = {"travelTimeInSeconds": travel_time,
+               "trafficDelayInSeconds": delay, "lengthInMeters": length,
+               "departureTime": departure}
+    return json.dumps({"routes": [{"summary": summary}]}).encode("utf-8")
+
+
+@pytest.fixture
+def stats_store(mocker):
+    """Blob storage holding the stats blobs, with ETags per version"""
+    store = {}
+
+    def download(url):
+        return store.get(url, (None, None))
+
+    def upload(url, data, etag):
+        if store.get(url, (None, None))[1] != etag:
+            return False
+        store[url] = (data, str(int(etag or 0) + 1))
+        return True
+
+    mocker.patch.object(blobutils, "download_blob_with_etag",
+                        side_effect=download)
+    mocker.patch.object(blobutils, "upload_blob_if_unchanged",
+                        side_effect=upload)
+    mocker.patch.object(blobutils, "download_blob",
+                        side_effect=lambda url: download(url)[0])
+    return store
+
+
+def test_moments():
+    values = np.random.default_rng(0).gamma(2, 100, 1000)
+    description = describe(make_measure(values), 0.02)
+    assert description["count"] == 1000
+    assert description["mean"] == pytest.approx(values.mean())
+    assert description["std"] == pytest.approx(values.std(ddof=1))
+    assert description["min"] == values.min()
+    assert description["max"] == values.max()
+
+
+def test_quantiles_within_accuracy():
+    values = np.random.default_rng(1).lognormal(5, 0.5, 5000)
+    measure = make_measure(values, 0.02)
+    for quantile in (0.1, 0.5, 0.9, 0.99):
+        expected = np.quantile(values, quantile, method="lower")
+        assert get_quantile(measure, quantile, 0.02) == pytest.approx(
+            expected, rel=0.021)
+
+
+def test_quantiles_zeros():
+    measure = make_measure([0, 0, 0, 10])
+    assert get_quantile(measure, 0.5, 0.02) == 0.0
+    assert get_quantile(measure, 1.0, 0.02) == pytest.approx(10, rel=0.02)
+    assert get_quantile(create_measure(), 0.5, 0.02) is None
+
+
+def test_collapse_bins(monkeypatch):
+    monkeypatch.setattr(statsutils, "max_bins", 16)
+    values = np.geomspace(1, 1e6, 1000)
+    measure = make_measure(values, 0.02)
+    # The lowest bins are folded together, the upper quantiles are kept
+    assert len(measure["bins"]) == 16
+    assert sum(measure["bins"].values()) == 1000
+    assert get_quantile(measure, 0.99, 0.02) == pytest.approx(
+        np.quantile(values, 0.99, method="lower"), rel=0.021)
+
+
+def test_merge_hour():
+    # Merging two workers' halves gives the statistics of the whole
+    values = np.random.default_rng(2).gamma(2, 100, 1000)
+    first, second, whole = (create_stats(1, 0.02) for _ in range(3))
+    for value in values[:300]:
+        add_route(first, 10, {"delay": value})
+    for value in values[300:]:
+        add_route(second, 10, {"delay": value})
+    for value in values:
+        add_route(whole, 10, {"delay": value})
+
+    state = create_hour_state(1, 10, 0.02, request_time)
+    merge_hour(state, first["hours"]["10"], 0.02)
+    merged = merge_hour(state, second["hours"]["10"], 0.02)[
+        "measures"]["delay"]
+    expected = whole["hours"]["10"]["delay"]
+    assert merged["bins"] == expected["bins"]
+    assert merged["count"] == expected["count"]
+    assert merged["mean"] == pytest.approx(expected["mean"])
+    assert merged["m2"] == pytest.approx(expected["m2"])
+
+
+def test_merge_hour_rebinned():
+    values = np.random.default_rng(3).lognormal(5, 0.5, 1000)
+    stats = create_stats(1, 0.01)
+    for value in values:
+        add_route(stats, 0, {"delay": value})
+    state = create_hour_state(1, 0, 0.02, request_time)
+    merged = merge_hour(state, stats["hours"]["0"], 0.01)[
+        "measures"]["delay"]
+    assert sum(merged["bins"].values()) == 1000
+    assert get_quantile(merged, 0.5, 0.02) == pytest.approx(
+        np.quantile(values, 0.5), rel=0.035)
+
+
+def test_read_route():
+    hour, values = read_route(json.loads(make_route_file(120)), request_time)
+    # Tuesday 08:37 local
+    assert hour == 24 + 8
+    assert values == {"travel_time": 600.0, "delay": 120.0,
+                      "delay_per_km": 24.0}
+
+
+def test_get_hour_of_week():
+    assert get_hour_of_week("2020-02-10T00:10:00+01:00", request_time) == 0
+    assert get_hour_of_week("2020-02-16T23:59:00", request_time) == 167
+    # Tuesday 03:00 UTC
+    assert get_hour_of_week(None, request_time) == 27
+    assert get_hour_of_week("not a time", request_time) == 27
+
+
+def test_route_stats_sink(stats_store):
+    sink = RouteStatsSink(25)
+    sink.add((0, 0), (1, 1), request_time, make_route_file(60))
+    sink.add((0, 0), (1, 1), request_time, make_route_file(180))
+    sink.add((0, 0), (1, 1), request_time, make_route_file(
+        30, departure="2020-02-11T09:05:00+00:00"))
+    sink.add((0, 0), (1, 1), request_time, b'{"error": "no route"}')
+    sink.close()
+
+    # A blob per hour of the week the routes departed in
+    assert len(stats_store) == 2
+    stats = load_stats(25, 32)
+    assert stats["since"] == stats["updated"]
+    delay = stats["measures"]["delay"]
+    assert describe(delay, stats["accuracy"])["mean"] == 120.0
+    assert delay["count"] == 2
+    assert load_stats(25, 33)["measures"]["delay"]["count"] == 1
+
+
+def test_save_stats_conflict(stats_store, mocker):
+    mocker.patch("time.sleep")
+    url = get_stats_url(25, 5)
+    stats = create_stats(25, 0.02)
+    add_route(stats, 5, {"delay": 10.0})
+
+    # Another worker saves its routes between this one's read & write
+    download = blobutils.download_blob_with_etag.side_effect
+
+    def download_then_conflict(url):
+        result = download(url)
+        if not stats_store:
+            other = create_hour_state(25, 5, 0.02, request_time)
+            merge_hour(other, stats["hours"]["5"], 0.02)
+            blobutils.upload_blob_if_unchanged.side_effect(
+                url, json.dumps(other).encode("utf-8"), None)
+        return result
+
+    blobutils.download_blob_with_etag.side_effect = download_then_conflict
+    save_stats(25, stats)
+
+    state = json.loads(stats_store[url][0])
+    assert state["measures"]["delay"]["count"] == 2
+    assert stats_store[url][1] == "2"
+
+
+def test_save_stats_gives_up(stats_store, mocker):
+    mocker.patch("time.sleep")
+    blobutils.upload_blob_if_unchanged.side_effect = None
+    blobutils.upload_blob_if_unchanged.return_value = False
+    stats = create_stats(25, 0.02)
+    add_route(stats, 5, {"delay": 10.0})
+    with pytest.raises(Exception, match="gave up"):
+        save_stats(25, stats)
+
+
+def test_get_stats_url():
+    assert get_stats_url(25, 32).endswith(
+        "/stats/cityId=25/hour=32/stats.json")
@@ -0,0 +1,235 @@
+from __app__.SharedCode.tileutils import (
+    TileBlobSink, DedupTileSink, MosaicTileSink, CongestionTileSink,
+    PyramidTileSink, content_blob_name, create_tile_sinks, decode_tile,
+    pad_tile, classify_tile, create_mosaic, encode_npz, encode_tile,
+    downsample_tile, outside_class, StreamedArray)
+from __app__.SharedCode import maputils
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import threading
+import hashlib
+import json
+import time
+import io
+import pytest
+
+
+def create_png(colour, size=256):
+    """Encodes a single colour RGBA tile as PNG bytes"""
+    buffer = io.BytesIO()
+    Image.new("RGBA", (size, size), colour).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_tile_blob_sink(mocker):
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+    sink = TileBlobSink("https://teststorage.invalid/tiles", "cityId=1/")
+    sink.add(4096, 4073, 13, b"png")
+    sink.close()
+    m.assert_called_once_with("https://teststorage.invalid/tiles",
+                              "cityId=1/map.4096.4073.13.traffic.png",
+                              b"png", raise_errors=True)
+
+
+def test_dedup_tile_sink(mocker):
+    stored = set()
+
+    def mock_upload_if_absent(container_url, file_name, results,
+                              raise_errors=False):
+        uploaded = file_name not in stored
+        stored.add(file_name)
+        return uploaded
+
+    mocker.patch('__app__.SharedCode.blobutils.upload_if_absent',
+                 side_effect=mock_upload_if_absent)
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    sink = DedupTileSink("https://teststorage.invalid/tiles", "1",
+                         "cityId=1/minute=0/", "2020-02-11T11:30:00")
+    sink.add(1, 1, 13, b"same")
+    sink.add(1, 2, 13, b"same")
+    sink.add(2, 1, 13, b"other")
+    sink.close()
+
+    # Two distinct contents stored, one manifest for the three tiles
+    assert sink.uploaded == 2
+    (container_url, file_name, manifest), _ = m.call_args
+    assert file_name == "cityId=1/minute=0/manifest.13.1.1.json"
+    tiles = json.loads(manifest)["tiles"]
+    assert [(t["x"], t["y"]) for t in tiles] == [(1, 1), (1, 2), (2, 1)]
+    assert tiles[0]["sha256"] == hashlib.sha256(b"same").hexdigest()
+    assert tiles[0]["timestamp"] == "2020-02-11T11:30:00"
+
+
+def test_dedup_tile_sink_concurrent(mocker):
+    uploads = []
+    started = threading.Event()
+
+    def mock_upload_if_absent(container_url, file_name, results,
+                              raise_errors=False):
+        uploads.append(file_name)
+        if len(uploads) == 1:
+            # The first write is still going when the other tiles arrive
+            started.set()
+            time.sleep(0.05)
+            raise Exception("Storage unavailable")
+        return True
+
+    mocker.patch('__app__.SharedCode.blobutils.upload_if_absent',
+                 side_effect=mock_upload_if_absent)
+    sink = DedupTileSink("https://teststorage.invalid/tiles", "1",
+                         "cityId=1/minute=0/", "2020-02-11T11:30:00")
+
+    def add(y):
+        if y:
+            started.wait()
+        try:
+            sink.add(1, y, 13, b"same")
+        except Exception:
+            return False
+        return True
+
+    with ThreadPoolExecutor(8) as executor:
+        added = list(executor.map(add, range(8)))
+    # The failed write is taken over once, not repeated for every tile
+    assert added == [False] + [True] * 7
+    assert len(uploads) == 2
+    assert sink.uploaded == 1
+
+
+def test_mosaic_tile_sink(mocker):
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+    sink = MosaicTileSink("https://teststorage.invalid/tiles", "cityId=1/")
+    sink.add(11, 20, 13, create_png((255, 0, 0, 255)))
+    sink.add(10, 21, 13, create_png((0, 255, 0, 255)))
+    sink.close()
+
+    (container_url, file_name, data), _ = m.call_args
+    assert file_name == "cityId=1/mosaic.13.10.20.traffic.npz"
+    mosaic = np.load(io.BytesIO(data))
+    assert mosaic["tile_xy"].tolist() == [[10, 21], [11, 20]]
+    assert mosaic["pixel_origin"].tolist() == [[0, 256], [256, 0]]
+    assert mosaic["mosaic_shape"].tolist() == [512, 512]
+    assert mosaic["tiles"][1, 0, 0].tolist() == [255, 0, 0, 255]
+
+
+def test_decode_tile():
+    tile = decode_tile(create_png((1, 2, 3, 4), size=8))
+    assert tile.shape == (8, 8, 4)
+    assert tile[0, 0].tolist() == [1, 2, 3, 4]
+
+
+def test_create_mosaic():
+    mosaic = create_mosaic({(5, 5): create_png((0, 0, 0, 0))}, 13)
+    assert mosaic["origin_tile"].tolist() == [5, 5]
+    assert mosaic["tiles"].shape == (1, 256, 256, 4)
+
+
+def test_encode_npz():
+    data = encode_npz({"a": np.arange(3)})
+    assert np.load(io.BytesIO(data))["a"].tolist() == [0, 1, 2]
+
+
+def test_encode_npz_streamed():
+    chunks = (np.full((2, 3), number, dtype=np.uint8) for number in range(4))
+    data = encode_npz({"a": StreamedArray((4, 2, 3), np.uint8, chunks),
+                       "b": np.arange(2)})
+    arrays = np.load(io.BytesIO(data))
+    assert arrays["a"].shape == (4, 2, 3)
+    assert arrays["a"][:, 0, 0].tolist() == [0, 1, 2, 3]
+    assert arrays["b"].tolist() == [0, 1]
+
+
+def test_content_blob_name():
+    assert (content_blob_name("1", "abcdef") ==
+            "cityId=1/content/ab/abcdef.png")
+
+
+def test_congestion_tile_sink(mocker):
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+    # Covers the left half of tile (4096, 4095) at zoom 13
+    polygon = maputils.create_polygon_from_string(
+        "0 0, 0.05 0, 0.05 0.02197265625, 0 0.02197265625, 0 0")
+    sink = CongestionTileSink("https://teststorage.invalid/tiles",
+                              "cityId=1/", polygon)
+    sink.add(4096, 4095, 13, create_png((0xf4, 0x43, 0x36, 255)))
+    sink.close()
+
+    (container_url, file_name, data), _ = m.call_args
+    assert file_name == "cityId=1/congestion.13.4096.4095.npz"
+    congestion = np.load(io.BytesIO(data))
+    grid = congestion["grid"][0]
+    assert grid.dtype == np.uint8
+    assert grid[128, 0] == 3 and grid[128, 255] == outside_class
+    assert congestion["tiles_histogram"].tolist() == [0, 0, 0, 256 * 128, 0]
+    assert congestion["classes"][3] == "heavy"
+
+
+def test_pyramid_tile_sink(mocker):
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+    sink = PyramidTileSink("https://teststorage.invalid/tiles", "cityId=1/",
+                           11)
+    # The four zoom 13 tiles of zoom 12 tile (2048, 2047), each a colour
+    colours = {(4096, 4094): (255, 0, 0, 255), (4097, 4094): (0, 255, 0, 255),
+               (4096, 4095): (0, 0, 255, 255), (4097, 4095): (0, 0, 0, 0)}
+    for (tileX, tileY), colour in colours.items():
+        sink.add(tileX, tileY, 13, create_png(colour))
+    sink.close()
+
+    tiles = {call[0][1]: decode_tile(call[0][2]) for call in m.call_args_list}
+    assert list(tiles) == ["cityId=1/map.2048.2047.12.traffic.png",
+                           "cityId=1/map.1024.1023.11.traffic.png"]
+    parent = tiles["cityId=1/map.2048.2047.12.traffic.png"]
+    assert parent[0, 0].tolist() == [255, 0, 0, 255]
+    assert parent[0, 255].tolist() == [0, 255, 0, 255]
+    assert parent[255, 0].tolist() == [0, 0, 255, 255]
+    assert parent[255, 255].tolist() == [0, 0, 0, 0]
+    # Zoom 12 tile (2048, 2047) is the bottom left quadrant of its parent
+    grandparent = tiles["cityId=1/map.1024.1023.11.traffic.png"]
+    assert grandparent[:128].sum() == 0 and grandparent[:, 128:].sum() == 0
+    assert grandparent[128, 0].tolist() == [255, 0, 0, 255]
+
+
+def test_downsample_tile():
+    tile = np.zeros((2, 4, 4), dtype=np.uint8)
+    # A road next to transparent pixels keeps its colour, fading in alpha
+    tile[:, 0] = (200, 100, 0, 255)
+    tile[:, 2:] = (0, 0, 200, 255)
+    assert downsample_tile(tile).tolist() == [[[200, 100, 0, 128],
+                                               [0, 0, 200, 255]]]
+
+
+def test_encode_tile():
+    tile = np.zeros((256, 256, 4), dtype=np.uint8)
+    tile[10, 20] = (1, 2, 3, 4)
+    assert np.array_equal(decode_tile(encode_tile(tile)), tile)
+
+
+def test_classify_tile():
+    tile = np.zeros((2, 2, 4), dtype=np.uint8)
+    tile[0, 0] = (0x50, 0xb0, 0x50, 255)
+    tile[0, 1] = (0x80, 0x00, 0x00, 255)
+    tile[1, 0] = (0xff, 0xc0, 0x00, 60)
+    mask = np.array([[True, True], [True, False]])
+    assert classify_tile(tile, mask).tolist() == [[1, 4], [0, outside_class]]
+
+
+def test_pad_tile():
+    tile = pad_tile(np.ones((1, 1, 4), dtype=np.uint8))
+    assert tile.shape == (256, 256, 4)
+    assert tile.sum() == 4
+
+
+def test_create_tile_sinks():
+    assert isinstance(create_tile_sinks("tiles", "url", "1", "f/", "t")[0],
+                      TileBlobSink)
+    assert isinstance(create_tile_sinks("dedup", "url", "1", "f/", "t")[0],
+                      DedupTileSink)
+    sinks = create_tile_sinks("mosaic", "url", "1", "f/", "t", None, True,
+                              10)
+    assert isinstance(sinks[0], MosaicTileSink)
+    assert isinstance(sinks[1], CongestionTileSink)
+    assert isinstance(sinks[2], PyramidTileSink)
+    with pytest.raises(ValueError):
+        create_tile_sinks("unknown", "url", "1", "f/", "t")
@@ -1,29 +1,52 @@
 import pytest
+from unittest.mock import Mock
 import requests
 import json
 from azure.storage.blob import BlobClient, ContainerClient
+from azure.core.exceptions import (
+    ResourceNotModifiedError, ResourceNotFoundError)
+from azure.core import MatchConditions
 from azure.keyvault.secrets import SecretClient
+from __app__.SharedCode import secretutils, blobutils
 
 
 class MockResponse:
+    status_code = 200
+
     @staticmethod
     def raise_for_status():
         return None
     content = b'mock data from Maps API'
 
+    def close(self):
+        self.closed = True
+
 
 class MockBlobClient:
+    etag = '"0x8D7AE8AB5B1B7E2"'
+
     def __init__(self, blob_url):
         self.blob_url = blob_url
 
-    def download_blob(self):
-        return MockStorageStreamDownloader()
+    def download_blob(self, etag=None, match_condition=None):
+        if (match_condition == MatchConditions.IfModified
+                and etag == self.etag):
+            raise ResourceNotModifiedError("The condition specified using "
+                                           "HTTP conditional header(s) "
+                                           "is not met.")
+        return MockStorageStreamDownloader(self.etag)
 
-    def upload_blob(self, results):
+    def upload_blob(self, results, overwrite=False, **kwargs):
         return {"mock_prop_key": "mock_prop_value"}
 
+    def get_blob_properties(self):
+        raise ResourceNotFoundError("The specified blob does not exist.")
+
 
 class MockStorageStreamDownloader:
+    def __init__(self, etag):
+        self.properties = Mock(etag=etag)
+
     @staticmethod
     def readall():
         json_file = json.dumps({"mock_key": "mock_value"})
@@ -38,6 +61,16 @@ class MockContainerClient:
         return MockBlobClient(url)
 
 
+@pytest.fixture(autouse=True)
+def reset_caches():
+    """Process-wide caches are emptied so tests don't leak state"""
+    secretutils.clear_cache()
+    blobutils.container_clients.clear()
+    blobutils.clear_polygonsJSON_cache()
+    blobutils.known_blobs.clear()
+    yield
+
+
 @pytest.fixture
 def mock_response(monkeypatch):
     """Requests.get() mocked to return {'mock_key':'mock_response'}."""
@@ -45,6 +78,7 @@ def mock_response(monkeypatch):
         return MockResponse()
 
     monkeypatch.setattr(requests, "get", mock_get)
+    monkeypatch.setattr(requests.Session, "get", mock_get)
 
 
 @pytest.fixture
@@ -0,0 +1,43 @@
+# ----------------------------------------------------------
+# Local in-process stand-in for an Azure Storage queue
+# Acts as the queue output binding of the timer functions and drains
+# its messages into a queue triggered worker, retrying failed messages
+# and moving them to a poison list like the Functions host does
+# ----------------------------------------------------------
+
+
+import azure.functions as func
+import collections
+
+
+class LocalQueue:
+    """Queue output binding (set/get) that can be drained into a worker"""
+
+    def __init__(self, max_dequeue_count=5):
+        self.max_dequeue_count = max_dequeue_count
+        self.messages = collections.deque()
+        self.poison = []
+
+    def set(self, value):
+        if isinstance(value, (list, tuple)):
+            self.messages.extend((body, 0) for body in value)
+        else:
+            self.messages.append((value, 0))
+
+    def get(self):
+        return [body for body, _ in self.messages]
+
+    def drain(self, worker_main):
+        """Runs worker_main for every message until the queue is empty"""
+        processed = 0
+        while self.messages:
+            body, dequeue_count = self.messages.popleft()
+            try:
+                worker_main(func.QueueMessage(body=body.encode("utf-8")))
+                processed += 1
+            except Exception:
+                if dequeue_count + 1 >= self.max_dequeue_count:
+                    self.poison.append(body)
+                else:
+                    self.messages.append((body, dequeue_count + 1))
+        return processed
@@ -0,0 +1,417 @@
+# ----------------------------------------------------------
+# Local stand-in HTTP servers for offline tests & benchmarks
+# LocalMapsServer emulates the Azure Maps route directions (single &
+# batch submit/poll) and traffic tile APIs used by the functions,
+# LocalKeyVaultServer a vault plus the managed identity token endpoint
+# and LocalBlobServer the blob storage operations the functions use.
+# Every server can add latency, server errors and 429 throttling.
+# ----------------------------------------------------------
+
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+from xml.etree import ElementTree
+import collections
+import threading
+import itertools
+import datetime
+import random
+import time
+import math
+import json
+import ssl
+import os
+
+
+# A 1x1 transparent PNG, returned for every traffic tile
+blank_png = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000001e221bc330000"
+    "000049454e44ae426082")
+
+
+def fake_route(query):
+    """Builds a deterministic route response for a 'lat,lon:lat,lon' query"""
+    (origin_lat, origin_lon), (dest_lat, dest_lon) = (
+        [float(value) for value in point.split(",")]
+        for point in query.split(":"))
+
+    # Rough straight line distance, padded to look like a road network
+    length = int(111320 * 1.3 * math.hypot(
+        dest_lat - origin_lat,
+        (dest_lon - origin_lon) * math.cos(math.radians(origin_lat))))
+    no_traffic_time = int(length / 12)
+    delay = int(no_traffic_time * 0.2)
+    summary = {
+        "lengthInMeters": length,
+        "travelTimeInSeconds": no_traffic_time + delay,
+        "trafficDelayInSeconds": delay,
+        "departureTime": "2020-02-11T11:37:00+00:00",
+        "arrivalTime": "2020-02-11T12:02:00+00:00",
+        "noTrafficTravelTimeInSeconds": no_traffic_time,
+        "historicTrafficTravelTimeInSeconds": no_traffic_time + delay // 2,
+        "liveTrafficIncidentsTravelTimeInSeconds": no_traffic_time + delay,
+    }
+    points = [{"latitude": round(origin_lat + (dest_lat - origin_lat)
+                                 * step / 20, 5),
+               "longitude": round(origin_lon + (dest_lon - origin_lon)
+                                  * step / 20, 5)}
+              for step in range(21)]
+
+    return {
+        "formatVersion": "0.0.12",
+        "routes": [{
+            "summary": summary,
+            "legs": [{"summary": summary, "points": points}],
+            "sections": [{"startPointIndex": 0, "endPointIndex": 20,
+                          "sectionType": "TRAVEL_MODE",
+                          "travelMode": "car"}]
+        }]
+    }
+
+
+def create_tls_context(directory):
+    """Creates a self-signed certificate for 127.0.0.1 and a server context.
+
+    Returns the context and the path of the certificate, which clients
+    can trust through REQUESTS_CA_BUNDLE.
+    """
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    import ipaddress
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName(
+            [x509.IPAddress(ipaddress.ip_address("127.0.0.1")),
+             x509.DNSName("localhost")]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None),
+                       critical=True)
+        .sign(key, hashes.SHA256()))
+
+    cert_path = os.path.join(directory, "localservers.pem")
+    key_path = os.path.join(directory, "localservers.key")
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()))
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    return context, cert_path
+
+
+class LocalServer:
+    """Threaded HTTP(S) server base class, for use as a context.
+
+    Each request waits `latency` seconds, then fails with a 500 with
+    probability `error_rate` or is throttled with a 429 (asking clients to
+    retry after `retry_after` seconds) with probability `throttle_rate`.
+    """
+
+    def __init__(self, latency=0, error_rate=0, throttle_rate=0,
+                 retry_after=0, tls_context=None, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = []
+        self.statuses = collections.Counter()
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0),
+                                         self.create_handler())
+        self.httpd.daemon_threads = True
+        self.scheme = "http"
+        if tls_context:
+            self.httpd.socket = tls_context.wrap_socket(
+                self.httpd.socket, server_side=True)
+            self.scheme = "https"
+
+    @property
+    def endpoint(self):
+        host, port = self.httpd.server_address
+        return f"{self.scheme}://{host}:{port}/"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def draw_fault(self):
+        """Gets the status of an injected failure, or None to serve"""
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.throttle_rate:
+            return 429
+        if draw < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+    def handle(self, handler, method, url, params, body):
+        """Serves a request, to be implemented by each server"""
+        raise NotImplementedError
+
+    def create_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections alive, as the real services do
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, body=b"", headers=()):
+                with server.lock:
+                    server.statuses[status] += 1
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def send_json(self, status, payload, headers=()):
+                body = json.dumps(payload).encode("utf-8")
+                self.send(status, body,
+                          [("Content-Type", "application/json")]
+                          + list(headers))
+
+            def dispatch(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                with server.lock:
+                    server.requests.append((self.command, url.path))
+
+                if server.latency:
+                    time.sleep(server.latency)
+                fault = server.draw_fault()
+                if fault == 429:
+                    self.send_json(429, {"error": {"code": "TooManyRequests"}},
+                                   [("Retry-After", str(server.retry_after))])
+                elif fault:
+                    self.send_json(fault, {"error": {"code": "ServerError"}})
+                else:
+                    server.handle(self, self.command, url, parse_qs(url.query),
+                                  body)
+
+            do_GET = do_POST = do_PUT = do_HEAD = dispatch
+
+        return Handler
+
+
+class LocalMapsServer(LocalServer):
+    """Server emulating Azure Maps.
+
+    `pending_polls` sets how many times a batch is polled (answering 202)
+    before its results are returned.
+    """
+
+    def __init__(self, pending_polls=1, **kwargs):
+        self.pending_polls = pending_polls
+        self.batches = {}
+        self.batch_ids = itertools.count(1)
+        super().__init__(**kwargs)
+
+    def submit_batch(self, batch_items):
+        """Stores a batch, returning the id to poll it by"""
+        with self.lock:
+            batch_id = str(next(self.batch_ids))
+            self.batches[batch_id] = {"items": batch_items,
+                                      "polls": 0}
+        return batch_id
+
+    def poll_batch(self, batch_id):
+        """Gets the results of a batch, or None if it's still pending"""
+        with self.lock:
+            batch = self.batches[batch_id]
+            batch["polls"] += 1
+            if batch["polls"] <= self.pending_polls:
+                return None
+
+        results = []
+        for item in batch["items"]:
+            query = parse_qs(urlparse(item["query"]).query)["query"][0]
+            results.append({"statusCode": 200,
+                            "response": fake_route(query)})
+        return {"batchItems": results,
+                "summary": {"successfulRequests": len(results),
+                            "totalRequests": len(results)}}
+
+    def handle(self, handler, method, url, params, body):
+        if method == "GET" and url.path == "/route/directions/json":
+            handler.send_json(200, fake_route(params["query"][0]))
+        elif (method == "GET"
+              and url.path.startswith("/route/directions/batch/")):
+            batch_id = url.path.rsplit("/", 1)[-1]
+            result = self.poll_batch(batch_id)
+            if result is None:
+                location = (f"{self.endpoint}route/directions/"
+                            f"batch/{batch_id}?api-version=1.0")
+                handler.send_json(202, {}, [("Location", location)])
+            else:
+                handler.send_json(200, result)
+        elif method == "GET" and url.path == "/traffic/flow/tile/png":
+            handler.send(200, blank_png, [("Content-Type", "image/png")])
+        elif method == "POST" and url.path == "/route/directions/batch/json":
+            batch_id = self.submit_batch(json.loads(body)["batchItems"])
+            location = (f"{self.endpoint}route/directions/batch/"
+                        f"{batch_id}?api-version=1.0")
+            handler.send_json(202, {}, [("Location", location)])
+        else:
+            handler.send_json(404, {"error": {"code": "NotFound"}})
+
+
+class LocalKeyVaultServer(LocalServer):
+    """Server emulating a Key Vault and the App Service identity endpoint.
+
+    Point IDENTITY_ENDPOINT at `identity_endpoint` (with any IDENTITY_HEADER)
+    for ManagedIdentityCredential to get its tokens here. Needs a TLS
+    context, as the Azure SDKs only send bearer tokens over HTTPS.
+    """
+
+    def __init__(self, secrets, **kwargs):
+        self.secrets = dict(secrets)
+        super().__init__(**kwargs)
+
+    @property
+    def identity_endpoint(self):
+        return f"{self.endpoint}msi/token"
+
+    def handle(self, handler, method, url, params, body):
+        if url.path == "/msi/token":
+            handler.send_json(200, {
+                "access_token": "local-token",
+                "expires_on": str(int(time.time()) + 3600),
+                "resource": params.get("resource", [""])[0],
+                "token_type": "Bearer"})
+        elif url.path.startswith("/secrets/"):
+            if "Authorization" not in handler.headers:
+                # The SDK checks the vault's host is a subdomain of the
+                # challenge resource, which 127.0.0.1 is of 0.0.1
+                host, port = self.httpd.server_address
+                resource = f"https://{host.split('.', 1)[1]}:{port}"
+                handler.send_json(401, {"error": {"code": "Unauthorized"}}, [(
+                    "WWW-Authenticate",
+                    f'Bearer authorization="{self.endpoint}local-tenant", '
+                    f'resource="{resource}"')])
+                return
+            name = url.path.split("/")[2]
+            if name not in self.secrets:
+                handler.send_json(404, {"error": {"code": "SecretNotFound"}})
+                return
+            handler.send_json(200, {
+                "value": self.secrets[name],
+                "id": f"{self.endpoint}secrets/{name}/1",
+                "attributes": {"enabled": True}})
+        else:
+            handler.send_json(404, {"error": {"code": "NotFound"}})
+
+
+class LocalBlobServer(LocalServer):
+    """Server emulating Blob Storage, with blobs held in memory.
+
+    URLs are path-style like Azurite's, /{account}/{container}/{blob}, and
+    a TLS context is needed for the SDK's bearer token authentication.
+    """
+
+    account = "devstoreaccount1"
+
+    def __init__(self, **kwargs):
+        self.blobs = {}
+        self.blocks = collections.defaultdict(dict)
+        self.etags = itertools.count(1)
+        super().__init__(**kwargs)
+
+    def container_url(self, container):
+        return f"{self.endpoint}{self.account}/{container}"
+
+    def put(self, path, data):
+        """Stores a blob's content by its /{account}/{container}/{blob} path"""
+        with self.lock:
+            etag = f'"0x{next(self.etags):015X}"'
+            self.blobs[path] = {"data": data, "etag": etag,
+                                "modified": time.time()}
+        return etag
+
+    def blob_headers(self, blob):
+        return [("ETag", blob["etag"]),
+                ("Last-Modified", datetime.datetime.fromtimestamp(
+                    blob["modified"], datetime.timezone.utc).strftime(
+                        "%a, %d %b %Y %H:%M:%S GMT")),
+                ("x-ms-blob-type", "BlockBlob"),
+                ("Content-Type", "application/octet-stream")]
+
+    def handle(self, handler, method, url, params, body):
+        path = unquote(url.path)
+        with self.lock:
+            blob = self.blobs.get(path)
+        comp = params.get("comp", [None])[0]
+
+        if method in ("GET", "HEAD"):
+            if blob is None:
+                handler.send(404, headers=[("x-ms-error-code",
+                                            "BlobNotFound")])
+            elif handler.headers.get("If-None-Match") == blob["etag"]:
+                handler.send(304, headers=[("ETag", blob["etag"]),
+                                           ("x-ms-error-code",
+                                            "ConditionNotMet")])
+            else:
+                self.send_blob(handler, blob)
+        elif method == "PUT" and comp == "block":
+            with self.lock:
+                self.blocks[path][params["blockid"][0]] = body
+            handler.send(201)
+        elif method == "PUT" and comp == "blocklist":
+            block_ids = [element.text for element in
+                         ElementTree.fromstring(body)]
+            with self.lock:
+                staged = self.blocks.pop(path, {})
+            etag = self.put(path, b"".join(staged[block_id]
+                                           for block_id in block_ids))
+            handler.send(201, headers=[("ETag", etag)])
+        elif method == "PUT":
+            if handler.headers.get("If-None-Match") == "*" and blob:
+                handler.send(409, headers=[("x-ms-error-code",
+                                            "BlobAlreadyExists")])
+                return
+            etag = self.put(path, body)
+            handler.send(201, headers=[("ETag", etag)])
+        else:
+            handler.send(400)
+
+    def send_blob(self, handler, blob):
+        data = blob["data"]
+        headers = self.blob_headers(blob)
+        requested = (handler.headers.get("x-ms-range")
+                     or handler.headers.get("Range"))
+        if not requested or not data:
+            handler.send(200, data, headers)
+            return
+
+        start, _, end = requested.split("=", 1)[1].partition("-")
+        start = int(start)
+        end = min(int(end) if end else len(data) - 1, len(data) - 1)
+        headers.append(("Content-Range",
+                        f"bytes {start}-{end}/{len(data)}"))
+        handler.send(206, data[start:end + 1], headers)
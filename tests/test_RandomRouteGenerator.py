@@ -1,6 +1,14 @@
-from __app__ import RandomRouteGenerator
+from __app__ import RandomRouteGenerator, RandomRouteWorker
+from __app__.SharedCode import (
+    maputils, metricsutils, geometryutils, statsutils)
+from tests.localservers import LocalMapsServer
+from tests.localqueue import LocalQueue
 from unittest.mock import Mock
 from datetime import datetime
+import json
+import io
+import numpy as np
+import pytest
 import re
 import gzip
 
@@ -32,3 +40,371 @@ def test_random_routes_main(mock_blob, mock_response, mock_keyvault, mocker):
     RandomRouteGenerator.main(req)
 
     assert m.call_count == 100
+
+
+def test_random_routes_main_batch(mock_blob, mock_keyvault, mocker,
+                                  monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'}])
+    monkeypatch.setenv("ROUTES_REQUEST_MODE", "batch")
+    monkeypatch.setenv("ROUTES_BATCH_SIZE", "30")
+    monkeypatch.setattr(maputils, "batch_poll_interval", 0.01)
+
+    uploads = []
+    mocker.patch(
+        '__app__.SharedCode.blobutils.upload_results',
+        side_effect=lambda url, name, results, **kwargs: uploads.append(
+            (name, json.loads(gzip.decompress(results)))))
+
+    with LocalMapsServer(pending_polls=2) as server:
+        monkeypatch.setattr(maputils, "maps_endpoint", server.endpoint)
+        RandomRouteGenerator.main(req)
+
+    assert len(uploads) == 100
+    # 100 routes in batches of 30 is 4 submits, rather than 100 requests
+    submits = [r for r in server.requests if r[0] == "POST"]
+    assert len(submits) == 4
+    assert sorted(int(name.rsplit("/", 1)[1].split(".")[0])
+                  for name, _ in uploads) == list(range(1, 101))
+    for _, route in uploads:
+        assert "lengthInMeters" in route["routes"][0]["summary"]
+
+
+def test_random_routes_main_fanout(mock_blob, mock_response, mock_keyvault,
+                                   mocker, monkeypatch):
+    req = Mock()
+    queue = LocalQueue()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'},
+                      {'cityId': '26', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'}])
+    monkeypatch.setenv("FANOUT_MODE", "true")
+
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    RandomRouteGenerator.main(req, queue)
+
+    # The timer only queues one work item per city
+    assert len(queue.get()) == 2
+    assert m.call_count == 0
+
+    assert queue.drain(RandomRouteWorker.main) == 2
+    assert m.call_count == 200
+
+
+def test_random_routes_main_city_failure(mock_blob, mock_response,
+                                         mock_keyvault, mocker):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '24', 'polygon': ''},
+                      {'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'}])
+
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    # The failing city doesn't stop the next one, but fails the run
+    with pytest.raises(Exception, match="24"):
+        RandomRouteGenerator.main(req)
+    assert m.call_count == 100
+
+
+def test_random_routes_main_summary(mock_blob, mock_keyvault, mocker,
+                                    monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'}])
+    monkeypatch.setenv("ROUTES_SUMMARY_OUTPUT", "true")
+
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    with LocalMapsServer() as server:
+        monkeypatch.setattr(maputils, "maps_endpoint", server.endpoint)
+        RandomRouteGenerator.main(req)
+
+    # 100 raw route blobs plus the run's columnar summary
+    assert m.call_count == 101
+    (container_url, file_name, data), _ = m.call_args
+    assert file_name.endswith("/summary.npy")
+    assert len(np.load(io.BytesIO(data))) == 100
+
+
+def test_random_routes_main_ndjson(mock_blob, mock_keyvault, mocker,
+                                   monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'}])
+    mocker.patch(
+        '__app__.RandomRouteGenerator.datetime',
+        Mock(utcnow=lambda: datetime(2017, 11, 29, 14, 32, 23)))
+    monkeypatch.setenv("ROUTES_OUTPUT_MODE", "ndjson")
+
+    blocks = {}
+    mocker.patch('__app__.SharedCode.blobutils.stage_block',
+                 side_effect=lambda url, name, block_id, data:
+                 blocks.__setitem__(block_id, data))
+    commit = mocker.patch('__app__.SharedCode.blobutils.commit_blocks')
+    upload = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    with LocalMapsServer() as server:
+        monkeypatch.setattr(maputils, "maps_endpoint", server.endpoint)
+        RandomRouteGenerator.main(req)
+
+    # All routes go to one streamed blob rather than a blob each
+    assert upload.call_count == 0
+    (container_url, file_name, block_ids), _ = commit.call_args
+    assert file_name == ('cityId=25/year=2017/month=11/day=29/hour=14/'
+                         'minute=32/routes.ndjson.gz')
+    lines = gzip.decompress(
+        b"".join(blocks[block_id] for block_id in block_ids)).splitlines()
+    assert len(lines) == 100
+    assert all("routes" in json.loads(line) for line in lines)
+
+
+def test_random_routes_main_od_panel(mock_blob, mock_keyvault, mocker,
+                                     monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'}])
+    monkeypatch.setenv("OD_PANEL", "true")
+
+    panels = {}
+    mocker.patch('__app__.SharedCode.blobutils.download_blob',
+                 side_effect=panels.get)
+    mocker.patch('__app__.SharedCode.blobutils.upload_blob',
+                 side_effect=panels.__setitem__)
+    mocker.patch('__app__.SharedCode.blobutils.upload_results')
+    sampler = mocker.spy(maputils, 'get_random_coords')
+
+    with LocalMapsServer() as server:
+        monkeypatch.setattr(maputils, "maps_endpoint", server.endpoint)
+        RandomRouteGenerator.main(req)
+        RandomRouteGenerator.main(req)
+
+    # The panel is sampled in full once, then only its rotated tenth
+    assert [call[0][1] for call in sampler.call_args_list] == [200, 20]
+    assert len(panels) == 1
+    assert len(server.requests) == 200
+
+
+def test_random_routes_main_metrics(mock_blob, mock_keyvault, mocker,
+                                    monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'}])
+    mocker.patch('__app__.SharedCode.blobutils.upload_results')
+    emit = mocker.spy(metricsutils.RunMetrics, 'emit')
+
+    with LocalMapsServer() as server:
+        monkeypatch.setattr(maputils, "maps_endpoint", server.endpoint)
+        RandomRouteGenerator.main(req)
+
+    # One record for the invocation, with the city's stages & counters
+    assert emit.call_count == 1
+    city = emit.spy_return["cities"]["25"]
+    assert city["counters"]["maps_calls"] == 100
+    assert city["counters"]["sampled_points"] == 200
+    assert city["stages"]["maps_http"]["calls"] == 100
+    assert city["stages"]["gzip"]["calls"] == 100
+    assert "sampling" in city["stages"]
+
+
+def test_random_routes_main_schedule(mock_blob, mock_keyvault, mocker,
+                                     monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'},
+                      {'cityId': '26',
+                       'polygon': '0 0, 0 .1, .1 .1, .1 0, 0 0'}])
+    mocker.patch('__app__.SharedCode.scheduleutils.adaptive_schedule', True)
+    store = {}
+    mocker.patch('__app__.SharedCode.blobutils.download_blob',
+                 side_effect=store.get)
+    mocker.patch('__app__.SharedCode.blobutils.upload_blob',
+                 side_effect=store.__setitem__)
+    mocker.patch('__app__.SharedCode.blobutils.upload_results')
+    sampler = mocker.spy(maputils, 'get_random_coords')
+
+    with LocalMapsServer() as server:
+        monkeypatch.setattr(maputils, "maps_endpoint", server.endpoint)
+        RandomRouteGenerator.main(req)
+        RandomRouteGenerator.main(req)
+
+    # Without history both cities get 100 routes. Then the large city,
+    # whose delays vary more, gets more of the same 200 route budget.
+    counts = [call[0][1] // 2 for call in sampler.call_args_list]
+    assert counts[:2] == [100, 100]
+    assert counts[2] > 100 and sum(counts[2:]) <= 200
+    assert len(server.requests) == sum(counts)
+    audits = [url for url in store if '/schedule/audit/' in url]
+    assert len(audits) >= 1
+
+
+def test_random_routes_main_schedule_od_panel(mock_blob, mock_keyvault,
+                                              mocker, monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'},
+                      {'cityId': '26',
+                       'polygon': '0 0, 0 .1, .1 .1, .1 0, 0 0'}])
+    mocker.patch('__app__.SharedCode.scheduleutils.adaptive_schedule', True)
+    monkeypatch.setenv("OD_PANEL", "true")
+    store = {}
+    mocker.patch('__app__.SharedCode.blobutils.download_blob',
+                 side_effect=store.get)
+    mocker.patch('__app__.SharedCode.blobutils.upload_blob',
+                 side_effect=store.__setitem__)
+    mocker.patch('__app__.SharedCode.blobutils.upload_results')
+    sampler = mocker.spy(maputils, 'get_random_coords')
+
+    with LocalMapsServer() as server:
+        monkeypatch.setattr(maputils, "maps_endpoint", server.endpoint)
+        RandomRouteGenerator.main(req)
+        RandomRouteGenerator.main(req)
+
+    # Panels hold the scheduled maximum of 200 routes, so the cities'
+    # changed route counts don't resample them, only their rotated tenth
+    counts = [call[0][1] // 2 for call in sampler.call_args_list]
+    assert counts == [200, 200, 20, 20]
+    assert len(server.requests) > 200
+
+
+def test_random_routes_main_geometry_encoding(mock_blob, mock_keyvault,
+                                              mocker, monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'}])
+    monkeypatch.setenv("ROUTES_GEOMETRY_ENCODING", "polyline")
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+    compact = mocker.spy(geometryutils, 'compact_route_file')
+
+    with LocalMapsServer() as server:
+        monkeypatch.setattr(maputils, "maps_endpoint", server.endpoint)
+        RandomRouteGenerator.main(req)
+
+    responses = [json.loads(call[0][0]) for call in compact.call_args_list]
+    assert m.call_count == 100
+    for (container_url, file_name, data), _ in m.call_args_list:
+        route = json.loads(gzip.decompress(data))
+        leg = route["routes"][0]["legs"][0]
+        assert "points" not in leg
+        assert leg["encodedPoints"]["format"] == "polyline"
+        # Expanding restores the points Maps returned
+        assert geometryutils.expand_route(route) in responses
+
+
+def test_random_routes_main_unknown_geometry_encoding(
+        mock_blob, mock_response, mock_keyvault, mocker, monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'}])
+    monkeypatch.setenv("ROUTES_GEOMETRY_ENCODING", "gzip")
+
+    with pytest.raises(Exception, match="25"):
+        RandomRouteGenerator.main(req)
+
+
+def test_random_routes_main_stats(mock_blob, mock_keyvault, mocker,
+                                  monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'}])
+    mocker.patch('__app__.SharedCode.statsutils.stats_output', True)
+    mocker.patch('__app__.SharedCode.blobutils.upload_results')
+    store = {}
+    mocker.patch('__app__.SharedCode.blobutils.download_blob_with_etag',
+                 side_effect=lambda url: store.get(url, (None, None)))
+    mocker.patch('__app__.SharedCode.blobutils.upload_blob_if_unchanged',
+                 side_effect=lambda url, data, etag:
+                 store.__setitem__(url, (data, "etag")) or True)
+
+    with LocalMapsServer() as server:
+        monkeypatch.setattr(maputils, "maps_endpoint", server.endpoint)
+        RandomRouteGenerator.main(req)
+        RandomRouteGenerator.main(req)
+
+    # Both runs' routes are merged into the city's stats blob for the hour
+    # the fake routes all depart in, Tuesday 11:37
+    assert list(store) == [statsutils.get_stats_url('25', 35)]
+    stats = json.loads(store[statsutils.get_stats_url('25', 35)][0])
+    assert stats["cityId"] == '25'
+    delay = stats["measures"]["delay"]
+    assert delay["count"] == 200
+    assert statsutils.describe(delay, stats["accuracy"])["p50"] > 0
+
+
+def test_random_routes_main_batch_failures(mock_blob, mock_keyvault, mocker,
+                                           monkeypatch, caplog):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'}])
+    monkeypatch.setenv("ROUTES_REQUEST_MODE", "batch")
+    monkeypatch.setenv("ROUTES_BATCH_SIZE", "30")
+    upload = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    def query_maps_batch(batch_items):
+        if len(batch_items) < 30:
+            # The last batch of 10 fails as a whole
+            return None
+        return [{"statusCode": 200 if number % 3 else 400,
+                 "response": {"routes": []}}
+                for number in range(len(batch_items))]
+
+    mocker.patch('__app__.SharedCode.maputils.query_maps_batch',
+                 side_effect=query_maps_batch)
+    RandomRouteGenerator.main(req)
+
+    # Failures are counted per route: 10 per full batch, and all of the
+    # last one
+    assert upload.call_count == 60
+    assert "40 routes failed for CityID 25" in caplog.text
+
+
+def test_random_routes_main_batch_errors(mock_blob, mock_keyvault, mocker,
+                                         monkeypatch, caplog):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[{'cityId': '25', 'polygon': '0 0, 0 1, 1 1, 1 0, 0 0'}])
+    monkeypatch.setenv("ROUTES_REQUEST_MODE", "batch")
+    monkeypatch.setenv("ROUTES_BATCH_SIZE", "30")
+    upload = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    def query_maps_batch(batch_items):
+        if len(batch_items) < 30:
+            # The last batch of 10 can't be sent at all
+            raise Exception("Could not get Key Vault secret")
+        # Maps leaves the last 5 items out of the full batches
+        return [{"statusCode": 200, "response": {"routes": []}}] * 25
+
+    mocker.patch('__app__.SharedCode.maputils.query_maps_batch',
+                 side_effect=query_maps_batch)
+    RandomRouteGenerator.main(req)
+
+    assert upload.call_count == 75
+    assert "25 routes failed for CityID 25" in caplog.text
@@ -1,7 +1,13 @@
-from __app__ import TrafficTileGenerator
+from __app__ import TrafficTileGenerator, TrafficTileWorker
+from tests.localqueue import LocalQueue
 from unittest.mock import Mock
 from datetime import datetime
 import re
+import json
+import io
+import numpy as np
+import pytest
+from PIL import Image
 
 
 def test_random_routes_main(mock_blob, mock_response, mock_keyvault, mocker):
@@ -31,3 +37,186 @@ def test_random_routes_main(mock_blob, mock_response, mock_keyvault, mocker):
     TrafficTileGenerator.main(req)
 
     assert m.call_count == 72
+
+
+def test_traffic_tiles_main_fanout(mock_blob, mock_response, mock_keyvault,
+                                   mocker, monkeypatch):
+    req = Mock()
+    queue = LocalQueue()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[
+            {'cityId': '25', 'polygon': '0 0, 0 .1, 1 .1, 1 0, 0 0'}])
+    monkeypatch.setenv("FANOUT_MODE", "true")
+    monkeypatch.setenv("TILES_PER_WORK_ITEM", "20")
+
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    TrafficTileGenerator.main(req, queue)
+
+    # 72 tiles queued as chunks of up to 20
+    assert len(queue.get()) == 4
+    assert queue.drain(TrafficTileWorker.main) == 4
+    assert m.call_count == 72
+
+
+def test_traffic_tiles_main_fanout_invalid_city(mock_blob, mock_response,
+                                                mock_keyvault, mocker,
+                                                monkeypatch):
+    req = Mock()
+    queue = LocalQueue()
+
+    # An unclosed ring fails to parse, the valid city is still queued
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[
+            {'cityId': '24', 'polygon': '0 0, 0 .1, 1 .1'},
+            {'cityId': '25', 'polygon': '0 0, 0 .1, 1 .1, 1 0, 0 0'}])
+    monkeypatch.setenv("FANOUT_MODE", "true")
+    monkeypatch.setenv("TILES_PER_WORK_ITEM", "20")
+
+    with pytest.raises(Exception, match=r"CityIDs \['24'\]"):
+        TrafficTileGenerator.main(req, queue)
+    assert len(queue.get()) == 4
+
+
+def test_traffic_tiles_main_dedup(mock_blob, mock_response, mock_keyvault,
+                                  mocker, monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[
+            {'cityId': '25', 'polygon': '0 0, 0 .1, 1 .1, 1 0, 0 0'}])
+    mocker.patch(
+        '__app__.TrafficTileGenerator.datetime',
+        Mock(utcnow=lambda: datetime(2017, 11, 29, 14, 32, 23)))
+    monkeypatch.setenv("TILES_OUTPUT_MODE", "dedup")
+
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    TrafficTileGenerator.main(req)
+
+    # Every mocked tile is identical: one content blob and one manifest
+    names = [call[0][1] for call in m.call_args_list]
+    assert len(names) == 2
+    assert names[0].startswith('cityId=25/content/')
+    assert names[1].startswith('cityId=25/year=2017/month=11/day=29/'
+                               'hour=14/minute=32/manifest.13.')
+
+
+def test_traffic_tiles_main_mosaic(mock_blob, mock_keyvault, mocker,
+                                   monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[
+            {'cityId': '25', 'polygon': '0 0, 0 .1, 1 .1, 1 0, 0 0'}])
+    buffer = io.BytesIO()
+    Image.new("RGBA", (256, 256), (0, 255, 0, 255)).save(buffer, "PNG")
+    mocker.patch('__app__.SharedCode.maputils.query_maps',
+                 return_value=buffer.getvalue())
+    monkeypatch.setenv("TILES_OUTPUT_MODE", "mosaic")
+
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    TrafficTileGenerator.main(req)
+
+    # One blob holding all 72 tiles instead of 72 blobs
+    assert m.call_count == 1
+    (container_url, file_name, data), _ = m.call_args
+    assert re.search(r'/mosaic\.13\.\d+\.\d+\.traffic\.npz$', file_name)
+    assert np.load(io.BytesIO(data))["tiles"].shape == (72, 256, 256, 4)
+
+
+def test_traffic_tiles_main_congestion(mock_blob, mock_keyvault, mocker,
+                                       monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[
+            {'cityId': '25', 'polygon': '0 0, 0 .1, 1 .1, 1 0, 0 0'}])
+    buffer = io.BytesIO()
+    free_flow = (0x4c, 0xaf, 0x50, 255)
+    Image.new("RGBA", (256, 256), free_flow).save(buffer, "PNG")
+    mocker.patch('__app__.SharedCode.maputils.query_maps',
+                 return_value=buffer.getvalue())
+    monkeypatch.setenv("TILES_CONGESTION_OUTPUT", "true")
+
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    TrafficTileGenerator.main(req)
+
+    # 72 tile blobs plus the congestion grid
+    assert m.call_count == 73
+    (container_url, file_name, data), _ = m.call_args
+    assert re.search(r'/congestion\.13\.\d+\.\d+\.npz$', file_name)
+    congestion = np.load(io.BytesIO(data))
+    assert congestion["grid"].shape == (72, 256, 256)
+    # Every pixel inside the city is free flowing
+    histogram = congestion["tiles_histogram"]
+    assert histogram[1] == histogram.sum() > 0
+
+
+def test_traffic_tiles_main_schedule(mock_blob, mock_response, mock_keyvault,
+                                     mocker):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[
+            {'cityId': '25', 'polygon': '0 0, 0 .1, 1 .1, 1 0, 0 0'}])
+    mocker.patch('__app__.SharedCode.scheduleutils.adaptive_schedule', True)
+    store = {}
+    mocker.patch('__app__.SharedCode.blobutils.download_blob',
+                 side_effect=store.get)
+    mocker.patch('__app__.SharedCode.blobutils.upload_blob',
+                 side_effect=store.__setitem__)
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    TrafficTileGenerator.main(req)
+    assert m.call_count == 72
+
+    # Collected moments ago, so the city isn't due again yet
+    TrafficTileGenerator.main(req)
+    assert m.call_count == 72
+    state, = [json.loads(data) for url, data in store.items()
+              if url.endswith('/schedule/TrafficTileGenerator.json')]
+    assert state["cities"]["25"]["interval"] == 15
+    assert len(state["cities"]["25"]["tiles"]) == 72
+
+
+def test_traffic_tiles_main_pyramid(mock_blob, mock_keyvault, mocker,
+                                    monkeypatch):
+    req = Mock()
+
+    mocker.patch(
+        '__app__.SharedCode.blobutils.get_polygonsJSON',
+        return_value=[
+            {'cityId': '25', 'polygon': '0 0, 0 .1, 1 .1, 1 0, 0 0'}])
+    buffer = io.BytesIO()
+    Image.new("RGBA", (256, 256), (0, 255, 0, 255)).save(buffer, "PNG")
+    mocker.patch('__app__.SharedCode.maputils.query_maps',
+                 return_value=buffer.getvalue())
+    monkeypatch.setenv("TILES_PYRAMID_MIN_ZOOM", "11")
+
+    m = mocker.patch('__app__.SharedCode.blobutils.upload_results')
+
+    TrafficTileGenerator.main(req)
+
+    zooms = [int(call[0][1].split('.')[-3]) for call in m.call_args_list]
+    # The 72 zoom 13 tiles (a 3 x 24 block) are covered by 26 tiles at
+    # zoom 12 and 7 at zoom 11, all built without fetching them
+    assert (zooms.count(13), zooms.count(12), zooms.count(11)) == (72, 26, 7)
+
+
+def test_fetch_tile_no_response(mock_keyvault, mocker):
+    mocker.patch('__app__.SharedCode.maputils.query_maps', return_value=None)
+    sink = Mock()
+    # Raised, so run_concurrently counts the tile as failed
+    with pytest.raises(Exception, match="No tile from Maps"):
+        TrafficTileGenerator.fetch_tile(13, [sink], 4096, 4073)
+    assert sink.add.call_count == 0